@@ -0,0 +1,6 @@
+from aiohttp import web
+from python.async_app import create_app
+
+# An alternative to uWSGI (see wsgi.py), serving the bot from a single asyncio process
+if __name__ == "__main__":
+    web.run_app(create_app(), host='0.0.0.0', port=8443)
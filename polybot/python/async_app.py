@@ -0,0 +1,481 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack
+from aiohttp import web
+from loguru import logger
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiException, ApiTelegramException
+import threading
+import tempfile
+import asyncio
+import sqlite3
+import aiohttp
+import json
+import os
+from get_docker_secret import get_docker_secret
+from img_proc import Img
+from captions import parse_caption, is_prediction, PipelineCommand
+from bot import (ImageProcessingBot, WELCOME_TEXT, images_bucket, images_prefix, downscale_size,
+                 result_cache, file_id_cache, media_group_aggregator, send_scheduler)
+from bot_utils import parse_result, S3_CONFIG
+from async_bot_utils import s3_session, upload_image_to_s3, download_image_from_s3
+from downloader import FileDownloader, DOWNLOAD_MAX_BYTES, DOWNLOAD_SPOOL_BYTES, DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT, DOWNLOAD_POOL_SIZE, CHUNK_SIZE
+from ingest_queue import IngestQueue
+from seen_updates import SeenUpdates
+from yolo5_client import yolo5_url, poll_delays, request_timeout, retry_after, is_unknown_job, job_error, PREDICT_TIMEOUT, YOLO5_ENDPOINT, BUSY_STATUSES
+from resilience import call_async, deadline, current_deadline, breaker_stats, Unavailable, DeadlineExceeded
+
+# The number of updates a process handles at the same time, most of them waiting on Telegram, S3 or yolo5
+ASYNC_MAX_IN_FLIGHT = int(os.getenv("ASYNC_MAX_IN_FLIGHT", "5000"))
+# Number of threads decoding, filtering and encoding images, they're the only CPU bound work
+ASYNC_IMG_WORKERS = int(os.getenv("ASYNC_IMG_WORKERS", str(os.cpu_count() or 1)))
+# Number of media groups handled at the same time, each holds a thread while its concat runs on the loop
+ASYNC_MEDIA_GROUP_WORKERS = int(os.getenv("ASYNC_MEDIA_GROUP_WORKERS", "4"))
+
+# What to do with an update when the ingest queue is full (see flask_app)
+OVERLOAD_POLICY = os.getenv("WEBHOOK_OVERLOAD_POLICY", "reject")
+if OVERLOAD_POLICY not in ["reject", "busy"]:
+    raise ValueError("WEBHOOK_OVERLOAD_POLICY must be either 'reject' or 'busy'")
+
+# The same queue and seen updates as the uWSGI app, so either may be run on the same volume
+ingest_queue = IngestQueue()
+seen_updates = SeenUpdates()
+
+BOT_KEY = web.AppKey("bot", "AsyncBot")
+
+
+class AsyncBot:
+    """
+    The asyncio counterpart of the bots in bot.py, handling every update as a coroutine so waiting on Telegram,
+    S3 and yolo5 doesn't hold a thread and one process can keep thousands of updates in flight.
+    The decoding, filtering and encoding of the images runs on a thread pool, and the blocking helpers shared with
+    the uWSGI app (the caches, the queue, the media group aggregator) on the loop's default executor.
+    """
+
+    def __init__(self, token, telegram_chat_url, max_in_flight=ASYNC_MAX_IN_FLIGHT, img_workers=ASYNC_IMG_WORKERS):
+        self.token = token
+        self.telegram_chat_url = telegram_chat_url
+        self.max_in_flight = max_in_flight
+
+        self.tgbot = AsyncTeleBot(token)
+        self.img_executor = ThreadPoolExecutor(max_workers=img_workers, thread_name_prefix="img")
+        # The media groups are handled on their own threads, which wait for the concat on the loop. That one needs the
+        # default executor (see run_io), so a group must never hold one of its threads while waiting
+        self.media_group_executor = ThreadPoolExecutor(max_workers=ASYNC_MEDIA_GROUP_WORKERS, thread_name_prefix="media-group")
+        self.loop = None
+        self.session = None
+        self.s3 = None
+        self._exit_stack = AsyncExitStack()
+
+        # The send scheduler paces the requests on its own threads, they wait for these to run on the loop
+        self._send_message = self._blocking(self.tgbot.send_message)
+        self._send_photo = self._blocking(self.tgbot.send_photo)
+
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+
+    async def start(self, app) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.session = await self._exit_stack.enter_async_context(aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=DOWNLOAD_POOL_SIZE),
+            timeout=aiohttp.ClientTimeout(sock_connect=DOWNLOAD_CONNECT_TIMEOUT, sock_read=DOWNLOAD_READ_TIMEOUT)
+        ))
+        self.s3 = await self._exit_stack.enter_async_context(s3_session().client('s3', config=S3_CONFIG))
+
+        # Remove any existing webhooks configured in Telegram servers and set the webhook URL
+        await self.tgbot.remove_webhook()
+        await asyncio.sleep(0.5)
+        await self.tgbot.set_webhook(url=f'{self.telegram_chat_url}/{self.token}/', timeout=90)
+        logger.info(f'Telegram Bot information\n\n{await self.tgbot.get_me()}')
+
+        ingest_queue.start(self.dispatch)
+        media_group_aggregator.start(self.concat_media_group, self.dispatch_media_group, ingest_queue.has_media_group)
+
+    async def stop(self, app) -> None:
+        await self._exit_stack.aclose()
+        await self.tgbot.close_session()
+        self.img_executor.shutdown(wait=False)
+        self.media_group_executor.shutdown(wait=False)
+
+    def _blocking(self, coroutine_function):
+        def call(*args, **kwargs):
+            return asyncio.run_coroutine_threadsafe(coroutine_function(*args, **kwargs), self.loop).result()
+        return call
+
+    def run_io(self, fn, *args):
+        """
+        Runs a blocking helper (SQLite, the disk) on the loop's default executor
+        """
+        return self.loop.run_in_executor(None, fn, *args)
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_flight": self.in_flight, "max_in_flight": self.max_in_flight, "rejected": self.rejected}
+
+    def dispatch(self, update) -> bool:
+        """
+        Called by the ingest queue's dispatcher thread with every leased update
+        """
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+
+        asyncio.run_coroutine_threadsafe(self.handle_queued_update(update), self.loop)
+        return True
+
+    async def handle_queued_update(self, update) -> None:
+        try:
+            await self.handle_update(update.payload)
+        except Exception as e:
+            logger.exception(f"Handling update {update.id} failed: {e}")
+            await self.run_io(ingest_queue.retry, update)
+        else:
+            await self.run_io(ingest_queue.ack, update.id)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def dispatch_media_group(self, chat_id, fn, *args) -> bool:
+        """
+        Called by the media group aggregator with every complete group, which counts against max_in_flight like an update
+        """
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+
+        asyncio.run_coroutine_threadsafe(self.handle_media_group(fn, *args), self.loop)
+        return True
+
+    async def handle_media_group(self, fn, *args) -> None:
+        try:
+            await self.loop.run_in_executor(self.media_group_executor, fn, *args)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    async def handle_update(self, msg) -> None:
+        """
+        Routes the update the way BotFactory.get_bot does
+        """
+        if "reply_to_message" in msg:
+            await self.handle_quote(msg)
+        elif "photo" in msg:
+            if is_prediction(msg.get("caption", "")) and not msg.get("media_group_id", None):
+                await self.handle_prediction(msg)
+            else:
+                await self.handle_image(msg)
+        else:
+            await self.handle_text(msg)
+
+    def send_message(self, chat_id, text, **kwargs):
+        """
+        Texts are paced and coalesced by the send scheduler (see Bot.send_message) and sent in the background
+        """
+        return send_scheduler.send_text(chat_id, text, self._send_message, **kwargs)
+
+    def handle_exception(self, exception, chat_id) -> None:
+        logger.exception(f"Exception in chat {chat_id}: {exception}")
+        self.send_message(chat_id, f"An error has occurred:\n{exception}")
+
+    async def send_photo(self, chat_id, photo, caption=""):
+        """
+        Sends an encoded image, by reference to its file_id if it was already uploaded (see ImageProcessingBot.handle_photo)
+        """
+        digest = file_id_cache.digest(photo)
+        file_id = await self.run_io(file_id_cache.get, digest)
+        if file_id is not None:
+            try:
+                await asyncio.wrap_future(send_scheduler.send(chat_id, self._send_photo, chat_id, file_id, caption=caption or None))
+                return
+            except ApiTelegramException as e:
+                logger.warning(f"Telegram didn't accept the file_id of a sent image, uploading it again: {e}")
+                await self.run_io(file_id_cache.forget, digest)
+
+        message = await asyncio.wrap_future(send_scheduler.send(chat_id, self._send_photo, chat_id, photo, caption=caption or None))
+
+        if message is not None and message.photo:
+            await self.run_io(file_id_cache.put, digest, message.photo[-1].file_id)
+
+    async def handle_text(self, msg) -> None:
+        chat_id = msg['chat']['id']
+
+        if "text" in msg:
+            text = msg["text"].lower()
+            if any(substring in text for substring in ["start", "help", "hello"]):
+                self.send_message(chat_id, WELCOME_TEXT, parse_mode="Markdown")
+            else:
+                self.send_message(chat_id, f'Your original message: {msg["text"]}')
+        else:
+            self.handle_exception(Exception('None user message received'), chat_id)
+
+    async def handle_quote(self, msg) -> None:
+        chat_id = msg['chat']['id']
+
+        if "text" in msg:
+            if msg["text"] != 'Please don\'t quote me':
+                self.send_message(chat_id, msg["text"], reply_to_message_id=msg["message_id"])
+        else:
+            self.handle_exception(Exception('None user message received'), chat_id)
+
+    async def download(self, msg, photo_size):
+        """
+        Streams the photo into a spooled buffer, the asyncio counterpart of FileDownloader.download
+        :return: (file_path, photo) the photo's Telegram file_path and a binary file object the caller closes,
+                 or (None, None) if the download failed
+        """
+        buffer = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_BYTES)
+        try:
+            file_info = await self.tgbot.get_file(photo_size['file_id'])
+
+            size = 0
+            async with self.session.get(FileDownloader.file_url(self.token, file_info.file_path)) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > DOWNLOAD_MAX_BYTES:
+                        raise ValueError(f"The file is larger than {DOWNLOAD_MAX_BYTES // (1024 * 1024)}MB.")
+                    buffer.write(chunk)
+        except (OSError, ValueError, asyncio.TimeoutError, aiohttp.ClientError, ApiException) as e:
+            buffer.close()
+            self.handle_exception(f"Was unable to download image from Bot. {e}\nPlease try again.", msg["chat"]["id"])
+            return None, None
+
+        logger.info(f"Downloaded {file_info.file_path} ({size} bytes)")
+        buffer.seek(0)
+        return file_info.file_path, buffer
+
+    @staticmethod
+    def process(photo, command) -> bytes:
+        """
+        Decodes the photo, runs the command's pipeline on it and encodes the result, on the image thread pool
+        """
+        with photo:
+            if command.pipeline.allows_downscale and not command.full_quality:
+                img = Img(photo, max_size=(downscale_size, downscale_size))
+            else:
+                img = Img(photo)
+
+        command.pipeline.run(img)
+        encoded = img.encode()
+        logger.info(f"Encoded a {encoded.format} image of {len(encoded.data)} bytes in {encoded.seconds * 1000:.1f}ms")
+        return encoded.data
+
+    async def handle_image(self, msg) -> None:
+        chat_id = msg['chat']['id']
+        media_group_id = msg.get("media_group_id", None)
+
+        try:
+            command = ImageProcessingBot.parse_photo_command(msg)
+        except (ValueError, RuntimeError) as e:
+            self.handle_exception(e, chat_id)
+            return
+
+        photo_size = ImageProcessingBot.photo_size(msg, command)
+
+        # The same photo with the same actions is sent straight from the cache (a random one is processed every time)
+        result_key = None
+        if isinstance(command, PipelineCommand) and command.pipeline.cacheable:
+            result_key = ImageProcessingBot.result_key(command, photo_size)
+            result = await self.run_io(result_cache.get, result_key)
+            if result is not None:
+                await self.send_photo(chat_id, result)
+                return
+
+        file_path, photo = await self.download(msg, photo_size)
+        if photo is None:
+            return
+
+        if media_group_id:
+            # The photos of the group are concatenated once they've all arrived (see concat_media_group)
+            try:
+                with photo:
+                    await self.run_io(media_group_aggregator.add, chat_id, media_group_id, msg["message_id"], photo,
+                                      os.path.splitext(file_path)[1], msg.get("caption", ""))
+            except OSError as e:
+                self.handle_exception(f"{e}\nPlease try again.", chat_id)
+            return
+
+        try:
+            result = await self.loop.run_in_executor(self.img_executor, self.process, photo, command)
+            await self.send_photo(chat_id, result)
+            if result_key is not None:
+                await self.run_io(result_cache.put, result_key, result)
+        except Exception as e:
+            self.handle_exception(f"{e}\nPlease try again.", chat_id)
+
+    def concat_media_group(self, chat_id, paths, caption) -> None:
+        """
+        Called on one of the media group threads (see dispatch_media_group), the photos are removed once this returns
+        """
+        asyncio.run_coroutine_threadsafe(self._concat_media_group(chat_id, paths, caption), self.loop).result()
+
+    @staticmethod
+    def concat(paths, command) -> bytes:
+        img = Img.from_concat(paths, command.direction, command.sides)
+        return img.encode().data
+
+    async def _concat_media_group(self, chat_id, paths, caption) -> None:
+        try:
+            command = ImageProcessingBot.parse_group_command(caption)
+            result = await self.loop.run_in_executor(self.img_executor, self.concat, paths, command)
+            await self.send_photo(chat_id, result)
+        except Exception as e:
+            self.handle_exception(f"{e}\nPlease try again.", chat_id)
+
+    async def yolo5_request(self, method, path, **params):
+        """
+        The asyncio counterpart of Yolo5Client.request
+
+        :return: (status code, the answer's JSON or text)
+        """
+        async with self.session.request(method, f"{yolo5_url()}{path}", params=params,
+                                        timeout=aiohttp.ClientTimeout(total=request_timeout())) as response:
+            if response.status in BUSY_STATUSES:
+                raise Unavailable(f"HTTP error occurred: {response.status}\n{await response.text()}", retry_after(response.headers))
+            text = await response.text()
+            try:
+                return response.status, json.loads(text)
+            except ValueError:
+                return response.status, text
+
+    async def submit_prediction(self, image_name) -> str:
+        """
+        The asyncio counterpart of Yolo5Client.submit
+
+        :return: The id of the image's job
+        """
+        params = {"imgName": image_name, "timeout": round(current_deadline().remaining(), 1)}
+        status, body = await call_async(YOLO5_ENDPOINT, self.yolo5_request, "POST", "/jobs", **params)
+        if status not in (200, 202):
+            raise RuntimeError(f"HTTP error occurred: {status}\n{body}")
+        return body["job_id"]
+
+    async def predict(self, image_name) -> dict:
+        """
+        Runs the prediction as a yolo5 job the way Yolo5Client does, without holding a thread while polling for its result
+        """
+        with deadline(PREDICT_TIMEOUT) as scoped:
+            job_id = await self.submit_prediction(image_name)
+            logger.info(f"Prediction of {image_name} submitted as job {job_id}")
+
+            for delay in poll_delays():
+                if scoped.remaining() <= delay:
+                    raise DeadlineExceeded(f"The prediction of {image_name} took longer than {PREDICT_TIMEOUT} seconds")
+                await asyncio.sleep(delay)
+
+                status, body = await call_async(YOLO5_ENDPOINT, self.yolo5_request, "GET", f"/jobs/{job_id}/result")
+                if status == 200:
+                    logger.info(json.dumps(body))
+                    return body
+                if is_unknown_job(body):
+                    logger.warning(f"Job {job_id} of {image_name} was not found, submitting it again")
+                    job_id = await self.submit_prediction(image_name)
+                elif status != 202:
+                    raise job_error(image_name, status, body)
+
+    async def handle_prediction(self, msg) -> None:
+        chat_id = msg['chat']['id']
+
+        # The smallest size of the photo YOLOv5 doesn't have to upscale (see ImageProcessingBot.photo_size)
+        photo_size = ImageProcessingBot.photo_size(msg, parse_caption(msg.get("caption", "")))
+        file_path, photo = await self.download(msg, photo_size)
+        if photo is None:
+            return
+
+        # Let the user that something is happening
+        self.send_message(chat_id, "Processing, please wait...")
+
+        image_name = os.path.basename(file_path)
+        try:
+            with photo:
+                response = await upload_image_to_s3(self.s3, images_bucket, f"{images_prefix}/{image_name}", photo.read())
+            if response[1] != 200:
+                raise Exception(f"{response[0]}\nPlease try again.")
+
+            response_data = await self.predict(image_name)
+
+            response = await download_image_from_s3(self.s3, images_bucket, response_data["original_img_path"])
+            if response[1] != 200:
+                raise Exception(f"{response[0]}\nPlease try again.")
+
+            await self.send_photo(chat_id, response[2], parse_result(response_data))
+        except Exception as e:
+            self.handle_exception(e, chat_id)
+
+
+def create_app():
+    """
+    The aiohttp application serving the same routes as flask_app
+    """
+    token = get_docker_secret('telegram_bot_token')
+    if token is None:
+        raise ValueError("Token is not available")
+
+    bot = AsyncBot(token, os.environ['TELEGRAM_APP_URL'])
+
+    async def index(request):
+        return web.Response(text='Ok')
+
+    async def health(request):
+        return web.json_response({"status": "healthy", "message": "Service is up and running!"})
+
+    async def metrics(request):
+        return web.json_response({
+            "pid": os.getpid(),
+            "async_bot": bot.stats,
+            "ingest_queue": await bot.run_io(lambda: ingest_queue.stats),
+            "seen_updates": seen_updates.stats,
+            "send_scheduler": send_scheduler.stats,
+            "breakers": breaker_stats(),
+        })
+
+    async def webhook(request):
+        req = await request.json()
+        if "message" in req:
+            msg = req['message']
+        elif "edited_message" in req:
+            msg = req['edited_message']
+        else:
+            return web.Response(text='No message', status=400)
+
+        # A redelivered update is acknowledged and dropped (see SeenUpdates)
+        keys = seen_updates.keys(req)
+        if await bot.run_io(seen_updates.seen, keys):
+            return web.Response(text='Duplicate')
+
+        # Telegram is only answered once the update is safely on the disk (see IngestQueue)
+        try:
+            queued = await bot.run_io(ingest_queue.append, msg['chat']['id'], msg)
+        except sqlite3.Error as e:
+            logger.exception(f"Unable to queue an update: {e}")
+            return web.Response(text='Unable to queue the update', status=500)
+
+        if not queued:
+            logger.warning(f"The ingest queue is full, applying the '{OVERLOAD_POLICY}' policy.")
+            if OVERLOAD_POLICY == "reject":
+                return web.Response(text='Busy', status=429)
+
+            bot.send_message(msg['chat']['id'], "The bot is busy at the moment, please try again in a little while.")
+
+        # Only remembered once it's queued (see SeenUpdates)
+        if not await bot.run_io(seen_updates.add, keys):
+            logger.warning(f"Update {req.get('update_id')} was queued again by a redelivery accepted at the same time.")
+
+        return web.Response(text='Ok')
+
+    app = web.Application()
+    app[BOT_KEY] = bot
+    app.add_routes([
+        web.get('/', index),
+        web.get('/health', health),
+        web.get('/metrics', metrics),
+        web.post(f'/{token}/', webhook),
+    ])
+    app.on_startup.append(bot.start)
+    app.on_cleanup.append(bot.stop)
+    return app
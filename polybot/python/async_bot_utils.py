@@ -0,0 +1,50 @@
+import aioboto3
+from botocore import exceptions as boto_exceptions
+from loguru import logger
+from resilience import call_async
+from bot_utils import S3_ENDPOINT
+import os
+
+aws_profile = os.getenv("AWS_PROFILE", None)
+
+def s3_session():
+    # The same profile bot_utils uses
+    if aws_profile is not None and aws_profile == "dev":
+        return aioboto3.Session(profile_name=aws_profile)
+    return aioboto3.Session()
+
+async def get_image(s3, bucket_name, key):
+    # The body is read within the attempt so a connection dropped while reading it is retried as well
+    response = await s3.get_object(Bucket=bucket_name, Key=key)
+    async with response['Body'] as body:
+        return await body.read()
+
+async def upload_image_to_s3(s3, bucket_name, key, data):
+    """
+    The asyncio counterpart of bot_utils.upload_image_to_s3, uploading the image from memory
+    :param s3: An aioboto3 S3 client
+    :return: (message, status code)
+    """
+    try:
+        await call_async(S3_ENDPOINT, s3.put_object, Bucket=bucket_name, Key=key, Body=data)
+    except (boto_exceptions.BotoCoreError, boto_exceptions.ClientError) as e:
+        logger.exception(f"Upload to {bucket_name}/{key} failed. A {type(e).__name__} has occurred.\n{str(e)}")
+        return f"Upload to {bucket_name}/{key} failed. A {type(e).__name__} has occurred.\n{str(e)}", 500
+
+    logger.info(f"Upload to {bucket_name}/{key} succeeded.")
+    return f"Upload to {bucket_name}/{key} succeeded.", 200
+
+async def download_image_from_s3(s3, bucket_name, key):
+    """
+    The asyncio counterpart of bot_utils.download_image_from_s3, downloading the image into memory
+    :param s3: An aioboto3 S3 client
+    :return: (message, status code, the image's bytes or None)
+    """
+    try:
+        data = await call_async(S3_ENDPOINT, get_image, s3, bucket_name, key)
+    except (boto_exceptions.BotoCoreError, boto_exceptions.ClientError) as e:
+        logger.exception(f"Download from {bucket_name}/{key} failed. A {type(e).__name__} has occurred.\n{str(e)}")
+        return f"Download from {bucket_name}/{key} failed. A {type(e).__name__} has occurred.\n{str(e)}", 500, None
+
+    logger.info(f"Download from {bucket_name}/{key} succeeded.")
+    return f"Download from {bucket_name}/{key} succeeded.", 200, data
@@ -3,43 +3,106 @@ from loguru import logger
 import os
 import time
 import json
+import io
+import shutil
 from pathlib import Path
 from telebot.types import InputFile
-from img_proc import Img
-import requests
+from img_proc import Img, OUTPUT_QUALITY, parse_concat
+from captions import parse_caption, is_prediction, PipelineCommand, ConcatCommand, PredictCommand
+from result_cache import ResultCache
+from file_id_cache import FileIdCache
+from media_group_aggregator import MediaGroupAggregator
+from downloader import FileDownloader, choose_photo_size
+from send_scheduler import SendScheduler
+from yolo5_client import Yolo5Client
 from bot_utils import upload_image_to_s3, download_image_from_s3, parse_result
-import threading
 
 images_bucket = os.environ['BUCKET_NAME']
 images_prefix = os.environ['BUCKET_PREFIX']
+# Images whose filters don't depend on their exact size may be reduced to this size (in pixels) while they're decoded
+downscale_size = int(os.getenv("IMG_DOWNSCALE_SIZE", "1280"))
+# The size (in pixels) YOLOv5 resizes images to before inference, there's no point in sending it a larger photo
+predict_size = int(os.getenv("PREDICT_IMAGE_SIZE", "640"))
+# Results of the image pipelines, shared by all the bot instances of the process
+result_cache = ResultCache()
+# The file_ids of the images already uploaded to Telegram
+file_id_cache = FileIdCache()
+# Telegram files are downloaded over a keep-alive session shared by all the bots of the process
+file_downloader = FileDownloader()
+# Collects the photos of the media groups to concatenate, kept apart from the bots so they stay stateless
+media_group_aggregator = MediaGroupAggregator()
+# Paces everything the bots send to Telegram, shared by all the bots of the process
+send_scheduler = SendScheduler()
+# Runs the predictions as yolo5 jobs, shared by all the bots of the process
+yolo5_client = Yolo5Client()
+
+# The greeting and instructions sent for 'start', 'help' and 'hello'
+WELCOME_TEXT = '''
+Welcome to the Image Processing Bot!
+
+Upload an image and type in the caption the action you'd like to do.
+
+*NOTE:* You need to type in the words or numbers. For *Concat* you need to upload more than one image
+
+These are the available actions:
+1. *Blue* - blurs the image.
+    a. You may specify noise level by inputting a floating point number
+
+    *example usage: blur 10*
+2. *Contour* - applies a contour effect to the image
+
+    *example usage: contour*
+3. *Rotate* - rotates the image
+    a. You may also input either *clockwise* or *anti-clockwise* (default *clockwise*)
+    b. You may also input the degrees to rotate (default *90*)
+        i. *90*
+        ii. *180*
+        iii. *270*
+    c. You may enter either of the above or both
+
+    *example usage: anti-clockwise 180*
+4. *Salt and pepper* - randomly sprinkle white and black pixels on the image
+    a. You may specify noise level by inputting a floating point number representing the proportion of the image pixels to be affected by noise.
+
+    *example usage: salt and pepper 0.1*
+5. *Concat* - concatenates two or more images
+    a. You may also send the direction of either *horizontal* or *vertical* (default *horizontal*)
+    b. You may also specify the sides to be concatenated based on the direction (default *right-to-left*)
+        i. horizontal: *right-to-left*, *left-to-right*
+        ii. vertical: *top-to-bottom*, *bottom-to-top*
+
+    *example usage: concat vertical top-to-bottom*
+6. *Segment* - represented in a more simplified manner, and so we can then identify objects and boundaries more easily.
+
+    *example usage: segment*
+7. *Predict* - identifies items in the image
+
+    *example usage: predict*
+
+You may also chain several actions (except *Concat* and *Predict*) by separating them with a *|*, they are all applied to the image in one go.
+
+    *example usage: blur 5 | rotate 180 | segment*
+
+To speed things up the actions are applied to a smaller version of the image where they can be. Add *full quality* to the end of the caption to always use the original image.
+
+    *example usage: predict full quality*
+'''
 
 class ExceptionHandler(telebot.ExceptionHandler):
     """
-    An implementation of the telegram bot exception handler class
+    An implementation of the telegram bot exception handler class.
+    It keeps no state, the chat an exception is reported to is passed along with it
     """
-    _lock = threading.Lock()
-
     def __init__(self, bot):
         self.bot = bot
-        self._chat_id = None
-
-    @property
-    def chat_id(self):
-        with self._lock:
-            return self._chat_id
-
-    @chat_id.setter
-    def chat_id(self, value):
-        with self._lock:
-            self._chat_id = value
-
-    def handle(self, exception):
-        with self._lock:
-            if self._chat_id is not None:
-                logger.exception(f"Exception in chat {self.chat_id}: {exception}")
-                return self.bot.send_message(self.chat_id, f"An error has occurred:\n{exception}")
-            else:
-                logger.exception("Exception occurred without an active chat context.")
+
+    def handle(self, exception, chat_id=None):
+        if chat_id is not None:
+            logger.exception(f"Exception in chat {chat_id}: {exception}")
+            # Paced like every other message (and joined with the chat's other texts), a failure to send it is only logged
+            return send_scheduler.send_text(chat_id, f"An error has occurred:\n{exception}", self.bot.send_message)
+
+        logger.exception("Exception occurred without an active chat context.")
         return False
 
 class BotFactory:
@@ -47,9 +110,6 @@ class BotFactory:
     BotFactory class as its name implies, this class makes use of an OO pattern called Factory,
     to generate a bot depending on the incoming message and its parameters.
     """
-    _lock = threading.Lock()
-    _curr_bot = None
-
     def __init__(self, token, telegram_chat_url):
         self.tgbot = telebot.TeleBot(token)
 
@@ -65,15 +125,12 @@ class BotFactory:
 
         logger.info(f'Telegram Bot information\n\n{self.tgbot.get_me()}')
 
-    @property
-    def curr_bot(self):
-        with self._lock:
-            return self._curr_bot
-
-    @curr_bot.setter
-    def curr_bot(self, value):
-        with self._lock:
-            self._curr_bot = value
+        # A single, long lived instance of every bot. The updates of a chat are handled in order (see WorkerPool)
+        # and the bots only keep state per media group, so they're shared by all the chats without locking
+        self.bot = Bot(self.tgbot)
+        self.quote_bot = QuoteBot(self.tgbot)
+        self.image_processing_bot = ImageProcessingBot(self.tgbot)
+        self.object_detection_bot = ObjectDetectionBot(self.tgbot)
 
     def is_current_msg_photo(self, msg):
         """
@@ -91,7 +148,7 @@ class BotFactory:
         """
         Check if it's a prediction
         """
-        return msg.get("caption", "").strip().lower() == "predict"
+        return is_prediction(msg.get("caption", ""))
 
     def get_bot(self, msg = ""):
         """
@@ -99,21 +156,17 @@ class BotFactory:
         """
         logger.info('Getting a bot...')
         # Check for a reply
-        if self.is_a_reply(msg) and not isinstance(BotFactory.curr_bot, QuoteBot):
-            BotFactory.curr_bot = QuoteBot(self.tgbot)
+        if self.is_a_reply(msg):
+            return self.quote_bot
         # Check for an image
         elif self.is_current_msg_photo(msg):
-            if self.is_prediction(msg) and not isinstance(BotFactory.curr_bot, ObjectDetectionBot):
+            if self.is_prediction(msg):
                 # For ObjectDetectionBot with "predict" caption
-                BotFactory.curr_bot = ObjectDetectionBot(self.tgbot)
-            elif not isinstance(BotFactory.curr_bot, ImageProcessingBot):
-                # For general image processing
-                BotFactory.curr_bot = ImageProcessingBot(self.tgbot)
+                return self.object_detection_bot
+            # For general image processing
+            return self.image_processing_bot
         # Fallback basic Bot
-        else:
-            BotFactory.curr_bot = Bot(self.tgbot)
-
-        return BotFactory.curr_bot
+        return self.bot
 
 class Bot:
     """
@@ -128,62 +181,34 @@ class Bot:
         """
         return getattr(self._tgbot, name)
 
+    def send_message(self, chat_id, text, **kwargs):
+        """
+        Texts are paced by the send scheduler and sent in the background, joined with the chat's other texts sent
+        within the coalescing window
+        :return: A Future of the sent message
+        """
+        return send_scheduler.send_text(chat_id, text, self._tgbot.send_message, **kwargs)
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        """
+        Photos are paced by the send scheduler and go before any waiting text. Waits for Telegram's answer
+        :return: The sent message
+        """
+        return send_scheduler.send(chat_id, self._tgbot.send_photo, chat_id, photo, **kwargs).result()
+
     def handle_exception(self, exception, chat_id):
         """
         This is a wrapper function which makes use of the exception handling mechanism
         By using it this way it maintains context hence when the ExceptionHandler sends a message it's as if it was sent
         by the bot itself.
         """
-        self.exception_handler.chat_id = chat_id
-        self.exception_handler.handle(exception)
+        self.exception_handler.handle(exception, chat_id)
 
     def send_welcome(self, chat_id):
         """
         This method is used to both greet and give instructions to the user.
         """
-        text = '''
-Welcome to the Image Processing Bot!
-
-Upload an image and type in the caption the action you'd like to do.
-
-*NOTE:* You need to type in the words or numbers. For *Concat* you need to upload more than one image
-
-These are the available actions:
-1. *Blue* - blurs the image.
-    a. You may specify noise level by inputting a floating point number
-
-    *example usage: blur 10*
-2. *Contour* - applies a contour effect to the image
-
-    *example usage: contour*
-3. *Rotate* - rotates the image
-    a. You may also input either *clockwise* or *anti-clockwise* (default *clockwise*)
-    b. You may also input the degrees to rotate (default *90*)
-        i. *90*
-        ii. *180*
-        iii. *270*
-    c. You may enter either of the above or both
-
-    *example usage: anti-clockwise 180*
-4. *Salt and pepper* - randomly sprinkle white and black pixels on the image
-    a. You may specify noise level by inputting a floating point number representing the proportion of the image pixels to be affected by noise.
-
-    *example usage: salt and pepper 0.1*
-5. *Concat* - concatenates two or more images
-    a. You may also send the direction of either *horizontal* or *vertical* (default *horizontal*)
-    b. You may also specify the sides to be concatenated based on the direction (default *right-to-left*)
-        i. horizontal: *right-to-left*, *left-to-right*
-        ii. vertical: *top-to-bottom*, *bottom-to-top*
-
-    *example usage: concat vertical top-to-bottom*
-6. *Segment* - represented in a more simplified manner, and so we can then identify objects and boundaries more easily.
-
-    *example usage: segment*
-7. *Predict* - identifies items in the image
-
-    *example usage: predict*
-'''
-        self.send_message(chat_id, text, parse_mode="Markdown")
+        self.send_message(chat_id, WELCOME_TEXT, parse_mode="Markdown")
 
     def send_text(self, chat_id, text):
         """
@@ -235,57 +260,170 @@ class ImageProcessingBot(Bot):
     This bot is an extension of the original bot and is dedicated for image processing operations
     """
 
-    def __init__(self, tgbot):
-        super().__init__(tgbot)
-        self.media_groups = {}
-        self.direction = None
-        self.sides = None
+    @staticmethod
+    def parse_photo_command(msg):
+        """
+        Parses the caption of a photo (see parse_caption) and checks the command fits the message.
+        Raises a ValueError for an invalid caption and a RuntimeError for a command which doesn't fit
+
+        :return: The command, None for a photo of a media group, whose caption is parsed once the whole group arrived
+                 (see parse_group_command)
+        """
+        if msg.get("media_group_id", None):
+            return None
+
+        command = parse_caption(msg.get("caption", ""))
+
+        if command is None:
+            raise RuntimeError("Please specify an action you'd like to execute on the image and try again.\nIf you're unsure, please refer to 'help' for assistance and try again.")
+
+        if isinstance(command, ConcatCommand):
+            raise RuntimeError("You need to upload more than one image in order to concat. Please try again.")
+
+        return command
+
+    @staticmethod
+    def parse_group_command(caption):
+        """
+        Parses the caption of a complete media group, Telegram only sends it with the first photo of the group.
+        Raises a ValueError for an invalid caption and a RuntimeError for a command other than concat
 
-    def download_user_photo(self, msg):
+        :return: The ConcatCommand, the defaults for a group without a caption
+        """
+        command = parse_caption(caption)
+        if command is None:
+            return ConcatCommand(*parse_concat())
+
+        if not isinstance(command, ConcatCommand):
+            raise RuntimeError("Only Concat may be applied to more than one image.")
+
+        return command
+
+    @staticmethod
+    def photo_size(msg, command):
+        """
+        Chooses the smallest size of the photo which is enough for the command (see choose_photo_size), unless the caption
+        asks for full quality. Concat and blur (whose result depends on the size of the photo) always get the largest one
+        """
+        if isinstance(command, PredictCommand) and not command.full_quality:
+            target = predict_size
+        elif isinstance(command, PipelineCommand) and not command.full_quality and command.pipeline.allows_downscale:
+            target = downscale_size
+        else:
+            target = None
+
+        return choose_photo_size(msg['photo'], target)
+
+    def fetch_user_photo(self, msg, photo_size=None):
+        """
+        Streams the photo sent to the Bot into memory (see FileDownloader), without writing it to the disk
+        :param photo_size: Which of msg['photo'] to download, the largest one by default
+        :return: (file_path, photo) the photo's Telegram file_path and a binary file object holding it, which the caller
+                 closes, or (None, None) if the download failed
+        """
+        photo_size = photo_size or choose_photo_size(msg['photo'])
+        logger.info(f"Downloading the {photo_size['width']}x{photo_size['height']} size of the photo")
+
+        try:
+            file_info = self.get_file(photo_size['file_id'])
+            return file_info.file_path, file_downloader.download(self.token, file_info.file_path)
+        except (OSError, ValueError, telebot.apihelper.ApiException) as e:
+            logger.exception(e)
+            self.handle_exception(f"Was unable to download image from Bot. {e}\nPlease try again.", msg["chat"]["id"])
+            return None, None
+
+    def download_user_photo(self, msg, photo_size=None):
         """
         Downloads the photos that sent to the Bot to `photos` directory (should be existed)
+        :param photo_size: Which of msg['photo'] to download, the largest one by default
         :return file_info.file_path:
         """
-        file_info = self.get_file(msg['photo'][-1]['file_id'])
-        data = self.download_file(file_info.file_path)
-        folder_name = file_info.file_path.split('/')[0]
+        file_path, photo = self.fetch_user_photo(msg, photo_size)
+        if photo is None:
+            return None
+
+        folder_name = file_path.split('/')[0]
 
         if not os.path.exists(folder_name):
             os.makedirs(folder_name)
 
         try:
-            with open(file_info.file_path, 'wb') as photo:
-                photo.write(data)
+            with photo, open(file_path, 'wb') as file:
+                shutil.copyfileobj(photo, file)
         except OSError as e:
             logger.exception(e)
             self.handle_exception(f"{e}\nPlease try again.", msg["chat"]["id"])
             return None
 
-        return file_info.file_path
+        return file_path
 
-    def handle_photo(self, chat_id, img_path, caption=""):
+    def handle_photo(self, chat_id, photo, caption=""):
         """
         This method is used to send images to the user
+        :param photo: Either the path of the image or its encoded bytes, which are streamed straight to Telegram
         """
-        try:
-            if not img_path.exists() and img_path.is_file():
-                raise FileNotFoundError("Image doesn't exist or it's not a file. Please try again")
-        except FileNotFoundError as e:
-            logger.exception(e)
-            self.handle_exception(e, chat_id)
-            return
+        if isinstance(photo, Path):
+            try:
+                if not (photo.exists() and photo.is_file()):
+                    raise FileNotFoundError("Image doesn't exist or it's not a file. Please try again")
+            except FileNotFoundError as e:
+                logger.exception(e)
+                self.handle_exception(e, chat_id)
+                return
 
-        if not caption:
-            self.send_photo(
-                chat_id,
-                InputFile(img_path)
-            )
-        else:
-            self.send_photo(
-                chat_id,
-                InputFile(img_path),
-                caption=caption
-            )
+            photo = photo.read_bytes()
+
+        # An image which was already uploaded is sent by reference to its file_id, without uploading it again
+        digest = file_id_cache.digest(photo)
+        file_id = file_id_cache.get(digest)
+        if file_id is not None:
+            try:
+                self.send_photo(chat_id, file_id, caption=caption or None)
+                return
+            except telebot.apihelper.ApiTelegramException as e:
+                logger.warning(f"Telegram didn't accept the file_id of a sent image, uploading it again: {e}")
+                file_id_cache.forget(digest)
+
+        message = self.send_photo(
+            chat_id,
+            InputFile(io.BytesIO(photo)),
+            caption=caption or None
+        )
+
+        # Telegram returns the photo in several sizes, the last one being the uploaded one
+        if message is not None and message.photo:
+            file_id_cache.put(digest, message.photo[-1].file_id)
+
+    def send_img(self, chat_id, img):
+        """
+        Encodes the processed image in memory (see Img.encode) and sends it to the user, logging its size and how long encoding took
+        """
+        encoded = img.encode()
+        logger.info(f"Encoded a {encoded.format} image of {len(encoded.data)} bytes in {encoded.seconds * 1000:.1f}ms")
+        self.handle_photo(chat_id, encoded.data)
+        return encoded.data
+
+    @staticmethod
+    def result_key(command, photo_size):
+        """
+        The result cache key of running the command's pipeline on the given size of the photo. Telegram's file_unique_id
+        is the same for the same photo, whoever sent it and however many times
+        """
+        return (
+            photo_size['file_unique_id'],
+            command.pipeline.key,
+            downscale_size if command.pipeline.allows_downscale and not command.full_quality else None,
+            OUTPUT_QUALITY
+        )
+
+    def remove_file(self, path):
+        """
+        Removes a file which is no longer needed (such as a downloaded photo), so they don't pile up on the disk
+        """
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"Unable to remove {path}: {e}")
 
     def handle_message(self, msg):
         """Image Bot message handler"""
@@ -293,19 +431,13 @@ class ImageProcessingBot(Bot):
         chat_id = msg['chat']['id']
 
         # Check whether a caption was sent and if so assign to variable
-        caption = msg.get("caption", "").strip().lower()
+        caption = msg.get("caption", "")
         # Check wether the incoming image is part of a media group i.e. more than one image was sent
         media_group_id = msg.get("media_group_id", None)
         try:
-            if not caption and not media_group_id:
-                raise RuntimeError("Please specify an action you'd like to execute on the image and try again.\nIf you're unsure, please refer to 'help' for assistance and try again.")
-
-            if caption:
-                if not any(substring in caption for substring in ["blur", "contour", "rotate", "salt and pepper", "concat", "segment"]):
-                    raise ValueError("Invalid image action specified. Please refer to the 'help' for assistance and try again.")
-
-                if "concat" in caption and not media_group_id:
-                    raise RuntimeError("You need to upload more than one image in order to concat. Please try again.")
+            # Parse (and validate) the caption before spending time on downloading the image
+            command = self.parse_photo_command(msg)
+            pipeline = command.pipeline if isinstance(command, PipelineCommand) else None
         except ValueError as e:
             logger.exception(e)
             self.handle_exception(e, chat_id)
@@ -315,126 +447,79 @@ class ImageProcessingBot(Bot):
             self.handle_exception(e, chat_id)
             return
 
-        image_path = self.download_user_photo(msg)
-
-        try:
-            if not image_path:
-                raise Exception("Was unable to download image from Bot. Please try again.")
-        except Exception as e:
-            logger.exception(e)
-            self.handle_exception(e, chat_id)
-            return
-
-        try:
-            img = Img(image_path)
-        except Exception as e:
-            logger.exception(e)
-            self.handle_exception(f"{e}\nPlease try again.", chat_id)
-            return
-
-        if (caption and "concat" in caption) or media_group_id:
-            if caption:
-                instruction = caption.replace("concat", "").strip()
+        photo_size = self.photo_size(msg, command)
 
-                if instruction:
-                    for substring in ["horizontal", "vertical"]:
-                        if substring in instruction:
-                            self.direction = substring
-                            break
-                    if self.direction:
-                        instruction = instruction.replace(self.direction, "").strip()
+        # The same photo with the same actions is sent straight from the cache, without downloading or processing it again
+        result_key = self.result_key(command, photo_size) if pipeline is not None and pipeline.cacheable else None
+        if result_key is not None:
+            result = result_cache.get(result_key)
+            logger.info(f"Result cache {'hit' if result is not None else 'miss'} {result_cache.stats}")
 
-                    if instruction:
-                        self.sides = instruction
-
-            # Initialize the group in the dictionary if it doesn't exist
-            if media_group_id not in self.media_groups:
-                self.media_groups[media_group_id] = []
+            if result is not None:
+                self.handle_photo(chat_id, result)
+                return
 
-            self.media_groups[media_group_id].append(img)
+        file_path, photo = self.fetch_user_photo(msg, photo_size)
+        if photo is None:
+            return
 
-            if len(self.media_groups[media_group_id]) > 1:
+        with photo:
+            if media_group_id:
+                # The photos of the group are concatenated once they've all arrived (see concat_media_group)
                 try:
-                    if self.direction and self.sides:
-                        self.media_groups[media_group_id][0].concat(self.media_groups[media_group_id][1], self.direction, self.sides)
-                    elif self.direction:
-                        self.media_groups[media_group_id][0].concat(self.media_groups[media_group_id][1], direction=self.direction)
-                    elif self.sides:
-                        self.media_groups[media_group_id][0].concat(self.media_groups[media_group_id][1], sides=self.sides)
-                    else:
-                        self.media_groups[media_group_id][0].concat(self.media_groups[media_group_id][1])
-
-                    image_path = self.media_groups[media_group_id][0].save_img()
-                    # Send the response with the modified image back to the bot
-                    self.handle_photo(chat_id, image_path)
-                except ValueError as e:
-                    logger.exception(f"{e}\nPlease try again.")
-                    self.handle_exception(f"{e}\nPlease try again.", chat_id)
-                    return
-                except RuntimeError as e:
-                    logger.exception(f"{e}\nPlease try again.")
-                    self.handle_exception(f"{e}\nPlease try again.", chat_id)
-                    return
-                except Exception as e:
-                    logger.exception(f"{e}\nPlease try again.")
+                    media_group_aggregator.add(chat_id, media_group_id, msg["message_id"], photo, os.path.splitext(file_path)[1], caption)
+                except OSError as e:
+                    logger.exception(e)
                     self.handle_exception(f"{e}\nPlease try again.", chat_id)
-                    return
-                finally:
-                    # Clean the handled group from the media groups dictionary and reset the direction and sides
-                    del self.media_groups[media_group_id]
-                    self.direction = None
-                    self.sides = None
-        else:
+                return
+
+            # The photo is decoded straight from memory
             try:
-                if "blur" in caption:
-                    blur_level = caption.replace("blur", "").strip()
-                    if blur_level:
-                        img.blur(blur_level)
-                    else:
-                        img.blur()
-                elif "contour" in caption:
-                    img.contour()
-                elif "rotate" in caption:
-                    direction = None
-                    degree = None
-                    instruction = caption.replace("rotate", "").strip()
-                    if instruction:
-                        for substring in ["anti-clockwise", "clockwise"]:
-                            if substring in instruction:
-                                direction = substring
-                                break
-                        if direction:
-                            instruction = instruction.replace(direction, "").strip()
-
-                        if instruction:
-                            degree = instruction
-
-                    if direction and degree:
-                        img.rotate(direction, degree)
-                    elif direction:
-                        img.rotate(direction=direction)
-                    elif degree:
-                        img.rotate(deg=degree)
-                    else:
-                        img.rotate()
-                elif "salt and pepper" in caption:
-                    noise_level = caption.replace("salt and pepper", "").strip()
-                    if noise_level:
-                        img.salt_n_pepper(noise_level)
-                    else:
-                        img.salt_n_pepper()
-                elif "segment" in caption:
-                    img.segment()
-
-                image_path = img.save_img()
-                # Send the response with the modified image back to the bot
-                self.handle_photo(chat_id, image_path)
-            except ValueError as e:
-                logger.exception(f"{e}\nPlease try again.")
-                self.handle_exception(f"{e}\nPlease try again.", chat_id)
+                if pipeline.allows_downscale and not command.full_quality:
+                    img = Img(photo, max_size=(downscale_size, downscale_size))
+                else:
+                    img = Img(photo)
             except Exception as e:
-                logger.exception(f"{e}\nPlease try again.")
+                logger.exception(e)
                 self.handle_exception(f"{e}\nPlease try again.", chat_id)
+                return
+
+        try:
+            # All the operations run on the image in one go and it's only materialized once, when it's saved
+            pipeline.run(img)
+
+            # Send the response with the modified image back to the bot, straight from memory
+            result = self.send_img(chat_id, img)
+            if result_key is not None:
+                result_cache.put(result_key, result)
+        except ValueError as e:
+            logger.exception(f"{e}\nPlease try again.")
+            self.handle_exception(f"{e}\nPlease try again.", chat_id)
+        except Exception as e:
+            logger.exception(f"{e}\nPlease try again.")
+            self.handle_exception(f"{e}\nPlease try again.", chat_id)
+
+    def concat_media_group(self, chat_id, paths, caption):
+        """
+        Concatenates all the photos of a media group in a single pass (see Img.from_concat) and sends the result to the user
+        :param paths: The paths of the photos, in the order they were sent
+        :param caption: The caption of the group e.g. 'concat vertical bottom-to-top'
+        """
+        try:
+            command = self.parse_group_command(caption)
+            img = Img.from_concat(paths, command.direction, command.sides)
+
+            # Send the response with the modified image back to the bot, straight from memory
+            self.send_img(chat_id, img)
+        except ValueError as e:
+            logger.exception(f"{e}\nPlease try again.")
+            self.handle_exception(f"{e}\nPlease try again.", chat_id)
+        except RuntimeError as e:
+            logger.exception(f"{e}\nPlease try again.")
+            self.handle_exception(f"{e}\nPlease try again.", chat_id)
+        except Exception as e:
+            logger.exception(f"{e}\nPlease try again.")
+            self.handle_exception(f"{e}\nPlease try again.", chat_id)
 
 class ObjectDetectionBot(ImageProcessingBot):
     """
@@ -445,13 +530,12 @@ class ObjectDetectionBot(ImageProcessingBot):
         logger.info(f"Prediction Bot - incoming message {msg}")
         chat_id = msg['chat']['id']
 
-        # Check whether a caption was sent and if so assign to variable
-        caption = msg.get("caption", "").strip().lower()
-
-        if "predict" not in caption:
+        # Every photo of a media group goes to the aggregator, a prediction caption is rejected once the group is complete
+        if msg.get("media_group_id", None) or not is_prediction(msg.get("caption", "")):
             super().handle_message(msg)
-        elif "predict" in caption:
-            image_path = self.download_user_photo(msg)
+        else:
+            # The smallest size of the photo YOLOv5 doesn't have to upscale is downloaded, uploaded to S3 and predicted on
+            image_path = self.download_user_photo(msg, self.photo_size(msg, parse_caption(msg.get("caption", ""))))
 
             try:
                 if not image_path:
@@ -474,57 +558,37 @@ class ObjectDetectionBot(ImageProcessingBot):
             except Exception as e:
                 self.handle_exception(e, chat_id)
                 return
+            finally:
+                # Once uploaded the downloaded photo is no longer needed
+                self.remove_file(image_path)
 
-            # Implemented a retry mechanism when calling the Yolo service together with catching all raised exceptions and handling them gracefully.
-            response = None
-            retry = 0
-            max_retries = 3
-            curr_exception = None
-            while retry < max_retries:
-                try:
-                    response = requests.post(f"http://{os.environ['YOLO5_NAME']}:{os.environ['YOLO5_PORT']}/predict?imgName={image_name}", timeout=90)
-                    response.raise_for_status()  # This will raise HTTPError for 4XX or 5XX status codes
-                    logger.info(json.dumps(response.json()))
-                    break
-                except requests.ConnectionError as e:
-                    curr_exception = e
-                    logger.exception(e)
-                except requests.Timeout as e:
-                    curr_exception = e
-                    logger.exception(e)
-                except requests.HTTPError as e:
-                    curr_exception = f"HTTP error occurred: {e.response.status_code}\n{e}"
-                    logger.exception(curr_exception)
-                except Exception as e:
-                    curr_exception = e
-                    logger.exception(e)
-
-                retry += 1
-                if retry < max_retries:
-                    time.sleep(3)
-
-            if retry == max_retries:
-                self.handle_exception(curr_exception, chat_id)
+            # yolo5 is given the image once and its result is polled for until it's ready
+            try:
+                response_data = yolo5_client.predict(image_name)
+                logger.info(json.dumps(response_data))
+            except Exception as e:
+                logger.exception(e)
+                self.handle_exception(e, chat_id)
                 return
 
             # Upon success downloaded the resulting image and send it to the user together with a summary of the results.
-            if response.status_code == 200:
-                response_data = response.json()
-                try:
-                    res = download_image_from_s3(images_bucket, response_data["original_img_path"], response_data["original_img_path"], images_prefix)
-
-                    if res[1] != 200:
-                        raise Exception(f"{res[0]}\nPlease try again.")
+            try:
+                res = download_image_from_s3(images_bucket, response_data["original_img_path"], response_data["original_img_path"], images_prefix)
 
-                    parsed_results = ""
-                    try:
-                        parsed_results = parse_result(response_data)
-                    except Exception as e:
-                        raise e
+                if res[1] != 200:
+                    raise Exception(f"{res[0]}\nPlease try again.")
 
-                    image_path = Path(response_data["original_img_path"])
-                    # Send the response with the modified image back to the bot
-                    self.handle_photo(chat_id, image_path, parsed_results)
+                parsed_results = ""
+                try:
+                    parsed_results = parse_result(response_data)
                 except Exception as e:
-                    logger.exception(e)
-                    self.handle_exception(e, chat_id)
\ No newline at end of file
+                    raise e
+
+                image_path = Path(response_data["original_img_path"])
+                photo = image_path.read_bytes()
+                self.remove_file(image_path)
+                # Send the response with the modified image back to the bot
+                self.handle_photo(chat_id, photo, parsed_results)
+            except Exception as e:
+                logger.exception(e)
+                self.handle_exception(e, chat_id)
\ No newline at end of file
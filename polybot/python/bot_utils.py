@@ -1,18 +1,29 @@
 import boto3
 from botocore import exceptions as boto_exceptions
+from botocore.config import Config
 from loguru import logger
 from collections import Counter
+from resilience import call
 import os
 
 aws_profile = os.getenv("AWS_PROFILE", None)
 if aws_profile is not None and aws_profile == "dev":
     boto3.setup_default_session(profile_name=aws_profile)
 
+# The name of S3's circuit breaker
+S3_ENDPOINT = "s3"
+# S3 calls are retried by resilience.call (with the breaker and the deadline in mind), not by botocore as well
+S3_CONFIG = Config(retries={"total_max_attempts": 1})
+
+def put_image(s3, bucket_name, key, image_path):
+    # Opened by every attempt so a retry uploads the whole image again
+    with open(image_path, 'rb') as img:
+        s3.put_object(Bucket=bucket_name, Key=key, Body=img)
+
 def upload_image_to_s3(bucket_name, key, image_path):
     try:
-        s3 = boto3.client('s3')
-        with open(image_path, 'rb') as img:
-            s3.put_object(Bucket=bucket_name, Key=key, Body=img)
+        s3 = boto3.client('s3', config=S3_CONFIG)
+        call(S3_ENDPOINT, put_image, s3, bucket_name, key, image_path)
     except FileNotFoundError as e:
         logger.exception(f"Upload to {bucket_name}/{key} failed. A FileNotFoundError has occurred.\n{str(e)}")
         return f"Upload to {bucket_name}/{key} failed. A FileNotFoundError has occurred.\n{str(e)}", 500
@@ -52,8 +63,8 @@ def download_image_from_s3(bucket_name, key, image_path, images_prefix):
         os.makedirs(images_prefix)
 
     try:
-        s3 = boto3.client('s3')
-        response = s3.get_object(Bucket=bucket_name, Key=key)
+        s3 = boto3.client('s3', config=S3_CONFIG)
+        response = call(S3_ENDPOINT, s3.get_object, Bucket=bucket_name, Key=key)
     except boto_exceptions.ProfileNotFound as e:
         logger.exception(f"Download from {bucket_name}/{key} failed. A ProfileNotFound has occurred.\n{str(e)}")
         return f"Download from {bucket_name}/{key} failed. A ProfileNotFound has occurred.\n{str(e)}", 500
@@ -0,0 +1,117 @@
+from collections import namedtuple
+from img_proc import Pipeline, parse_concat
+import re
+
+# The commands a caption may hold. full_quality asks for the photo to be processed in the largest size Telegram has it in
+PipelineCommand = namedtuple("PipelineCommand", ["pipeline", "full_quality"], defaults=[False])
+ConcatCommand = namedtuple("ConcatCommand", ["direction", "sides"])
+PredictCommand = namedtuple("PredictCommand", ["full_quality"], defaults=[False])
+
+# The actions which may be chained into a pipeline: (compiled pattern, builder adding the action to a Pipeline).
+# The named groups of the pattern which matched are passed to the builder (without the ones which weren't given)
+OPERATIONS = []
+
+PREDICT_PATTERN = re.compile(r"predict")
+CONCAT_PATTERN = re.compile(r"concat(?:\s+(?P<direction>horizontal|vertical))?(?:\s+(?P<sides>\S+))?")
+WHITESPACE = re.compile(r"\s+")
+# May be added to the end of a caption e.g. 'predict full quality' or 'contour | segment | full quality'
+FULL_QUALITY_FLAG = re.compile(r"(?:^|\s*\|?\s*)\bfull quality$")
+
+INVALID_ACTION = "Invalid image action{} specified. Please refer to the 'help' for assistance and try again."
+
+
+def operation(pattern):
+    """
+    Registers a pipeline action, new actions only need a pattern and a builder e.g.
+
+        @operation(r"flip(?: (?P<direction>horizontal|vertical))?")
+        def flip(pipeline, **params):
+            pipeline.flip(**params)
+    """
+    def register(builder):
+        OPERATIONS.append((re.compile(pattern), builder))
+        return builder
+    return register
+
+
+@operation(r"blur(?:\s+(?P<blur_level>\S+))?")
+def blur(pipeline, **params):
+    pipeline.blur(**params)
+
+
+@operation(r"contour")
+def contour(pipeline):
+    pipeline.contour()
+
+
+# The direction and the degrees may be given in either order e.g. 'rotate anti-clockwise 180' or 'rotate 180 anti-clockwise'
+@operation(r"rotate(?:\s+(?P<direction>anti-clockwise|clockwise))?(?:\s+(?P<deg>\S+))?")
+@operation(r"rotate\s+(?P<deg>\S+)\s+(?P<direction>anti-clockwise|clockwise)")
+def rotate(pipeline, **params):
+    pipeline.rotate(**params)
+
+
+@operation(r"salt and pepper(?:\s+(?P<noise_level>\S+))?")
+def salt_n_pepper(pipeline, **params):
+    pipeline.salt_n_pepper(**params)
+
+
+@operation(r"segment")
+def segment(pipeline):
+    pipeline.segment()
+
+
+def normalize(caption) -> str:
+    return WHITESPACE.sub(" ", caption or "").strip().lower()
+
+
+def split_flags(caption):
+    """
+    :return: (caption, full_quality) the normalized caption without the full quality flag and whether it had it
+    """
+    caption = normalize(caption)
+    flag = FULL_QUALITY_FLAG.search(caption)
+    if flag is None:
+        return caption, False
+    return caption[:flag.start()], True
+
+
+def is_prediction(caption) -> bool:
+    return PREDICT_PATTERN.fullmatch(split_flags(caption)[0]) is not None
+
+
+def parse_action(pipeline, action) -> None:
+    for pattern, builder in OPERATIONS:
+        match = pattern.fullmatch(action)
+        if match is not None:
+            builder(pipeline, **{name: value for name, value in match.groupdict().items() if value is not None})
+            return
+
+    raise ValueError(INVALID_ACTION.format(f" '{action}'" if action else ""))
+
+
+def parse_caption(caption):
+    """
+    Parses a caption into a command, validating all its parameters, so a caption which isn't valid is rejected
+    before the photo is downloaded. Several actions may be chained into a pipeline by separating them with a '|'
+    e.g. 'blur 5 | rotate 180 | segment', and a pipeline or a prediction may end with the 'full quality' flag.
+    Raises a ValueError for an invalid action or parameter.
+
+    :return: A PipelineCommand, ConcatCommand or PredictCommand, None for an empty caption
+    """
+    caption, full_quality = split_flags(caption)
+    if not caption:
+        return None
+
+    if PREDICT_PATTERN.fullmatch(caption):
+        return PredictCommand(full_quality)
+
+    match = CONCAT_PATTERN.fullmatch(caption)
+    if match is not None:
+        return ConcatCommand(*parse_concat(match["direction"] or "horizontal", match["sides"] or "right-to-left"))
+
+    pipeline = Pipeline()
+    for action in caption.split("|"):
+        parse_action(pipeline, action.strip())
+
+    return PipelineCommand(pipeline, full_quality)
@@ -0,0 +1,118 @@
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+from loguru import logger
+import threading
+import tempfile
+import requests
+import time
+import os
+
+# The largest file that is downloaded (the Telegram Bot API doesn't serve files over 20MB anyway)
+DOWNLOAD_MAX_BYTES = int(os.getenv("DOWNLOAD_MAX_MB", "20")) * 1024 * 1024
+# Downloads are kept in memory up to this size and spill over to a temporary file beyond it
+DOWNLOAD_SPOOL_BYTES = int(os.getenv("DOWNLOAD_SPOOL_MB", "8")) * 1024 * 1024
+# Seconds to wait for the connection to be established and then for every chunk of the body
+DOWNLOAD_CONNECT_TIMEOUT = float(os.getenv("DOWNLOAD_CONNECT_TIMEOUT", "5"))
+DOWNLOAD_READ_TIMEOUT = float(os.getenv("DOWNLOAD_READ_TIMEOUT", "30"))
+# Number of keep-alive connections to api.telegram.org kept open by each process
+DOWNLOAD_POOL_SIZE = int(os.getenv("DOWNLOAD_POOL_SIZE", "8"))
+
+CHUNK_SIZE = 64 * 1024
+
+
+def choose_photo_size(photo_sizes, target=None):
+    """
+    Chooses which of the sizes Telegram keeps a photo in to download. Telegram sends them smallest first,
+    e.g. 90, 320, 800 and 1280 pixels on their longer side, and the smaller ones are much faster to download and process.
+
+    :param photo_sizes: The PhotoSizes of the photo (msg['photo'])
+    :param target: The number of pixels on the longer side the operation needs, None for the full quality photo
+    :return: The smallest size which is at least the target, the largest size if none is or there's no target
+    """
+    largest = max(photo_sizes, key=lambda size: size['width'] * size['height'])
+    if target is None:
+        return largest
+
+    adequate = [size for size in photo_sizes if max(size['width'], size['height']) >= target]
+    return min(adequate, key=lambda size: size['width'] * size['height']) if adequate else largest
+
+
+class FileDownloader:
+    """
+    Downloads Telegram files over a single keep-alive session shared by all the threads of the process,
+    streaming the body into a spooled buffer (in memory up to DOWNLOAD_SPOOL_BYTES) instead of reading it whole.
+    The number of downloads, their bytes and the time they took are recorded in stats.
+    """
+
+    def __init__(self, max_bytes=DOWNLOAD_MAX_BYTES, spool_bytes=DOWNLOAD_SPOOL_BYTES, timeout=(DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT), pool_size=DOWNLOAD_POOL_SIZE):
+        self.max_bytes = max_bytes
+        self.spool_bytes = spool_bytes
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._lock = threading.Lock()
+        self.downloads = 0
+        self.failures = 0
+        self.total_bytes = 0
+        self.total_seconds = 0.0
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "downloads": self.downloads,
+                "failures": self.failures,
+                "bytes": self.total_bytes,
+                "seconds": self.total_seconds,
+                "average_seconds": self.total_seconds / self.downloads if self.downloads else 0.0,
+            }
+
+    @staticmethod
+    def file_url(token, file_path) -> str:
+        # The same URL telebot's own download_file uses
+        return (apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(token, file_path)
+
+    def download(self, token, file_path):
+        """
+        Streams a file from Telegram into a spooled buffer.
+        Raises a ValueError if the file is larger than max_bytes and requests' exceptions if the download fails.
+
+        :param token: The bot token
+        :param file_path: The file_path of the file, as returned by get_file
+        :return: A binary SpooledTemporaryFile positioned at the start of the file, the caller closes it
+        """
+        start = time.perf_counter()
+        buffer = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        size = 0
+
+        try:
+            with self.session.get(self.file_url(token, file_path), stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+
+                if int(response.headers.get("Content-Length", 0)) > self.max_bytes:
+                    raise ValueError(f"The file is larger than {self.max_bytes // (1024 * 1024)}MB.")
+
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ValueError(f"The file is larger than {self.max_bytes // (1024 * 1024)}MB.")
+                    buffer.write(chunk)
+        except Exception:
+            buffer.close()
+            with self._lock:
+                self.failures += 1
+            raise
+
+        seconds = time.perf_counter() - start
+        with self._lock:
+            self.downloads += 1
+            self.total_bytes += size
+            self.total_seconds += seconds
+
+        logger.info(f"Downloaded {file_path} ({size} bytes) in {seconds * 1000:.1f}ms")
+        buffer.seek(0)
+        return buffer
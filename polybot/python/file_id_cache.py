@@ -0,0 +1,99 @@
+from loguru import logger
+import threading
+import tempfile
+import hashlib
+import sqlite3
+import time
+import os
+
+# The SQLite database the file_ids are kept in, it may be shared by all the processes of the app
+FILE_ID_CACHE_PATH = os.getenv("FILE_ID_CACHE_PATH", os.path.join(tempfile.gettempdir(), "polybot_file_ids.sqlite3"))
+# The maximum number of file_ids kept, the oldest ones are dropped first
+FILE_ID_CACHE_SIZE = int(os.getenv("FILE_ID_CACHE_SIZE", "10000"))
+# How long a file_id is used for before the image is uploaded again
+FILE_ID_CACHE_TTL = int(os.getenv("FILE_ID_CACHE_TTL_DAYS", "30")) * 24 * 60 * 60
+
+
+class FileIdCache:
+    """
+    Remembers the Telegram file_id of every image uploaded by the bot, keyed by the SHA-256 of its content,
+    so an identical image can be sent again by reference instead of being uploaded again.
+    The map is persisted in SQLite, bounded to max_size entries and every entry expires ttl seconds after it was stored.
+    The connection is opened by the first call of every process, as it doesn't survive forking.
+    """
+
+    def __init__(self, path=FILE_ID_CACHE_PATH, max_size=FILE_ID_CACHE_SIZE, ttl=FILE_ID_CACHE_TTL):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._connection = None
+
+    def _connect(self):
+        """
+        Opens the connection if it isn't open in this process yet (must be called holding the lock)
+        """
+        if self._pid == os.getpid():
+            return self._connection
+
+        self._pid = os.getpid()
+        self._connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS file_ids (digest TEXT PRIMARY KEY, file_id TEXT NOT NULL, stored REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS file_ids_stored ON file_ids (stored)")
+        return self._connection
+
+    @staticmethod
+    def digest(data) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, digest):
+        """
+        :return: The file_id of the image with the given content digest, None if it wasn't uploaded or it expired
+        """
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    "SELECT file_id FROM file_ids WHERE digest = ? AND stored > ?",
+                    (digest, time.time() - self.ttl)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Unable to look up a file_id: {e}")
+            return None
+
+        return row[0] if row else None
+
+    def put(self, digest, file_id) -> None:
+        """
+        Stores the file_id of an uploaded image, dropping expired entries and the oldest ones over max_size
+        """
+        now = time.time()
+        try:
+            with self._lock:
+                connection = self._connect()
+                connection.execute("BEGIN IMMEDIATE")
+                try:
+                    connection.execute("INSERT OR REPLACE INTO file_ids VALUES (?, ?, ?)", (digest, file_id, now))
+                    connection.execute("DELETE FROM file_ids WHERE stored <= ?", (now - self.ttl,))
+                    connection.execute(
+                        "DELETE FROM file_ids WHERE digest IN (SELECT digest FROM file_ids ORDER BY stored DESC LIMIT -1 OFFSET ?)",
+                        (self.max_size,)
+                    )
+                    connection.execute("COMMIT")
+                except sqlite3.Error:
+                    connection.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            logger.warning(f"Unable to store a file_id: {e}")
+
+    def forget(self, digest) -> None:
+        """
+        Removes a file_id Telegram no longer accepts
+        """
+        try:
+            with self._lock:
+                self._connect().execute("DELETE FROM file_ids WHERE digest = ?", (digest,))
+        except sqlite3.Error as e:
+            logger.warning(f"Unable to remove a file_id: {e}")
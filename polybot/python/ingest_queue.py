@@ -0,0 +1,351 @@
+from collections import namedtuple
+from loguru import logger
+import threading
+import tempfile
+import sqlite3
+import json
+import time
+import os
+
+# The SQLite database the updates are queued in. It should be on a volume so it outlives the container,
+# and it's shared by all the processes of the app
+INGEST_QUEUE_PATH = os.getenv("INGEST_QUEUE_PATH", os.path.join(tempfile.gettempdir(), "polybot_ingest.sqlite3"))
+# The maximum number of updates waiting in the queue, new ones are turned away beyond it
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+# How long an update stays leased after its process stopped renewing the lease (e.g. because it was restarted),
+# before it's handed to another worker
+INGEST_QUEUE_LEASE_SECONDS = float(os.getenv("INGEST_QUEUE_LEASE_SECONDS", "300"))
+# Number of times an update is handed to a worker before it's dropped
+INGEST_QUEUE_MAX_ATTEMPTS = int(os.getenv("INGEST_QUEUE_MAX_ATTEMPTS", "5"))
+# How often the queue is checked for updates appended by the other processes or whose lease expired
+INGEST_QUEUE_POLL_SECONDS = float(os.getenv("INGEST_QUEUE_POLL_SECONDS", "0.5"))
+
+# The most appends committed together in one transaction
+GROUP_COMMIT_SIZE = 256
+# The most updates leased at once
+LEASE_BATCH_SIZE = 32
+
+QueuedUpdate = namedtuple("QueuedUpdate", ["id", "key", "payload", "attempts"])
+
+
+class IngestQueue:
+    """
+    A durable queue of incoming updates kept in SQLite (in WAL mode), so an update which was acknowledged to Telegram
+    isn't lost if a uWSGI worker is recycled or the container restarts before it was handled.
+
+    Appends are group committed: they're handed to a single writer thread which commits everything that arrived while
+    the previous transaction was being written in one transaction (and one fsync), so a burst costs a few commits
+    instead of one per update and a lone update doesn't wait for a batch to fill up.
+
+    Updates are drained with at-least-once semantics: a dispatcher thread leases them for lease_seconds and hands
+    them to its dispatch function, and an update is only removed once it's acknowledged. An update whose lease expired
+    is leased again, by any process. The dispatcher renews the leases of the updates its process holds every third of
+    lease_seconds, so an update waiting for a busy worker or whose handling is slow (e.g. a prediction) is never handed
+    out twice, and the lease only runs out once the process is gone. Only the oldest update of every key (e.g. the chat id) is leased at a time,
+    so the updates of a key are handled one after the other and in order, across all the processes of the app.
+    The threads and connections are created by the first call of every process, as they don't survive uWSGI forking the app.
+    """
+
+    def __init__(self, path=INGEST_QUEUE_PATH, max_size=INGEST_QUEUE_SIZE, lease_seconds=INGEST_QUEUE_LEASE_SECONDS,
+                 max_attempts=INGEST_QUEUE_MAX_ATTEMPTS, poll_interval=INGEST_QUEUE_POLL_SECONDS):
+        self.path = path
+        self.max_size = max_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        connection = self._connect()
+        try:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS updates ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, shard_key TEXT NOT NULL, payload TEXT NOT NULL, "
+                "enqueued REAL NOT NULL, leased_until REAL NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS updates_shard_key ON updates (shard_key, id)")
+        finally:
+            connection.close()
+
+        self._lock = threading.Lock()
+        self._pending = threading.Condition(threading.Lock())
+        self._appends = []
+        self._wake = threading.Event()
+        self._closed = False
+        self._pid = None
+        self._threads = []
+        self._writer = None
+        self._connection = None
+        self._dispatch = None
+        # The ids of the updates this process leased and hasn't acknowledged or returned yet
+        self._held = set()
+
+        self.appended = 0
+        self.rejected = 0
+        self.commits = 0
+        self.batched = 0
+        self.commit_seconds = 0.0
+        self.acked = 0
+        self.retried = 0
+        self.dropped = 0
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # Every commit is synced to the disk, group commit keeps that down to one sync per batch
+        connection.execute("PRAGMA synchronous=FULL")
+        return connection
+
+    def _ensure_started(self) -> None:
+        """
+        Opens the connections and starts the writer thread if they don't exist in this process yet (must be called holding the lock)
+        """
+        if self._pid == os.getpid():
+            return
+
+        self._pid = os.getpid()
+        self._appends = []
+        self._writer = self._connect()
+        self._connection = self._connect()
+        self._dispatch = None
+        self._held = set()
+        self._threads = [threading.Thread(target=self._write, name="ingest-writer", daemon=True)]
+        self._threads[0].start()
+
+    def start(self, dispatch) -> None:
+        """
+        Starts draining the queue in this process, idempotent so it may be called on every request
+
+        :param dispatch: Called with every leased QueuedUpdate, returns False if it can't take the update at the moment
+                         (e.g. the worker it goes to is busy), which returns it to the queue as it was
+        """
+        with self._lock:
+            self._ensure_started()
+            if self._dispatch is not None:
+                return
+
+            self._dispatch = dispatch
+            thread = threading.Thread(target=self._drain, name="ingest-dispatcher", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def append(self, key, payload) -> bool:
+        """
+        Durably appends an update, returning once it's committed. Raises sqlite3.Error if it couldn't be written
+
+        :param key: The updates of equal keys are handled in the order they were appended
+        :param payload: A JSON serializable update
+        :return: False if the queue is full and the update was rejected
+        """
+        with self._lock:
+            self._ensure_started()
+
+        done = threading.Event()
+        entry = [str(key), json.dumps(payload), done, None]
+        with self._pending:
+            self._appends.append(entry)
+            self._pending.notify()
+
+        done.wait()
+        if isinstance(entry[3], Exception):
+            raise entry[3]
+        return entry[3]
+
+    def _write(self) -> None:
+        while True:
+            with self._pending:
+                while not self._appends and not self._closed:
+                    self._pending.wait()
+                if not self._appends:
+                    return
+
+                # Everything that was appended while the previous batch was committed goes in this one
+                batch = self._appends[:GROUP_COMMIT_SIZE]
+                del self._appends[:GROUP_COMMIT_SIZE]
+
+            start = time.perf_counter()
+            try:
+                self._writer.execute("BEGIN IMMEDIATE")
+                try:
+                    size = self._writer.execute("SELECT COUNT(*) FROM updates").fetchone()[0]
+                    accepted = batch[:max(0, self.max_size - size)]
+                    now = time.time()
+                    self._writer.executemany(
+                        "INSERT INTO updates (shard_key, payload, enqueued) VALUES (?, ?, ?)",
+                        [(key, payload, now) for key, payload, _, _ in accepted]
+                    )
+                    self._writer.execute("COMMIT")
+                except sqlite3.Error:
+                    self._writer.execute("ROLLBACK")
+                    raise
+
+                for index, entry in enumerate(batch):
+                    entry[3] = index < len(accepted)
+            except sqlite3.Error as e:
+                logger.exception(f"Unable to append {len(batch)} updates to the ingest queue: {e}")
+                accepted = []
+                for entry in batch:
+                    entry[3] = e
+
+            with self._lock:
+                self.commits += 1
+                self.batched += len(batch)
+                self.commit_seconds += time.perf_counter() - start
+                self.appended += len(accepted)
+                self.rejected += sum(entry[3] is False for entry in batch)
+
+            for entry in batch:
+                entry[2].set()
+
+            if accepted:
+                self._wake.set()
+
+    def _lease(self) -> list:
+        """
+        Leases the oldest update of every key which has no update leased at the moment, dropping the ones which ran out of attempts
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._connection.execute(
+                    "SELECT id, shard_key, payload, attempts FROM updates AS u "
+                    "WHERE leased_until <= ? AND id = (SELECT MIN(id) FROM updates WHERE shard_key = u.shard_key) "
+                    "ORDER BY id LIMIT ?",
+                    (now, LEASE_BATCH_SIZE)
+                ).fetchall()
+
+                dead = [row for row in rows if row[3] >= self.max_attempts]
+                leased = [row for row in rows if row[3] < self.max_attempts]
+
+                self._connection.executemany("DELETE FROM updates WHERE id = ?", [(row[0],) for row in dead])
+                self._connection.executemany(
+                    "UPDATE updates SET leased_until = ?, attempts = attempts + 1 WHERE id = ?",
+                    [(now + self.lease_seconds, row[0]) for row in leased]
+                )
+                self._connection.execute("COMMIT")
+            except sqlite3.Error:
+                self._connection.execute("ROLLBACK")
+                raise
+
+            self.dropped += len(dead)
+
+        for row in dead:
+            logger.error(f"Dropped update {row[0]} of {row[1]} from the ingest queue after {row[3]} attempts: {row[2]}")
+
+        return [QueuedUpdate(row[0], row[1], json.loads(row[2]), row[3] + 1) for row in leased]
+
+    def _renew(self) -> None:
+        """
+        Extends the leases of the updates held by this process, which are still waiting for their worker or being handled
+        """
+        with self._lock:
+            self._connection.executemany(
+                "UPDATE updates SET leased_until = ? WHERE id = ?",
+                [(time.time() + self.lease_seconds, update_id) for update_id in self._held]
+            )
+
+    def _drain(self) -> None:
+        renew_interval = self.lease_seconds / 3
+        renew_at = time.monotonic() + renew_interval
+        while not self._closed:
+            try:
+                updates = self._lease()
+            except sqlite3.Error as e:
+                logger.exception(f"Unable to lease updates from the ingest queue: {e}")
+                updates = []
+
+            busy = False
+            for update in updates:
+                with self._lock:
+                    self._held.add(update.id)
+                if busy or not self._dispatch(update):
+                    # Returned to the queue without using up an attempt
+                    busy = True
+                    self._release(update.id, 0, penalize=False)
+
+            if time.monotonic() >= renew_at:
+                try:
+                    self._renew()
+                except sqlite3.Error as e:
+                    logger.exception(f"Unable to renew the leases of the ingest queue: {e}")
+                renew_at = time.monotonic() + renew_interval
+
+            # Appends and acks of this process wake the dispatcher up straight away, the others are picked up by polling
+            if busy or len(updates) < LEASE_BATCH_SIZE:
+                self._wake.wait(min(self.poll_interval, renew_interval))
+                self._wake.clear()
+
+    def _release(self, update_id, delay, penalize=True) -> None:
+        with self._lock:
+            self._held.discard(update_id)
+            self._connection.execute(
+                "UPDATE updates SET leased_until = ?, attempts = attempts - ? WHERE id = ?",
+                (time.time() + delay, 0 if penalize else 1, update_id)
+            )
+
+    def ack(self, update_id) -> None:
+        """
+        Removes an update which was handled, the next update of its key may be leased from now on
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM updates WHERE id = ?", (update_id,))
+            self._held.discard(update_id)
+            self.acked += 1
+        self._wake.set()
+
+    def retry(self, update):
+        """
+        Returns an update whose handling failed to the queue, it's leased again after a backoff which grows with its attempts
+        """
+        with self._lock:
+            self.retried += 1
+        self._release(update.id, min(self.lease_seconds, 2 ** update.attempts))
+
+    def has_media_group(self, key, media_group_id) -> bool:
+        """
+        Whether an update of the media group is still queued or being handled. The updates of a key are handled one after
+        the other, so the later photos of a group may wait behind its first ones (or another slow update) for a while
+        """
+        with self._lock:
+            self._ensure_started()
+            return self._connection.execute(
+                "SELECT 1 FROM updates WHERE shard_key = ? AND json_extract(payload, '$.media_group_id') = ? LIMIT 1",
+                (str(key), str(media_group_id))
+            ).fetchone() is not None
+
+    def close(self) -> None:
+        """
+        Stops the threads of this process once the pending appends are committed and closes its connections
+        """
+        with self._pending:
+            self._closed = True
+            self._pending.notify_all()
+        self._wake.set()
+
+        for thread in self._threads:
+            thread.join()
+        with self._lock:
+            for connection in [self._writer, self._connection]:
+                if connection is not None:
+                    connection.close()
+            self._writer = self._connection = None
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            depth = self._connection.execute("SELECT COUNT(*) FROM updates").fetchone()[0] if self._connection else None
+            return {
+                "max_size": self.max_size,
+                "depth": depth,
+                "held": len(self._held),
+                "appended": self.appended,
+                "rejected": self.rejected,
+                "commits": self.commits,
+                "average_batch": self.batched / self.commits if self.commits else 0.0,
+                "average_commit_seconds": self.commit_seconds / self.commits if self.commits else 0.0,
+                "acked": self.acked,
+                "retried": self.retried,
+                "dropped": self.dropped,
+            }
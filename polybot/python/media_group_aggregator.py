@@ -0,0 +1,273 @@
+from loguru import logger
+import threading
+import tempfile
+import fcntl
+import shutil
+import time
+import os
+
+# Where the photos of the media groups are collected, shared by all the processes of the app. The updates are acknowledged
+# once their photo is spooled, keep it on a volume so the groups which were pending outlive a restart
+MEDIA_GROUP_SPOOL_DIR = os.getenv("MEDIA_GROUP_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "polybot_media_groups"))
+# A media group is complete once none of its photos arrived for this long
+MEDIA_GROUP_QUIET_SECONDS = float(os.getenv("MEDIA_GROUP_QUIET_SECONDS", "2"))
+# Telegram media groups hold at most 10 photos, a group is complete as soon as it has them all
+MEDIA_GROUP_MAX_PARTS = 10
+# The spool directory is the state store of the media groups, the ones no process touched for this long are evicted
+MEDIA_GROUP_STALE_SECONDS = 600
+
+CAPTION_FILE = "caption"
+CHAT_FILE = "chat"
+# Held by the process handling a claimed group, the lock is released when the process dies
+LOCK_FILE = ".lock"
+
+
+class MediaGroupAggregator:
+    """
+    Collects the photos of Telegram media groups, which arrive as separate updates, and hands every group to its handler once.
+    The photos are spooled to a directory shared by all the processes of the app, so the updates of a group may be handled
+    by any worker of any process. The spool holds all the state of a group (its chat, caption and photos) and is its TTL
+    store, as the groups left untouched for MEDIA_GROUP_STALE_SECONDS are removed (see _sweep). A group is complete when
+    it has MEDIA_GROUP_MAX_PARTS photos or none arrived for the quiet window, and whichever process notices it first
+    claims it by atomically renaming its directory and dispatches it (see start), so the groups are handled by the same
+    bounded workers as the updates. A claimed group stays locked until it's handled, and every process picks up the
+    groups which were left pending or whose claimer died when it starts.
+    """
+
+    def __init__(self, spool_dir=MEDIA_GROUP_SPOOL_DIR, quiet_window=MEDIA_GROUP_QUIET_SECONDS, max_parts=MEDIA_GROUP_MAX_PARTS):
+        self.spool_dir = spool_dir
+        self.quiet_window = quiet_window
+        self.max_parts = max_parts
+
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+        # The timers of the groups this process is waiting on, a timer is removed once it fired
+        self._lock = threading.Lock()
+        self._timers = {}
+        self._pid = None
+        self._handler = None
+        self._dispatch = None
+        self._pending = None
+
+    def start(self, handler, dispatch=None, pending=None) -> None:
+        """
+        Sets what's done with the complete groups and picks up the groups left in the spool directory (see _recover),
+        once per process and idempotent so it may be called on every request
+
+        :param handler: Called with (chat_id, paths, caption) for every complete group, the photos are removed when it returns
+        :param dispatch: Called with (chat_id, fn, *args) to have fn(*args), the handling of a group, run by the chat's worker,
+                         returns False if it can't take it at the moment. Without one the group is handled on the timer's thread
+        :param pending: Called with (chat_id, media_group_id), returns True while updates of the group are still waiting
+                        to be handled (see IngestQueue.has_media_group). The group isn't complete until they've been spooled
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            self._handler = handler
+            self._dispatch = dispatch
+            self._pending = pending
+
+        self._recover()
+
+    def _recover(self) -> None:
+        """
+        Re-arms the groups which were pending when the app was restarted, and dispatches the claimed ones whose
+        claimer died before it handled them. The other processes may do the same, the groups are still handled once
+        """
+        with os.scandir(self.spool_dir) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+
+                media_group_id = entry.name.split(".")[0]
+                try:
+                    with open(os.path.join(entry.path, CHAT_FILE)) as file:
+                        chat_id = int(file.read())
+                except (FileNotFoundError, ValueError):
+                    # Its first photo is being written or it's already gone
+                    continue
+
+                if not entry.name.endswith(".claimed"):
+                    logger.info(f"Re-arming media group {media_group_id} of chat {chat_id}.")
+                    self._schedule(chat_id, media_group_id, self.quiet_window)
+                    continue
+
+                lock = self._try_lock(entry.path)
+                if lock is None:
+                    # It's being handled
+                    continue
+                if not os.path.exists(entry.path):
+                    # Handled while it was being locked
+                    os.close(lock)
+                    continue
+
+                logger.info(f"Dispatching media group {media_group_id} of chat {chat_id}, its claimer is gone.")
+                self._dispatch_claimed(chat_id, media_group_id, entry.path, lock)
+
+    @staticmethod
+    def _try_lock(group_dir):
+        """
+        :return: The descriptor holding the group's lock, None if the group is gone or another process holds its lock
+        """
+        try:
+            lock = os.open(os.path.join(group_dir, LOCK_FILE), os.O_RDWR | os.O_CREAT)
+        except FileNotFoundError:
+            return None
+
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(lock)
+            return None
+
+        return lock
+
+    def _group_dir(self, media_group_id) -> str:
+        return os.path.join(self.spool_dir, str(media_group_id))
+
+    @staticmethod
+    def _parts(group_dir) -> list:
+        """
+        :return: The paths of the photos of the group, in the order they were sent
+        """
+        return [os.path.join(group_dir, name) for name in sorted(os.listdir(group_dir)) if not name.startswith(".") and name not in (CAPTION_FILE, CHAT_FILE)]
+
+    def add(self, chat_id, media_group_id, message_id, photo, suffix, caption) -> None:
+        """
+        Adds a downloaded photo to its group
+
+        :param photo: A binary file object holding the photo, it's copied into the spool directory
+        :param suffix: The file extension of the photo e.g. '.jpg'
+        :param caption: The caption of the photo, Telegram only sends it with the first photo of the group
+        """
+        self._sweep()
+
+        group_dir = self._group_dir(media_group_id)
+        os.makedirs(group_dir, exist_ok=True)
+
+        try:
+            if not os.path.exists(os.path.join(group_dir, CHAT_FILE)):
+                # Which chat the group belongs to, for a process picking up the group after a restart
+                with tempfile.NamedTemporaryFile("w", dir=group_dir, prefix=".", delete=False) as file:
+                    file.write(str(chat_id))
+                os.replace(file.name, os.path.join(group_dir, CHAT_FILE))
+
+            if caption:
+                with tempfile.NamedTemporaryFile("w", dir=group_dir, prefix=".", delete=False) as file:
+                    file.write(caption)
+                os.replace(file.name, os.path.join(group_dir, CAPTION_FILE))
+
+            # Message ids grow in the order the photos were sent, padding them keeps that order when they're sorted by name
+            # Written under a temporary name so a group is never claimed with a partially written photo
+            with tempfile.NamedTemporaryFile(dir=group_dir, prefix=".", delete=False) as file:
+                shutil.copyfileobj(photo, file)
+            os.replace(file.name, os.path.join(group_dir, f"{int(message_id):012d}{suffix}"))
+        except FileNotFoundError:
+            # The group was claimed in the meantime
+            logger.warning(f"A photo of media group {media_group_id} arrived after the group was handled.")
+            return
+
+        if len(self._parts(group_dir)) >= self.max_parts:
+            self._claim(chat_id, media_group_id)
+        else:
+            self._schedule(chat_id, media_group_id, self.quiet_window)
+
+    def _schedule(self, chat_id, media_group_id, delay) -> None:
+        # One timer per group is enough, it checks when the last photo of the group arrived once it fires
+        with self._lock:
+            if media_group_id in self._timers:
+                return
+
+            timer = threading.Timer(delay, self._check, (chat_id, media_group_id))
+            timer.daemon = True
+            self._timers[media_group_id] = timer
+        timer.start()
+
+    def _check(self, chat_id, media_group_id) -> None:
+        with self._lock:
+            self._timers.pop(media_group_id, None)
+
+        group_dir = self._group_dir(media_group_id)
+        try:
+            last_arrival = max(os.stat(path).st_mtime for path in self._parts(group_dir) + [group_dir])
+        except FileNotFoundError:
+            # Claimed by another process
+            return
+
+        remaining = last_arrival + self.quiet_window - time.time()
+        if remaining > 0:
+            self._schedule(chat_id, media_group_id, remaining)
+        elif self._is_pending(chat_id, media_group_id):
+            # Its later photos are queued behind the chat's other updates, the quiet window starts once they're spooled
+            self._schedule(chat_id, media_group_id, self.quiet_window)
+        else:
+            self._claim(chat_id, media_group_id)
+
+    def _is_pending(self, chat_id, media_group_id) -> bool:
+        if self._pending is None:
+            return False
+
+        try:
+            return self._pending(chat_id, media_group_id)
+        except Exception as e:
+            logger.warning(f"Unable to check whether photos of media group {media_group_id} are queued: {e}")
+            return False
+
+    def _claim(self, chat_id, media_group_id) -> None:
+        group_dir = self._group_dir(media_group_id)
+        claimed_dir = f"{group_dir}.{os.getpid()}.{threading.get_ident()}.claimed"
+
+        # The lock is taken before the rename, so a claimed group is never seen unlocked while its claimer is alive
+        lock = self._try_lock(group_dir)
+        if lock is None:
+            # Claimed by another process or thread
+            return
+
+        try:
+            os.rename(group_dir, claimed_dir)
+        except FileNotFoundError:
+            os.close(lock)
+            return
+
+        self._dispatch_claimed(chat_id, media_group_id, claimed_dir, lock)
+
+    def _dispatch_claimed(self, chat_id, media_group_id, claimed_dir, lock) -> None:
+        if self._dispatch is None:
+            self._handle(chat_id, media_group_id, claimed_dir, lock)
+        elif not self._dispatch(chat_id, self._handle, chat_id, media_group_id, claimed_dir, lock):
+            # The chat's worker is full, the claimed group is offered to it again after another quiet window
+            logger.warning(f"Media group {media_group_id} was rejected by the workers, dispatching it again later.")
+            timer = threading.Timer(self.quiet_window, self._dispatch_claimed, (chat_id, media_group_id, claimed_dir, lock))
+            timer.daemon = True
+            timer.start()
+
+    def _handle(self, chat_id, media_group_id, claimed_dir, lock) -> None:
+        try:
+            caption_path = os.path.join(claimed_dir, CAPTION_FILE)
+            caption = ""
+            if os.path.exists(caption_path):
+                with open(caption_path) as file:
+                    caption = file.read()
+
+            self._handler(chat_id, self._parts(claimed_dir), caption)
+        except Exception as e:
+            logger.exception(f"Handling media group {media_group_id} failed: {e}")
+        finally:
+            # Released once the group is gone, so it's never picked up again
+            shutil.rmtree(claimed_dir, ignore_errors=True)
+            os.close(lock)
+
+    def _sweep(self) -> None:
+        """
+        Removes the groups which were left behind for longer than MEDIA_GROUP_STALE_SECONDS
+        """
+        stale = time.time() - MEDIA_GROUP_STALE_SECONDS
+        with os.scandir(self.spool_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir() and entry.stat().st_mtime < stale:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                except FileNotFoundError:
+                    continue
@@ -0,0 +1,290 @@
+# The same module is kept in polybot/python and yolo5, as each image is built from its own directory.
+# Change both copies together, test_resilience fails once they differ
+from contextlib import contextmanager
+from contextvars import ContextVar
+from loguru import logger
+import threading
+import asyncio
+import random
+import time
+import os
+
+# Number of attempts of a call whose failure is transient, including the first one
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "3"))
+# The delay before a retry is drawn from 0 up to base * 2 ** retry (full jitter), and never more than the maximum
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "10"))
+# Number of failures in a row which opens the breaker of an endpoint
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+# How long an open breaker fails calls before letting a single one through to probe the endpoint
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class Unavailable(Exception):
+    """
+    Raised (by the called function) for an answer meaning the endpoint is overloaded or down, e.g. a 503.
+    It's retried like a connection error, after at least retry_after seconds if the endpoint asked for them
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(Exception):
+    """
+    The endpoint's breaker is open, the call was failed without being made
+    """
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    There's no time left for (another attempt of) the call
+    """
+
+
+class Deadline:
+    """
+    The time by which the caller needs an answer, every attempt and every delay between them has to fit in it
+    """
+
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, timeout) -> float:
+        """
+        :return: The timeout of a single request, cut down to the time left
+        """
+        return min(timeout, self.remaining())
+
+
+_deadline = ContextVar("deadline", default=None)
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Every call made within the block (in the same thread or task) gives up once the seconds have passed, a nested block
+    can only shorten it
+    """
+    current = _deadline.get()
+    scoped = Deadline(seconds)
+    if current is not None and current.expires < scoped.expires:
+        scoped = current
+    token = _deadline.set(scoped)
+    try:
+        yield scoped
+    finally:
+        _deadline.reset(token)
+
+
+def current_deadline():
+    return _deadline.get()
+
+
+class CircuitBreaker:
+    """
+    Stops calling an endpoint after failures failures in a row, so a struggling endpoint isn't buried under retries.
+    Once reset_timeout passed a single call is let through: its success closes the breaker again and its failure keeps
+    it open for another reset_timeout
+    """
+
+    def __init__(self, name, failures=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failures
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+        self.calls = 0
+        self.failed = 0
+        self.rejected = 0
+        self.opened = 0
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._probing = False
+
+            if self.state == CLOSED or (self.state == HALF_OPEN and not self._probing):
+                self._probing = self.state == HALF_OPEN
+                self.calls += 1
+                return True
+
+            self.rejected += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info(f"The breaker of {self.name} is closed again")
+            self.state = CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failed += 1
+            self.failures += 1
+            self._probing = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                logger.warning(f"The breaker of {self.name} opened after {self.failures} failures in a row")
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.opened += 1
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "calls": self.calls,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "opened": self.opened,
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(endpoint) -> CircuitBreaker:
+    """
+    :return: The breaker of the endpoint, shared by everything calling it in the process
+    """
+    with _breakers_lock:
+        if endpoint not in _breakers:
+            _breakers[endpoint] = CircuitBreaker(endpoint)
+        return _breakers[endpoint]
+
+
+def breaker_stats() -> dict:
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.stats for breaker in breakers}
+
+
+def backoff(retry, base=RETRY_BASE_DELAY, maximum=RETRY_MAX_DELAY) -> float:
+    """
+    :param retry: 0 for the first retry
+    :return: The seconds to wait before the retry, drawn at random so the callers which failed together don't retry
+             together
+    """
+    return random.uniform(0, min(maximum, base * 2 ** retry))
+
+
+def is_transient(exception) -> bool:
+    """
+    The default of which failures are worth retrying: the endpoint being unavailable and connection errors and timeouts,
+    whichever client raised them
+    """
+    if isinstance(exception, (Unavailable, ConnectionError, TimeoutError)):
+        return True
+
+    # S3 throttling or failing (botocore's ClientError carries the answer as a dict)
+    response = getattr(exception, "response", None)
+    if isinstance(response, dict):
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        return status == 429 or status >= 500
+
+    # requests, aiohttp, botocore and pymongo don't derive their connection errors and timeouts from the builtin ones
+    names = {cls.__name__ for cls in type(exception).__mro__}
+    return bool(names & {"ConnectionError", "Timeout", "TimeoutError", "ClientConnectionError", "EndpointConnectionError",
+                         "ConnectionClosedError", "ReadTimeoutError", "ConnectTimeoutError", "AutoReconnect",
+                         "ConnectionFailure", "ServerTimeoutError"})
+
+
+def _retry_delay(endpoint, exception, retry, attempts, deadline):
+    """
+    :return: The seconds to wait before the next attempt, None if the call should give up
+    """
+    if retry + 1 >= attempts:
+        return None
+
+    delay = max(backoff(retry), getattr(exception, "retry_after", None) or 0)
+    if deadline is not None and deadline.remaining() <= delay:
+        logger.warning(f"Not retrying {endpoint}, the deadline is in {deadline.remaining():.1f}s")
+        return None
+
+    logger.warning(f"Calling {endpoint} failed: {exception}. Retrying in {delay:.1f}s")
+    return delay
+
+
+def _start_attempt(endpoint, circuit, deadline) -> None:
+    if deadline is not None and deadline.expired():
+        raise DeadlineExceeded(f"The deadline of the call to {endpoint} has passed")
+    if not circuit.allow():
+        raise CircuitOpenError(f"{endpoint} is unavailable, please try again later")
+
+
+def call(endpoint, fn, *args, attempts=RETRY_ATTEMPTS, retryable=is_transient, deadline=None, **kwargs):
+    """
+    Calls fn(*args, **kwargs) through the endpoint's breaker, retrying transient failures with an exponential backoff
+    and jitter for as long as the deadline (the given one or the block's, see deadline()) allows.
+    Raises CircuitOpenError without calling fn while the breaker is open, DeadlineExceeded if there's no time left and
+    otherwise what fn raised last
+    """
+    deadline = deadline or current_deadline()
+    circuit = breaker(endpoint)
+    for retry in range(attempts):
+        _start_attempt(endpoint, circuit, deadline)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if not retryable(e):
+                # The endpoint did answer
+                circuit.record_success()
+                raise
+            circuit.record_failure()
+
+            delay = _retry_delay(endpoint, e, retry, attempts, deadline)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            continue
+
+        circuit.record_success()
+        return result
+
+
+async def call_async(endpoint, coroutine_function, *args, attempts=RETRY_ATTEMPTS, retryable=is_transient, deadline=None, **kwargs):
+    """
+    The asyncio counterpart of call, awaiting coroutine_function(*args, **kwargs) and sleeping without holding a thread
+    """
+    deadline = deadline or current_deadline()
+    circuit = breaker(endpoint)
+    for retry in range(attempts):
+        _start_attempt(endpoint, circuit, deadline)
+        try:
+            result = await coroutine_function(*args, **kwargs)
+        except Exception as e:
+            if not retryable(e):
+                circuit.record_success()
+                raise
+            circuit.record_failure()
+
+            delay = _retry_delay(endpoint, e, retry, attempts, deadline)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            continue
+
+        circuit.record_success()
+        return result
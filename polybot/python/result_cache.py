@@ -0,0 +1,194 @@
+from collections import OrderedDict
+from loguru import logger
+import threading
+import tempfile
+import hashlib
+import os
+
+# How many bytes of results are kept in memory (0 disables the in-process tier)
+RESULT_CACHE_MEMORY_BYTES = int(os.getenv("RESULT_CACHE_MEMORY_MB", "64")) * 1024 * 1024
+# How many bytes of results are kept on disk (0 disables the on-disk tier)
+RESULT_CACHE_DISK_BYTES = int(os.getenv("RESULT_CACHE_DISK_MB", "512")) * 1024 * 1024
+# Where the on-disk tier keeps its files, it may be shared by all the processes of the app
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "polybot_results"))
+# Once the on-disk tier is over its size it's trimmed to this fraction of it, so it isn't scanned on every write
+DISK_TRIM_RATIO = 0.9
+
+
+class ResultCache:
+    """
+    A two tier cache of encoded results: an LRU in memory in front of a size capped directory on disk.
+    Keys are any value with a stable repr (e.g. a tuple of the photo's file_unique_id and the pipeline's key),
+    they are stored as their SHA-256 digest.
+    The on-disk tier evicts the least recently used files (by modification time, which is refreshed on every hit)
+    and is safe to share between processes as files are written to a temporary name and renamed into place.
+    """
+
+    def __init__(self, memory_bytes=RESULT_CACHE_MEMORY_BYTES, disk_bytes=RESULT_CACHE_DISK_BYTES, directory=RESULT_CACHE_DIR):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes if directory else 0
+        self.directory = directory
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk_size = 0
+
+        self.hits = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_bytes > 0:
+            os.makedirs(self.directory, exist_ok=True)
+            self._disk_size = sum(size for _, _, size in self._disk_entries())
+
+    @staticmethod
+    def digest(key) -> str:
+        return hashlib.sha256(repr(key).encode()).hexdigest()
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "memory_items": len(self._memory),
+                "memory_bytes": self._memory_size,
+                "disk_bytes": self._disk_size,
+            }
+
+    def get(self, key):
+        """
+        :return: The cached bytes of the key or None on a miss
+        """
+        digest = self.digest(key)
+
+        with self._lock:
+            data = self._memory.get(digest)
+            if data is not None:
+                self._memory.move_to_end(digest)
+                self.hits += 1
+                self.memory_hits += 1
+                return data
+
+        data = self._read(digest)
+
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.disk_hits += 1
+            self._remember(digest, data)
+
+        return data
+
+    def put(self, key, data) -> None:
+        digest = self.digest(key)
+
+        with self._lock:
+            self._remember(digest, data)
+
+        self._write(digest, data)
+
+    def _remember(self, digest, data) -> None:
+        """
+        Adds the data to the memory tier, evicting the least recently used results (must be called holding the lock)
+        """
+        if len(data) > self.memory_bytes:
+            return
+
+        previous = self._memory.pop(digest, None)
+        if previous is not None:
+            self._memory_size -= len(previous)
+
+        self._memory[digest] = data
+        self._memory_size += len(data)
+
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _path(self, digest) -> str:
+        return os.path.join(self.directory, digest)
+
+    def _read(self, digest):
+        if self.disk_bytes <= 0:
+            return None
+
+        path = self._path(digest)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            # Mark the file as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"Unable to read cached result {path}: {e}")
+            return None
+
+        return data
+
+    def _write(self, digest, data) -> None:
+        if self.disk_bytes <= 0 or len(data) > self.disk_bytes:
+            return
+
+        path = self._path(digest)
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.directory, prefix=".", delete=False) as file:
+                file.write(data)
+            # A result written again (e.g. by another process) replaces its file, only the difference is added
+            try:
+                previous = os.stat(path).st_size
+            except FileNotFoundError:
+                previous = 0
+            os.replace(file.name, path)
+        except OSError as e:
+            logger.warning(f"Unable to cache result {path}: {e}")
+            return
+
+        with self._lock:
+            self._disk_size += len(data) - previous
+            if self._disk_size > self.disk_bytes:
+                self._trim_disk()
+
+    def _disk_entries(self):
+        """
+        :return: Generator of (modification time, path, size) of the cached files
+        """
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another process
+                    continue
+                yield stat.st_mtime, entry.path, stat.st_size
+
+    def _trim_disk(self) -> None:
+        """
+        Removes the least recently used files until the on-disk tier is back under DISK_TRIM_RATIO of its size.
+        The directory is rescanned as other processes may have added or removed files (must be called holding the lock)
+        """
+        entries = sorted(self._disk_entries())
+        size = sum(entry_size for _, _, entry_size in entries)
+
+        for _, path, entry_size in entries:
+            if size <= self.disk_bytes * DISK_TRIM_RATIO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+        self._disk_size = size
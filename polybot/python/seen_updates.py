@@ -0,0 +1,157 @@
+from loguru import logger
+import threading
+import tempfile
+import sqlite3
+import time
+import os
+
+# The SQLite database the seen updates are kept in, shared by all the processes of the app
+SEEN_UPDATES_PATH = os.getenv("SEEN_UPDATES_PATH", os.path.join(tempfile.gettempdir(), "polybot_seen_updates.sqlite3"))
+# The maximum number of keys kept, the oldest ones are dropped first
+SEEN_UPDATES_SIZE = int(os.getenv("SEEN_UPDATES_SIZE", "100000"))
+# How long an update is remembered for, Telegram gives up redelivering an update after 24 hours
+SEEN_UPDATES_TTL = int(os.getenv("SEEN_UPDATES_TTL_HOURS", "24")) * 60 * 60
+
+# Expired keys and the ones over the maximum are dropped once every so many updates
+PRUNE_EVERY = 100
+
+
+class SeenUpdates:
+    """
+    Remembers the updates the webhook accepted so the ones Telegram redelivers (e.g. because it didn't get an answer
+    in time) are dropped before any work is scheduled for them. An update is only added once it was queued, so a process
+    dying in between has Telegram's redelivery handled rather than taken for a duplicate. An update is recognized by its update_id and by
+    its (chat_id, message_id, edit_date), so an edit of a message is still handled.
+    The keys are kept in SQLite, shared by all the uWSGI processes, bounded to max_size and every key expires ttl
+    seconds after it was seen. The connection is opened by the first call of every process, as it doesn't survive forking.
+    """
+
+    def __init__(self, path=SEEN_UPDATES_PATH, max_size=SEEN_UPDATES_SIZE, ttl=SEEN_UPDATES_TTL):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._connection = None
+
+        self.lookups = 0
+        self.duplicates = 0
+        self.added = 0
+
+    @staticmethod
+    def keys(update) -> list:
+        """
+        :param update: The update as sent by Telegram
+        :return: The keys which identify the update
+        """
+        keys = []
+        if "update_id" in update:
+            keys.append(f"update:{update['update_id']}")
+
+        msg = update.get("message") or update.get("edited_message")
+        if msg and "message_id" in msg:
+            keys.append(f"message:{msg['chat']['id']}:{msg['message_id']}:{msg.get('edit_date', 0)}")
+
+        return keys
+
+    def _connect(self):
+        """
+        Opens the connection if it isn't open in this process yet (must be called holding the lock)
+        """
+        if self._pid == os.getpid():
+            return self._connection
+
+        self._pid = os.getpid()
+        self._connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # Losing the last few keys on a power failure only means an update may be handled twice
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS seen_updates (key TEXT PRIMARY KEY, seen REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS seen_updates_seen ON seen_updates (seen)")
+        return self._connection
+
+    def _is_seen(self, connection, keys, now) -> bool:
+        placeholders = ", ".join("?" * len(keys))
+        return connection.execute(
+            f"SELECT 1 FROM seen_updates WHERE key IN ({placeholders}) AND seen > ? LIMIT 1",
+            (*keys, now - self.ttl)
+        ).fetchone() is not None
+
+    def seen(self, keys) -> bool:
+        """
+        Checks whether an update was already accepted, without recording it (see add)
+
+        :param keys: The keys of the update (see keys)
+        :return: True if the update is a duplicate. If the seen updates can't be read it's treated as a new one,
+                 as handling an update twice is better than dropping it
+        """
+        if not keys:
+            return False
+
+        try:
+            with self._lock:
+                duplicate = self._is_seen(self._connect(), keys, time.time())
+                self.lookups += 1
+                self.duplicates += duplicate
+        except sqlite3.Error as e:
+            logger.warning(f"Unable to check whether an update was seen: {e}")
+            return False
+
+        return duplicate
+
+    def add(self, keys) -> bool:
+        """
+        Records an update once it was accepted, unless one of its keys was already seen
+
+        :param keys: The keys of the update (see keys)
+        :return: False if the update was already recorded (e.g. a redelivery accepted at the same time)
+        """
+        if not keys:
+            return True
+
+        now = time.time()
+        try:
+            with self._lock:
+                connection = self._connect()
+                connection.execute("BEGIN IMMEDIATE")
+                try:
+                    duplicate = self._is_seen(connection, keys, now)
+
+                    if not duplicate:
+                        connection.executemany("INSERT OR REPLACE INTO seen_updates VALUES (?, ?)", [(key, now) for key in keys])
+                        self.added += 1
+                        if self.added % PRUNE_EVERY == 0:
+                            self._prune(connection, now)
+
+                    connection.execute("COMMIT")
+                except sqlite3.Error:
+                    connection.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            logger.warning(f"Unable to record a seen update: {e}")
+            return True
+
+        return not duplicate
+
+    def _prune(self, connection, now) -> None:
+        connection.execute("DELETE FROM seen_updates WHERE seen <= ?", (now - self.ttl,))
+        connection.execute(
+            "DELETE FROM seen_updates WHERE key IN (SELECT key FROM seen_updates ORDER BY seen DESC LIMIT -1 OFFSET ?)",
+            (self.max_size,)
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._pid = self._connection = None
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "lookups": self.lookups,
+                "duplicates": self.duplicates,
+                "hit_rate": self.duplicates / self.lookups if self.lookups else 0.0,
+            }
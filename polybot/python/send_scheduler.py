@@ -0,0 +1,269 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from loguru import logger
+import itertools
+import threading
+import time
+import os
+
+# Telegram lets a bot send about 30 messages a second overall and about one a second to the same chat (in short bursts)
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+# Texts sent to the same chat within this window are joined into one message
+OUTBOUND_COALESCE_SECONDS = float(os.getenv("OUTBOUND_COALESCE_SECONDS", "0.3"))
+# Number of requests to Telegram made at the same time by each process
+OUTBOUND_SENDERS = int(os.getenv("OUTBOUND_SENDERS", "4"))
+# Number of times a request Telegram answered with 429 is retried after the time it asked for
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+
+# The longest text Telegram accepts in a single message
+MAX_TEXT_LENGTH = 4096
+
+# Lower goes first
+PHOTO_PRIORITY = 0
+TEXT_PRIORITY = 1
+
+
+def flood_wait(exception):
+    """
+    :return: The seconds Telegram asked to wait if the exception is its 429 answer, None otherwise.
+             Both TeleBot's and AsyncTeleBot's ApiTelegramException carry the answer in result_json
+    """
+    if getattr(exception, "error_code", None) != 429:
+        return None
+    return ((getattr(exception, "result_json", None) or {}).get("parameters") or {}).get("retry_after")
+
+
+class TokenBucket:
+    """
+    Allows rate requests a second on average, and bursts of up to burst requests
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def delay(self, now) -> float:
+        """
+        :return: The number of seconds until a token is available, 0 if one is available now
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class SendJob:
+
+    def __init__(self, chat_id, priority, seq, fn, args, kwargs, ready_at, texts=None):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.seq = seq
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.ready_at = ready_at
+        self.texts = texts
+        self.attempts = 0
+        self.future = Future()
+
+
+class SendScheduler:
+    """
+    Paces every request which sends something to a chat so the bot stays within Telegram's limits instead of running into
+    429 (flood wait) errors: a global token bucket and one per chat, a chat only has one request in flight at a time
+    (so its messages arrive in order) and when Telegram answers 429 the chat is paused for the retry_after it asked for
+    and the request is retried.
+    Photos go before texts, and texts sent to the same chat within the coalescing window (e.g. a status and an error)
+    are joined into a single message.
+    The dispatcher thread and the senders are started by the first send of every process, as threads don't survive
+    uWSGI forking the app.
+    """
+
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE, chat_burst=OUTBOUND_CHAT_BURST,
+                 coalesce_window=OUTBOUND_COALESCE_SECONDS, senders=OUTBOUND_SENDERS, max_retries=OUTBOUND_MAX_RETRIES):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.coalesce_window = coalesce_window
+        self.senders = senders
+        self.max_retries = max_retries
+
+        self._condition = threading.Condition()
+        self._seq = itertools.count()
+        self._pid = None
+        self._executor = None
+        self._pending = []
+        self._in_flight = set()
+        self._global_bucket = None
+        self._chat_buckets = {}
+        self._paused_until = {}
+
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.flood_waits = 0
+
+    def _ensure_started(self) -> None:
+        """
+        Starts the dispatcher and the senders if they don't run in this process yet (must be called holding the condition)
+        """
+        if self._pid == os.getpid():
+            return
+
+        self._pid = os.getpid()
+        self._pending = []
+        self._in_flight = set()
+        self._global_bucket = TokenBucket(self.global_rate, max(1.0, self.global_rate))
+        self._chat_buckets = {}
+        self._paused_until = {}
+        self._executor = ThreadPoolExecutor(max_workers=self.senders, thread_name_prefix="sender")
+        threading.Thread(target=self._dispatch, name="send-dispatcher", daemon=True).start()
+
+    def send(self, chat_id, fn, *args, priority=PHOTO_PRIORITY, **kwargs) -> Future:
+        """
+        Schedules fn(*args, **kwargs), a request sending something to the chat
+
+        :return: A Future of the request's result
+        """
+        with self._condition:
+            self._ensure_started()
+            job = SendJob(chat_id, priority, next(self._seq), fn, args, kwargs, time.monotonic())
+            self._pending.append(job)
+            self._condition.notify()
+        return job.future
+
+    def send_text(self, chat_id, text, fn, **kwargs) -> Future:
+        """
+        Schedules fn(chat_id, text, **kwargs) e.g. TeleBot.send_message. The text waits for the coalescing window and
+        is joined with the other texts sent to the chat in the meantime (with the same kwargs)
+
+        :return: A Future of the request's result, shared by all the texts joined into the message
+        """
+        text = str(text)
+        with self._condition:
+            self._ensure_started()
+
+            for job in self._pending:
+                if (job.texts is not None and job.chat_id == chat_id and job.fn == fn and job.kwargs == kwargs
+                        and sum(map(len, job.texts)) + 2 * len(job.texts) + len(text) <= MAX_TEXT_LENGTH):
+                    job.texts.append(text)
+                    self.coalesced += 1
+                    return job.future
+
+            job = SendJob(chat_id, TEXT_PRIORITY, next(self._seq), fn, (chat_id,), kwargs,
+                          time.monotonic() + self.coalesce_window, texts=[text])
+            self._pending.append(job)
+            self._condition.notify()
+        return job.future
+
+    def _next(self, now):
+        """
+        Picks the job to send next: the first one by priority (and then the order it was sent in) whose chat isn't
+        busy, paused or over its rate, provided the global bucket allows it. Must be called holding the condition
+
+        :return: (job, None) or (None, seconds to wait before looking again, None until a job is added or completes)
+        """
+        wait = None
+        for job in sorted(self._pending, key=lambda job: (job.priority, job.seq)):
+            if job.chat_id in self._in_flight:
+                continue
+
+            bucket = self._chat_buckets.get(job.chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[job.chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+
+            delay = max(job.ready_at - now, self._paused_until.get(job.chat_id, 0) - now, bucket.delay(now))
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+
+            delay = self._global_bucket.delay(now)
+            if delay > 0:
+                return None, delay if wait is None else min(wait, delay)
+
+            bucket.take()
+            self._global_bucket.take()
+            return job, None
+
+        return None, wait
+
+    def _dispatch(self) -> None:
+        while True:
+            with self._condition:
+                job, wait = self._next(time.monotonic())
+                while job is None:
+                    self._condition.wait(wait)
+                    job, wait = self._next(time.monotonic())
+
+                self._pending.remove(job)
+                self._in_flight.add(job.chat_id)
+                self._forget_idle_chats()
+
+            self._executor.submit(self._send, job)
+
+    def _forget_idle_chats(self) -> None:
+        # The buckets of chats which are full again are the same as new ones
+        if len(self._chat_buckets) > 1000:
+            now = time.monotonic()
+            active = {job.chat_id for job in self._pending} | self._in_flight
+            for chat_id, bucket in list(self._chat_buckets.items()):
+                if chat_id not in active and bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.burst:
+                    del self._chat_buckets[chat_id]
+                    self._paused_until.pop(chat_id, None)
+
+    @staticmethod
+    def _rewind(job) -> None:
+        # A retried upload (e.g. an InputFile) has to be read from the start again
+        for arg in list(job.args) + list(job.kwargs.values()):
+            file = getattr(arg, "file", arg)
+            if hasattr(file, "seek"):
+                file.seek(0)
+
+    def _send(self, job) -> None:
+        try:
+            if job.attempts:
+                self._rewind(job)
+            args = job.args if job.texts is None else job.args + ("\n\n".join(job.texts),)
+            job.future.set_result(job.fn(*args, **job.kwargs))
+            with self._condition:
+                self.sent += 1
+        except Exception as e:
+            retry_after = flood_wait(e)
+            if retry_after is not None and job.attempts < self.max_retries:
+                logger.warning(f"Telegram asked to wait {retry_after}s before sending to chat {job.chat_id} again, retrying then")
+                with self._condition:
+                    self.flood_waits += 1
+                    job.attempts += 1
+                    self._paused_until[job.chat_id] = time.monotonic() + retry_after
+                    # It keeps its place in the queue
+                    self._pending.append(job)
+            else:
+                self._fail(job, e)
+        finally:
+            with self._condition:
+                self._in_flight.discard(job.chat_id)
+                self._condition.notify()
+
+    def _fail(self, job, exception) -> None:
+        # Sending errors aren't reported to the chat, that would only send more messages
+        logger.warning(f"Sending to chat {job.chat_id} failed: {exception}")
+        with self._condition:
+            self.failed += 1
+        job.future.set_exception(exception)
+
+    @property
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "pending": len(self._pending),
+                "in_flight": len(self._in_flight),
+                "sent": self.sent,
+                "failed": self.failed,
+                "coalesced": self.coalesced,
+                "flood_waits": self.flood_waits,
+            }
@@ -0,0 +1,112 @@
+from loguru import logger
+import threading
+import queue
+import time
+import os
+
+# Number of updates handled at the same time by each process
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "2"))
+# Number of updates which may wait for each worker before new ones are turned away
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "16"))
+
+
+class WorkerPool:
+    """
+    A fixed number of worker threads, each fed by its own bounded queue.
+    Every task is submitted with a key (e.g. the chat id) and all the tasks of a key go to the same worker, so they run
+    one at a time and in the order they were submitted, while tasks of different keys run in parallel on the other workers.
+    submit never blocks: once the worker's queue is full the task is rejected and the caller applies its overload policy,
+    which keeps the number of threads (and the time a queued update waits) bounded however big a burst is.
+    The threads are started by the first submit of every process, as threads don't survive uWSGI forking the app.
+    """
+
+    def __init__(self, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE):
+        if workers < 1:
+            raise ValueError("A worker pool needs at least one worker.")
+
+        self.workers = workers
+        self.queue_size = queue_size
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queues = []
+
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.active = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+
+    def _ensure_started(self) -> None:
+        """
+        Starts the worker threads if they don't run in this process yet (must be called holding the lock)
+        """
+        if self._pid == os.getpid():
+            return
+
+        self._pid = os.getpid()
+        self._queues = [queue.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+
+        for index, tasks in enumerate(self._queues):
+            threading.Thread(target=self._work, args=(tasks,), name=f"worker-{index}", daemon=True).start()
+
+    def submit(self, key, fn, *args) -> bool:
+        """
+        Queues fn(*args) to be run by the worker of the key
+
+        :param key: A hashable value, tasks with equal keys run in order
+        :return: False if the worker's queue is full and the task was rejected
+        """
+        with self._lock:
+            self._ensure_started()
+            tasks = self._queues[hash(key) % self.workers]
+            try:
+                tasks.put_nowait((fn, args, time.monotonic()))
+            except queue.Full:
+                self.rejected += 1
+                return False
+
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, tasks.qsize())
+            return True
+
+    def _work(self, tasks) -> None:
+        while True:
+            fn, args, queued = tasks.get()
+
+            with self._lock:
+                self.active += 1
+                self.total_wait += time.monotonic() - queued
+
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.exception(f"A worker task failed: {e}")
+                with self._lock:
+                    self.failed += 1
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+                tasks.task_done()
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            depths = [tasks.qsize() for tasks in self._queues]
+            started = self.submitted - sum(depths)
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "queue_depth": sum(depths),
+                "queue_depths": depths,
+                "max_queue_depth": self.max_depth,
+                "active": self.active,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+                "average_wait": self.total_wait / started if started > 0 else 0.0,
+            }
@@ -0,0 +1,143 @@
+from loguru import logger
+from resilience import call, deadline, current_deadline, Unavailable, DeadlineExceeded
+import requests
+import time
+import os
+
+# The longest a prediction is waited for, from submitting it until its result is ready
+PREDICT_TIMEOUT = float(os.getenv("PREDICT_TIMEOUT", "120"))
+# The result is polled for after this many seconds, twice as long every time up to the maximum
+PREDICT_POLL_INITIAL = float(os.getenv("PREDICT_POLL_INITIAL", "0.5"))
+PREDICT_POLL_MAX = float(os.getenv("PREDICT_POLL_MAX", "5"))
+# Seconds to wait for yolo5 to answer a single request (not the prediction itself)
+REQUEST_TIMEOUT = 10
+# The name of yolo5's circuit breaker
+YOLO5_ENDPOINT = "yolo5"
+# Answers meaning yolo5 is overloaded or restarting
+BUSY_STATUSES = (429, 502, 503, 504)
+# The statuses yolo5 answers a job's result with once it failed, and for a job it doesn't know (see yolo5's app.py)
+FAILED = "failed"
+UNKNOWN = "unknown"
+
+
+def yolo5_url() -> str:
+    return f"http://{os.environ['YOLO5_NAME']}:{os.environ['YOLO5_PORT']}"
+
+
+def poll_delays(initial=PREDICT_POLL_INITIAL, maximum=PREDICT_POLL_MAX):
+    """
+    Yields the seconds to wait before each poll, doubling from initial up to maximum
+    """
+    delay = initial
+    while True:
+        yield delay
+        delay = min(maximum, delay * 2)
+
+
+def request_timeout() -> float:
+    """
+    :return: The timeout of a single request to yolo5, no longer than the time left of the prediction
+    """
+    scoped = current_deadline()
+    return REQUEST_TIMEOUT if scoped is None else scoped.timeout(REQUEST_TIMEOUT)
+
+
+def retry_after(headers):
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_unknown_job(body) -> bool:
+    """
+    Whether the answer says yolo5 doesn't know the job (e.g. it restarted), only then is the image submitted again
+    """
+    return isinstance(body, dict) and body.get("status") == UNKNOWN
+
+
+def job_error(image_name, status, body) -> RuntimeError:
+    """
+    :return: The error of a job whose result isn't coming, the prediction's own error if it failed (e.g. nothing was detected)
+    """
+    if isinstance(body, dict) and body.get("status") == FAILED:
+        return RuntimeError(f"The prediction of {image_name} failed ({body.get('status_code')}): {body.get('error')}")
+    return RuntimeError(f"HTTP error occurred: {status}\n{body}")
+
+
+class Yolo5Client:
+    """
+    Runs predictions as yolo5 jobs: the image is submitted once, yolo5 answers straight away with the job's id, and the
+    result is polled for with a growing delay, so no request (nor a thread of yolo5's) is held open for the whole
+    inference.
+    yolo5 submits each image only once, so submitting again after a failed request or a job yolo5 lost (e.g. it restarted)
+    joins the running inference instead of starting another.
+    Every request goes through yolo5's circuit breaker (see resilience.call), so once yolo5 keeps failing the predictions
+    fail straight away instead of piling more requests on it.
+    """
+
+    def __init__(self, base_url=None, timeout=PREDICT_TIMEOUT, poll_initial=PREDICT_POLL_INITIAL, poll_max=PREDICT_POLL_MAX):
+        # Read when the first prediction is made as the bot doesn't need yolo5 to run
+        self.base_url = base_url
+        self.timeout = timeout
+        self.poll_initial = poll_initial
+        self.poll_max = poll_max
+        self.session = requests.Session()
+
+    def url(self, path) -> str:
+        return f"{self.base_url or yolo5_url()}{path}"
+
+    def request(self, method, path, **params):
+        """
+        Raises Unavailable if yolo5 is too busy to answer
+
+        :return: (status code, the answer's JSON or text)
+        """
+        response = self.session.request(method, self.url(path), params=params, timeout=request_timeout())
+        if response.status_code in BUSY_STATUSES:
+            raise Unavailable(f"HTTP error occurred: {response.status_code}\n{response.text}", retry_after(response.headers))
+
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, response.text
+
+    def submit(self, image_name) -> str:
+        """
+        :return: The id of the image's job
+        """
+        params = {"imgName": image_name}
+        scoped = current_deadline()
+        if scoped is not None:
+            # yolo5 doesn't start the job once nobody waits for it anymore
+            params["timeout"] = round(scoped.remaining(), 1)
+
+        status, body = call(YOLO5_ENDPOINT, self.request, "POST", "/jobs", **params)
+        if status not in (200, 202):
+            raise RuntimeError(f"HTTP error occurred: {status}\n{body}")
+        return body["job_id"]
+
+    def predict(self, image_name) -> dict:
+        """
+        Raises DeadlineExceeded if the result isn't ready in time, CircuitOpenError if yolo5 is failing and RuntimeError
+        if the prediction failed
+
+        :return: The prediction's summary
+        """
+        with deadline(self.timeout) as scoped:
+            job_id = self.submit(image_name)
+            logger.info(f"Prediction of {image_name} submitted as job {job_id}")
+
+            for delay in poll_delays(self.poll_initial, self.poll_max):
+                if scoped.remaining() <= delay:
+                    raise DeadlineExceeded(f"The prediction of {image_name} took longer than {self.timeout} seconds")
+                time.sleep(delay)
+
+                status, body = call(YOLO5_ENDPOINT, self.request, "GET", f"/jobs/{job_id}/result")
+                if status == 200:
+                    return body
+                if is_unknown_job(body):
+                    logger.warning(f"Job {job_id} of {image_name} was not found, submitting it again")
+                    job_id = self.submit(image_name)
+                elif status != 202:
+                    raise job_error(image_name, status, body)
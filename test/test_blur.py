@@ -0,0 +1,62 @@
+import unittest
+import random
+from polybot.python.img_proc import Img
+import os
+
+img_path = 'polybot/test/beatles.jpeg' if '/polybot/test' not in os.getcwd() else 'beatles.jpeg'
+
+
+def naive_blur(data, blur_level):
+    result = []
+    for i in range(len(data) - blur_level + 1):
+        row_result = []
+        for j in range(len(data[0]) - blur_level + 1):
+            sub_matrix = [row[j:j + blur_level] for row in data[i:i + blur_level]]
+            row_result.append(sum(sum(sub_row) for sub_row in sub_matrix) // blur_level ** 2)
+        result.append(row_result)
+    return result
+
+
+class TestImgBlur(unittest.TestCase):
+
+    def setUp(self):
+        self.img = Img(img_path)
+        self.original_dimension = (len(self.img.data), len(self.img.data[0]))
+
+    def test_blur_dimension(self):
+        blur_level = 16
+        self.img.blur(blur_level)
+        actual_dimension = (len(self.img.data), len(self.img.data[0]))
+        expected_dimension = (self.original_dimension[0] - blur_level + 1, self.original_dimension[1] - blur_level + 1)
+        self.assertEqual(expected_dimension, actual_dimension)
+
+    def test_blur_matches_naive_average(self):
+        data = [[random.randint(0, 255) for _ in range(23)] for _ in range(17)]
+
+        for blur_level in [1, 2, 5, 17]:
+            self.img.data = data
+            self.img.blur(blur_level)
+            self.assertEqual(naive_blur(data, blur_level), self.img.data)
+
+    def test_blur_of_image_matches_naive_average(self):
+        data = [row[:40] for row in self.img.data[:40]]
+        self.img.data = data
+        self.img.blur(7)
+
+        expected = naive_blur(data, 7)
+        mismatches = sum(pixel1 != pixel2 for row1, row2 in zip(expected, self.img.data) for pixel1, pixel2 in zip(row1, row2))
+        self.assertLessEqual(mismatches, 1)
+
+    def test_blur_level_from_caption(self):
+        self.img.blur("10")
+        self.assertEqual(len(self.img.data), self.original_dimension[0] - 9)
+
+    def test_invalid_blur_level(self):
+        with self.assertRaises(ValueError):
+            self.img.blur(0)
+        with self.assertRaises(ValueError):
+            self.img.blur("abc")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import sys
+import os
+
+# The bot's modules import each other as top level modules, the way uWSGI loads them
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python')))
+from captions import parse_caption, is_prediction, PipelineCommand, ConcatCommand, PredictCommand
+from img_proc import Transform
+
+
+class TestCaptions(unittest.TestCase):
+
+    def test_pipeline(self):
+        command = parse_caption(" Blur 5 |  rotate anti-clockwise 180|segment ")
+
+        self.assertIsInstance(command, PipelineCommand)
+        self.assertEqual(
+            [("blur_segment", (5,)), ("transform", (Transform(2),))],
+            [tuple(step) for step in command.pipeline.optimized()]
+        )
+
+    def test_defaults(self):
+        command = parse_caption("rotate | salt and pepper | blur")
+
+        self.assertEqual(
+            [("transform", Transform(1)), ("salt_n_pepper", 0.05), ("blur", 16)],
+            [(step.operation, step.params[0]) for step in command.pipeline.steps]
+        )
+
+    def test_rotate_direction_and_degrees_in_either_order(self):
+        for direction in ["clockwise", "anti-clockwise"]:
+            before = parse_caption(f"rotate {direction} 90").pipeline.steps
+            after = parse_caption(f"rotate 90 {direction}").pipeline.steps
+            self.assertEqual([tuple(step) for step in before], [tuple(step) for step in after])
+
+        self.assertNotEqual(
+            [tuple(step) for step in parse_caption("rotate 90 clockwise").pipeline.steps],
+            [tuple(step) for step in parse_caption("rotate 90 anti-clockwise").pipeline.steps]
+        )
+
+    def test_concat(self):
+        self.assertEqual(ConcatCommand("horizontal", "right-to-left"), parse_caption("concat"))
+        self.assertEqual(ConcatCommand("vertical", "top-to-bottom"), parse_caption("concat vertical"))
+        self.assertEqual(ConcatCommand("vertical", "bottom-to-top"), parse_caption("Concat bottom-to-top"))
+
+        with self.assertRaises(ValueError):
+            parse_caption("concat horizontal top-down")
+
+    def test_predict(self):
+        self.assertEqual(PredictCommand(), parse_caption("Predict "))
+        self.assertTrue(is_prediction(" predict"))
+        self.assertFalse(is_prediction("predict 5"))
+
+    def test_full_quality(self):
+        self.assertEqual(PredictCommand(True), parse_caption("predict  Full Quality"))
+        self.assertTrue(is_prediction("predict full quality"))
+
+        for caption in ["contour | segment | full quality", "contour | segment full quality"]:
+            command = parse_caption(caption)
+            self.assertTrue(command.full_quality, caption)
+            self.assertEqual(["contour", "segment"], [step.operation for step in command.pipeline.steps])
+
+        self.assertFalse(parse_caption("contour").full_quality)
+
+        with self.assertRaises(ValueError):
+            parse_caption("full quality | contour")
+
+    def test_invalid_captions(self):
+        self.assertIsNone(parse_caption("  "))
+
+        for caption in ["bogus", "blur five", "rotate 45", "blur 5 | sharpen", "blur |", "rotate sideways"]:
+            with self.assertRaises(ValueError, msg=caption):
+                parse_caption(caption)
+
+
+if __name__ == '__main__':
+    unittest.main()
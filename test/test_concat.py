@@ -1,5 +1,8 @@
 import unittest
-from polybot.python.img_proc import Img
+import tempfile
+import numpy as np
+from PIL import Image
+from polybot.python.img_proc import Img, decode_bytes_per_pixel
 import os
 
 img_path = 'polybot/test/beatles.jpeg' if '/polybot/test' not in os.getcwd() else 'beatles.jpeg'
@@ -36,6 +39,54 @@ class TestImgConcat(unittest.TestCase):
 
         self.assertEqual(left_half, right_half)
 
+    def test_vertical_concat(self):
+        top = [[1, 2, 3], [4, 5, 6]]
+        bottom = [[7, 8, 9]]
+
+        img1 = Img(img_path)
+        img2 = Img(img_path)
+
+        img1.data = bottom
+        img2.data = top
+        img1.concat(img2, "vertical", "top-to-bottom")
+        self.assertEqual(top + bottom, img1.data)
+
+        img1.data = top
+        img2.data = bottom
+        img1.concat(img2, "vertical", "bottom-to-top")
+        self.assertEqual(top + bottom, img1.data)
+
+    def test_concat_many_files(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = []
+            for index, shape in enumerate([(2, 3), (2, 1), (2, 2)]):
+                paths.append(os.path.join(tmp_dir, f'{index}.png'))
+                Image.fromarray(np.full(shape, index * 10, np.uint8)).save(paths[-1])
+
+            img = Img.from_concat(paths)
+            self.assertEqual([[0, 0, 0, 10, 20, 20]] * 2, img.data)
+
+            img = Img.from_concat(paths, sides="left-to-right")
+            self.assertEqual([[20, 20, 10, 0, 0, 0]] * 2, img.data)
+
+            with self.assertRaises(RuntimeError):
+                Img.from_concat(paths, "vertical")
+
+    def test_concat_many_matches_concat(self):
+        for direction, sides in [("horizontal", "right-to-left"), ("horizontal", "left-to-right"), ("vertical", "top-to-bottom"), ("vertical", "bottom-to-top")]:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                other_path = os.path.join(tmp_dir, 'other.png')
+                with Image.open(img_path) as image:
+                    image.transpose(Image.Transpose.FLIP_LEFT_RIGHT).save(other_path)
+
+                expected = Img(img_path)
+                expected.concat(Img(other_path), direction, sides)
+
+                # With a budget only fitting the decoding of each image, every image is decoded into the result band by band
+                for memory_budget in [None, image.width * image.height * decode_bytes_per_pixel(image.mode)]:
+                    img = Img.from_concat([img_path, other_path], direction, sides, memory_budget=memory_budget)
+                    self.assertTrue(np.array_equal(np.asarray(expected.data), np.asarray(img.data)), (direction, sides))
+
 
 if __name__ == '__main__':
     unittest.main()
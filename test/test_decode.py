@@ -0,0 +1,50 @@
+import unittest
+import tempfile
+import io
+import numpy as np
+from PIL import Image
+from polybot.python.img_proc import Img, rgb2gray
+import os
+
+img_path = 'polybot/test/beatles.jpeg' if '/polybot/test' not in os.getcwd() else 'beatles.jpeg'
+
+
+class TestImgDecode(unittest.TestCase):
+
+    def setUp(self):
+        self.img = Img(img_path)
+
+    def test_grayscale_weighting(self):
+        with Image.open(img_path) as image:
+            rgb = np.asarray(image.convert("RGB"), dtype=np.float64)
+
+        expected = np.round(rgb2gray(rgb))
+        self.assertEqual(np.uint8, self.img._pixels.dtype)
+        self.assertTrue(np.array_equal(expected, self.img._pixels))
+
+    def test_png_decodes_to_8_bit(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            png_path = os.path.join(tmp_dir, 'beatles.png')
+            with Image.open(img_path) as image:
+                image.convert("RGBA").save(png_path)
+
+            png_img = Img(png_path)
+
+        self.assertEqual(self.img.data, png_img.data)
+
+    def test_draft_decode(self):
+        small_img = Img(img_path, max_size=(300, 300))
+
+        self.assertEqual((330, 330), (len(small_img.data), len(small_img.data[0])))
+
+    def test_decode_from_file_object(self):
+        with open(img_path, 'rb') as file:
+            img = Img(io.BytesIO(file.read()))
+
+        self.assertIsNone(img.path)
+        self.assertEqual("JPEG", img.output_format)
+        self.assertEqual(self.img.data, img.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
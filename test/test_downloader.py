@@ -0,0 +1,95 @@
+import unittest
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from unittest.mock import patch
+import requests
+from polybot.python.downloader import FileDownloader, choose_photo_size
+
+PHOTO = bytes(range(256)) * 1024
+
+
+class PhotoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if not self.path.endswith("/photos/file_1.jpg"):
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(PHOTO)))
+        self.end_headers()
+        self.wfile.write(PHOTO)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFileDownloader(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(("127.0.0.1", 0), PhotoHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        patcher = patch("polybot.python.downloader.apihelper.FILE_URL", f"http://127.0.0.1:{self.server.server_port}/file/bot{{0}}/{{1}}")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_download_is_spooled(self):
+        downloader = FileDownloader(spool_bytes=1024)
+        self.addCleanup(downloader.session.close)
+
+        for _ in range(2):
+            with downloader.download("token", "photos/file_1.jpg") as photo:
+                self.assertEqual(PHOTO, photo.read())
+
+        stats = downloader.stats
+        self.assertEqual(2, stats["downloads"])
+        self.assertEqual(2 * len(PHOTO), stats["bytes"])
+
+    def test_size_cap(self):
+        downloader = FileDownloader(max_bytes=len(PHOTO) - 1)
+        self.addCleanup(downloader.session.close)
+
+        with self.assertRaises(ValueError):
+            downloader.download("token", "photos/file_1.jpg")
+        self.assertEqual(1, downloader.stats["failures"])
+
+    def test_missing_file(self):
+        downloader = FileDownloader()
+        self.addCleanup(downloader.session.close)
+
+        with self.assertRaises(requests.HTTPError):
+            downloader.download("token", "photos/file_2.jpg")
+
+
+
+class TestChoosePhotoSize(unittest.TestCase):
+
+    sizes = [
+        {'file_id': 's', 'width': 90, 'height': 60},
+        {'file_id': 'm', 'width': 320, 'height': 213},
+        {'file_id': 'x', 'width': 800, 'height': 533},
+        {'file_id': 'y', 'width': 1280, 'height': 853},
+    ]
+
+    def test_smallest_adequate_size(self):
+        self.assertEqual('x', choose_photo_size(self.sizes, 640)['file_id'])
+        self.assertEqual('x', choose_photo_size(self.sizes, 800)['file_id'])
+        self.assertEqual('s', choose_photo_size(self.sizes, 90)['file_id'])
+
+    def test_largest_size(self):
+        self.assertEqual('y', choose_photo_size(self.sizes)['file_id'])
+        self.assertEqual('y', choose_photo_size(self.sizes, 4096)['file_id'])
+        self.assertEqual('y', choose_photo_size(list(reversed(self.sizes)))['file_id'])
+
+
+if __name__ == '__main__':
+    unittest.main()
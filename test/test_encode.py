@@ -0,0 +1,64 @@
+import unittest
+import io
+import numpy as np
+from PIL import Image
+from polybot.python.img_proc import Img, Pipeline
+import os
+
+img_path = 'polybot/test/beatles.jpeg' if '/polybot/test' not in os.getcwd() else 'beatles.jpeg'
+
+
+class TestImgEncode(unittest.TestCase):
+
+    def setUp(self):
+        self.img = Img(img_path)
+
+    def decode(self, encoded):
+        with Image.open(io.BytesIO(encoded.data)) as image:
+            self.assertEqual(encoded.format, image.format)
+            self.assertEqual("L", image.mode)
+            return np.array(image)
+
+    def test_photo_stays_jpeg(self):
+        self.img.rotate()
+        encoded = self.img.encode()
+
+        self.assertEqual("JPEG", encoded.format)
+        self.assertEqual(self.img._pixels.shape, self.decode(encoded).shape)
+        self.assertGreaterEqual(encoded.seconds, 0)
+
+    def test_format_follows_operation(self):
+        self.img.segment()
+        encoded = self.img.encode()
+        self.assertEqual("PNG", encoded.format)
+        # PNG is lossless
+        self.assertTrue(np.array_equal(self.img._pixels, self.decode(encoded)))
+
+        self.img.blur()
+        self.assertEqual("JPEG", self.img.encode().format)
+
+        Pipeline().blur(4).segment().run(self.img)
+        self.assertEqual("PNG", self.img.encode().format)
+
+    def test_contour_is_stretched_to_full_range(self):
+        self.img.contour()
+        pixels = self.decode(self.img.encode())
+
+        self.assertEqual(0, pixels.min())
+        self.assertEqual(255, pixels.max())
+
+    def test_quality_tiers(self):
+        low = self.img.encode(quality="low")
+        high = self.img.encode(quality="high")
+
+        self.assertLess(len(low.data), len(high.data))
+        with self.assertRaises(ValueError):
+            self.img.encode(quality="best")
+
+    def test_explicit_format(self):
+        self.assertEqual("PNG", self.img.encode("png").format)
+        self.assertEqual("JPEG", self.img.encode("jpg").format)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import tempfile
+import time
+import os
+from unittest.mock import patch
+from polybot.python.file_id_cache import FileIdCache
+
+
+class TestFileIdCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'file_ids.sqlite3')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_file_id_is_remembered(self):
+        cache = FileIdCache(self.path)
+        digest = cache.digest(b"image")
+
+        self.assertIsNone(cache.get(digest))
+        cache.put(digest, "file-1")
+        self.assertEqual("file-1", cache.get(digest))
+
+        # It's persistent
+        self.assertEqual("file-1", FileIdCache(self.path).get(digest))
+
+        cache.forget(digest)
+        self.assertIsNone(cache.get(digest))
+
+    def test_connection_is_opened_by_the_first_call(self):
+        # It's created before uWSGI forks and a SQLite connection must not be used across a fork
+        cache = FileIdCache(self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+        cache.put("digest", "file-1")
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_entries_expire(self):
+        cache = FileIdCache(self.path, ttl=60)
+        cache.put("digest", "file-1")
+
+        with patch("polybot.python.file_id_cache.time.time", return_value=time.time() + 61):
+            self.assertIsNone(cache.get("digest"))
+
+    def test_size_is_bounded(self):
+        cache = FileIdCache(self.path, max_size=2)
+
+        for index in range(3):
+            with patch("polybot.python.file_id_cache.time.time", return_value=time.time() + index):
+                cache.put(f"digest-{index}", f"file-{index}")
+
+        self.assertIsNone(cache.get("digest-0"))
+        self.assertEqual("file-1", cache.get("digest-1"))
+        self.assertEqual("file-2", cache.get("digest-2"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import unittest
+import threading
+import tempfile
+import queue
+import time
+import os
+from polybot.python.ingest_queue import IngestQueue
+
+
+class TestIngestQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.path = os.path.join(self.tmp_dir.name, 'ingest.sqlite3')
+
+    def ingest_queue(self, **kwargs):
+        ingest_queue = IngestQueue(self.path, poll_interval=0.05, **kwargs)
+        self.addCleanup(ingest_queue.close)
+        return ingest_queue
+
+    def test_concurrent_appends_are_group_committed(self):
+        ingest_queue = self.ingest_queue()
+        results = []
+
+        def append(key):
+            for index in range(25):
+                results.append(ingest_queue.append(key, {"key": key, "index": index}))
+
+        threads = [threading.Thread(target=append, args=(key,)) for key in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = ingest_queue.stats
+        self.assertEqual([True] * 200, results)
+        self.assertEqual(200, stats["appended"])
+        self.assertEqual(200, stats["depth"])
+        self.assertLessEqual(stats["commits"], 200)
+
+    def test_full_queue_rejects(self):
+        ingest_queue = self.ingest_queue(max_size=2)
+
+        self.assertTrue(ingest_queue.append(1, {}))
+        self.assertTrue(ingest_queue.append(1, {}))
+        self.assertFalse(ingest_queue.append(1, {}))
+        self.assertEqual(1, ingest_queue.stats["rejected"])
+
+    def test_updates_of_a_key_are_dispatched_in_order_one_at_a_time(self):
+        ingest_queue = self.ingest_queue()
+        dispatched = queue.Queue()
+
+        for index in range(3):
+            ingest_queue.append("a", index)
+        ingest_queue.append("b", 0)
+        ingest_queue.start(lambda update: dispatched.put(update) or True)
+
+        # Only the oldest update of every key is out until it's acknowledged
+        first = [dispatched.get(timeout=5), dispatched.get(timeout=5)]
+        self.assertEqual([("a", 0), ("b", 0)], sorted((update.key, update.payload) for update in first))
+        with self.assertRaises(queue.Empty):
+            dispatched.get(timeout=0.2)
+
+        for index in range(1, 3):
+            ingest_queue.ack(next(update.id for update in first if update.key == "a"))
+            first = [dispatched.get(timeout=5)]
+            self.assertEqual(("a", index), (first[0].key, first[0].payload))
+
+    def test_unacknowledged_update_is_redelivered(self):
+        # The process which leased the update was restarted before acknowledging it
+        crashed = self.ingest_queue(lease_seconds=0.2)
+        crashed.append(1, {"message_id": 1})
+        leased = queue.Queue()
+        crashed.start(lambda update: leased.put(update) or True)
+        self.assertEqual(1, leased.get(timeout=5).attempts)
+        crashed.close()
+
+        dispatched = queue.Queue()
+        self.ingest_queue(lease_seconds=0.2).start(lambda update: dispatched.put(update) or True)
+
+        update = dispatched.get(timeout=5)
+        self.assertEqual({"message_id": 1}, update.payload)
+        self.assertEqual(2, update.attempts)
+
+    def test_lease_is_renewed_while_the_update_is_handled(self):
+        ingest_queue = self.ingest_queue(lease_seconds=0.3)
+        ingest_queue.append(1, "slow")
+        dispatched = queue.Queue()
+
+        def handle(update):
+            # Waits for its worker and is handled for several times the lease
+            time.sleep(1)
+            ingest_queue.ack(update.id)
+
+        def dispatch(update):
+            dispatched.put(update.payload)
+            threading.Thread(target=handle, args=(update,)).start()
+            return True
+
+        ingest_queue.start(dispatch)
+        # Another process drains the same queue
+        self.ingest_queue(lease_seconds=0.3).start(dispatch)
+
+        self.assertEqual("slow", dispatched.get(timeout=5))
+        with self.assertRaises(queue.Empty):
+            dispatched.get(timeout=1.5)
+        self.assertEqual(0, ingest_queue.stats["depth"])
+
+    def test_queued_media_group(self):
+        ingest_queue = self.ingest_queue()
+        ingest_queue.append(5, {"message_id": 1, "media_group_id": "g1"})
+        ingest_queue.append(6, {"message_id": 2})
+
+        self.assertTrue(ingest_queue.has_media_group(5, "g1"))
+        self.assertFalse(ingest_queue.has_media_group(5, "g2"))
+        self.assertFalse(ingest_queue.has_media_group(6, "g1"))
+
+    def test_busy_dispatch_keeps_the_update(self):
+        ingest_queue = self.ingest_queue()
+        ingest_queue.append(1, "update")
+        attempts = queue.Queue()
+        ingest_queue.start(lambda update: attempts.put(update.attempts) or attempts.qsize() > 2)
+
+        # Turning an update away doesn't use up its attempts
+        self.assertEqual([1, 1, 1], [attempts.get(timeout=5) for _ in range(3)])
+
+    def test_update_is_dropped_after_max_attempts(self):
+        ingest_queue = self.ingest_queue(max_attempts=2, lease_seconds=0.1)
+        ingest_queue.append(1, "failing")
+        ingest_queue.append(1, "next")
+        dispatched = queue.Queue()
+
+        def dispatch(update):
+            dispatched.put(update.payload)
+            if update.payload == "failing":
+                ingest_queue.retry(update)
+            return True
+
+        ingest_queue.start(dispatch)
+
+        self.assertEqual(["failing", "failing", "next"], [dispatched.get(timeout=5) for _ in range(3)])
+        self.assertEqual(1, ingest_queue.stats["dropped"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import unittest
+import io
+import tempfile
+import threading
+import fcntl
+import time
+import sys
+import os
+from pathlib import Path
+
+# The bot's modules import each other as top level modules, the way uWSGI loads them
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python')))
+from media_group_aggregator import MediaGroupAggregator
+
+
+class TestMediaGroupAggregator(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.spool_dir = os.path.join(self.tmp_dir.name, 'spool')
+        self.done = threading.Event()
+        self.groups = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def handler(self, chat_id, paths, caption):
+        self.groups.append((chat_id, [Path(path).read_text() for path in paths], caption))
+        self.done.set()
+
+    def aggregator(self, dispatch=None, pending=None, **kwargs):
+        aggregator = MediaGroupAggregator(self.spool_dir, **kwargs)
+        aggregator.start(self.handler, dispatch, pending)
+        return aggregator
+
+    def photo(self, content):
+        return io.BytesIO(content.encode())
+
+    def test_group_is_handled_once_it_is_quiet(self):
+        aggregator = self.aggregator(quiet_window=0.2)
+
+        # Updates of a group may come from different workers or processes, sharing the spool directory
+        other = self.aggregator(quiet_window=0.2)
+        aggregator.add(5, 'g1', 12, self.photo('second'), '.jpg', '')
+        other.add(5, 'g1', 11, self.photo('first'), '.jpg', 'concat vertical')
+        aggregator.add(5, 'g1', 13, self.photo('third'), '.jpg', '')
+
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual([(5, ['first', 'second', 'third'], 'concat vertical')], self.groups)
+
+        # The photos are removed once the handler returned
+        deadline = time.monotonic() + 5
+        while os.listdir(self.spool_dir) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([], os.listdir(self.spool_dir))
+
+    def test_group_waits_for_its_queued_photos(self):
+        queued = ['second']
+
+        def pending(chat_id, media_group_id):
+            return bool(queued)
+
+        aggregator = self.aggregator(pending=pending, quiet_window=0.1)
+        aggregator.add(5, 'g1', 1, self.photo('first'), '.jpg', 'concat')
+
+        # The second photo waits in the ingest queue for longer than the quiet window
+        self.assertFalse(self.done.wait(0.5))
+        aggregator.add(5, 'g1', 2, self.photo(queued.pop()), '.jpg', '')
+
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual([(5, ['first', 'second'], 'concat')], self.groups)
+
+    def test_full_group_is_handled_straight_away(self):
+        aggregator = self.aggregator(quiet_window=60, max_parts=2)
+        aggregator.add(5, 'g1', 1, self.photo('first'), '.jpg', 'concat')
+        self.assertEqual([], self.groups)
+
+        aggregator.add(5, 'g1', 2, self.photo('second'), '.jpg', '')
+        self.assertEqual([(5, ['first', 'second'], 'concat')], self.groups)
+
+    def test_group_is_dispatched_to_the_chat_worker(self):
+        dispatched = []
+
+        def dispatch(chat_id, fn, *args):
+            dispatched.append(chat_id)
+            if len(dispatched) == 1:
+                # The worker is full, the group is offered again later
+                return False
+            threading.Thread(target=fn, args=args).start()
+            return True
+
+        aggregator = self.aggregator(dispatch, quiet_window=0.1, max_parts=2)
+        aggregator.add(5, 'g1', 1, self.photo('first'), '.jpg', 'concat')
+        aggregator.add(5, 'g1', 2, self.photo('second'), '.jpg', '')
+
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual([5, 5], dispatched)
+        self.assertEqual([(5, ['first', 'second'], 'concat')], self.groups)
+
+    def test_pending_groups_are_picked_up_after_a_restart(self):
+        # Spooled by a process which was restarted before the group was complete
+        MediaGroupAggregator(self.spool_dir, quiet_window=60).add(5, 'g1', 1, self.photo('first'), '.jpg', 'concat')
+
+        self.aggregator(quiet_window=0.1)
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual([(5, ['first'], 'concat')], self.groups)
+
+    def test_claimed_groups_are_picked_up_once_their_claimer_is_gone(self):
+        for name in ['g1.100.1.claimed', 'g2.101.1.claimed']:
+            os.makedirs(os.path.join(self.spool_dir, name))
+            Path(self.spool_dir, name, 'chat').write_text('5')
+            Path(self.spool_dir, name, '000000000001.jpg').write_text(name)
+
+        # The claimer of g2 is still handling it
+        lock = open(os.path.join(self.spool_dir, 'g2.101.1.claimed', '.lock'), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        self.addCleanup(lock.close)
+
+        self.aggregator()
+        self.assertEqual([(5, ['g1.100.1.claimed'], '')], self.groups)
+        self.assertEqual(['g2.101.1.claimed'], os.listdir(self.spool_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+from unittest.mock import patch
+import numpy as np
+from polybot.python.img_proc import Img, Pipeline
+import os
+
+img_path = 'polybot/test/beatles.jpeg' if '/polybot/test' not in os.getcwd() else 'beatles.jpeg'
+
+
+@patch('polybot.python.img_proc.PARALLEL_MIN_PIXELS', 0)
+class TestImgParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.img = Img(img_path, workers=3)
+        self.expected_img = Img(img_path, workers=0)
+
+    def test_blur_matches_single_process(self):
+        self.img.blur(12)
+        self.expected_img.blur(12)
+
+        self.assertIsInstance(self.img._pixels, np.memmap)
+        self.assertEqual(self.expected_img.data, self.img.data)
+
+    def test_pipeline_matches_single_process(self):
+        pipeline = Pipeline().rotate().contour().segment().blur(3)
+        pipeline.run(self.img)
+        pipeline.run(self.expected_img)
+
+        self.assertEqual(self.expected_img.data, self.img.data)
+
+    def test_bands_within_memory_budget(self):
+        # Decoded in memory, only the operations are run in bands
+        img = Img(img_path, memory_budget=None, workers=2)
+        img.memory_budget = 256 * 1024
+        img.blur(5)
+        img.segment()
+
+        self.expected_img.blur(5)
+        self.expected_img.segment()
+
+        self.assertEqual(self.expected_img.data, img.data)
+
+    def test_small_images_stay_in_process(self):
+        with patch('polybot.python.img_proc.PARALLEL_MIN_PIXELS', 10 ** 9):
+            self.img.blur(3)
+            self.assertNotIsInstance(self.img._pixels, np.memmap)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+from polybot.python.img_proc import Img, Pipeline, Transform
+import os
+
+img_path = 'polybot/test/beatles.jpeg' if '/polybot/test' not in os.getcwd() else 'beatles.jpeg'
+
+
+class TestImgPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.img = Img(img_path)
+        self.expected_img = Img(img_path)
+
+    def test_pipeline_matches_eager_operations(self):
+        Pipeline().blur(5).rotate(deg=180).segment().run(self.img)
+
+        self.expected_img.blur(5)
+        self.expected_img.rotate(deg=180)
+        self.expected_img.segment()
+
+        self.assertEqual(self.expected_img.data, self.img.data)
+
+    def test_contour_segment_matches_eager_operations(self):
+        Pipeline().rotate().contour().rotate("anti-clockwise").segment().segment().run(self.img)
+
+        self.expected_img.rotate()
+        self.expected_img.contour()
+        self.expected_img.rotate("anti-clockwise")
+        self.expected_img.segment()
+
+        self.assertEqual(self.expected_img.data, self.img.data)
+
+    def test_rotations_are_folded(self):
+        steps = Pipeline().rotate(deg=90).rotate(deg=180).flip().flip().optimized()
+        self.assertEqual([("transform", (Transform(3),))], steps)
+
+        steps = Pipeline().rotate(deg=180).rotate(deg=180).optimized()
+        self.assertEqual([], steps)
+
+    def test_key_is_normalized(self):
+        self.assertEqual(Pipeline().rotate(deg=180).key, Pipeline().rotate().rotate().key)
+        self.assertEqual(Pipeline().blur(3).segment().key, Pipeline().blur("3").segment().segment().key)
+        self.assertNotEqual(Pipeline().blur(3).key, Pipeline().blur(4).key)
+
+    def test_random_operations_are_not_cacheable(self):
+        self.assertTrue(Pipeline().blur(3).rotate().segment().cacheable)
+        self.assertFalse(Pipeline().rotate().salt_n_pepper(0.1).cacheable)
+
+    def test_segment_is_moved_and_fused(self):
+        steps = Pipeline().blur(5).rotate(deg=180).salt_n_pepper(0.1).segment().optimized()
+        operations = [step.operation for step in steps]
+        self.assertEqual(["blur_segment", "transform", "salt_n_pepper"], operations)
+
+        steps = Pipeline().segment().rotate().segment().optimized()
+        operations = [step.operation for step in steps]
+        self.assertEqual(["segment", "transform"], operations)
+
+    def test_invalid_parameters_fail_when_building(self):
+        with self.assertRaises(ValueError):
+            Pipeline().rotate(deg=45)
+        with self.assertRaises(ValueError):
+            Pipeline().blur("strong")
+
+
+if __name__ == '__main__':
+    unittest.main()
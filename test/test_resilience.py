@@ -0,0 +1,132 @@
+import unittest
+import asyncio
+import time
+import os
+from unittest.mock import patch
+from polybot.python import resilience
+from polybot.python.resilience import (call, call_async, deadline, backoff, breaker, breaker_stats, is_transient,
+                                       CircuitBreaker, CircuitOpenError, DeadlineExceeded, Unavailable, OPEN, CLOSED)
+
+
+class Flaky:
+
+    def __init__(self, failures, exception=ConnectionError("refused")):
+        self.failures = failures
+        self.exception = exception
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.exception
+        return "ok"
+
+
+@patch.object(resilience, "backoff", lambda retry: 0.01)
+class TestResilience(unittest.TestCase):
+
+    def test_transient_failures_are_retried(self):
+        flaky = Flaky(2)
+        self.assertEqual("ok", call("retried", flaky, attempts=3))
+        self.assertEqual(3, flaky.calls)
+        self.assertEqual(CLOSED, breaker_stats()["retried"]["state"])
+
+    def test_other_failures_are_not_retried(self):
+        flaky = Flaky(1, ValueError("bad request"))
+        with self.assertRaises(ValueError):
+            call("not-retried", flaky, attempts=3)
+        self.assertEqual(1, flaky.calls)
+        self.assertEqual(0, breaker("not-retried").failures)
+
+    def test_breaker_fails_fast(self):
+        breaker("failing").reset_timeout = 0.2
+        flaky = Flaky(100)
+        with self.assertRaises(ConnectionError):
+            call("failing", flaky, attempts=3)
+        # The 5th failure in a row opens it, the retry after it isn't made
+        with self.assertRaises(CircuitOpenError):
+            call("failing", flaky, attempts=3)
+        self.assertEqual(5, flaky.calls)
+
+        with self.assertRaises(CircuitOpenError):
+            call("failing", flaky)
+        self.assertEqual(5, flaky.calls)
+        self.assertEqual(OPEN, breaker("failing").state)
+
+        # A single probe is let through once the reset timeout passed, and closes it again
+        time.sleep(0.2)
+        flaky.failures = 0
+        self.assertEqual("ok", call("failing", flaky))
+        self.assertEqual(CLOSED, breaker("failing").state)
+
+    def test_retries_stop_at_the_deadline(self):
+        flaky = Flaky(100, Unavailable("busy", retry_after=0.5))
+        start = time.monotonic()
+        with deadline(0.3):
+            with self.assertRaises(Unavailable):
+                call("deadline", flaky, attempts=5)
+        # Waiting retry_after would have passed the deadline
+        self.assertEqual(1, flaky.calls)
+        self.assertLess(time.monotonic() - start, 0.3)
+
+        with deadline(0):
+            with self.assertRaises(DeadlineExceeded):
+                call("deadline", flaky)
+        self.assertEqual(1, flaky.calls)
+
+    def test_nested_deadline_is_never_longer(self):
+        with deadline(1) as outer:
+            with deadline(10) as inner:
+                self.assertIs(outer, inner)
+
+    def test_call_async(self):
+        flaky = Flaky(1)
+
+        async def request():
+            return flaky()
+
+        self.assertEqual("ok", asyncio.run(call_async("async", request)))
+        self.assertEqual(2, flaky.calls)
+
+
+class TestBackoff(unittest.TestCase):
+
+    def test_backoff_is_jittered_and_capped(self):
+        delays = [backoff(3, base=0.5, maximum=10) for _ in range(100)]
+        self.assertTrue(all(0 <= delay <= 4 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+        self.assertTrue(all(backoff(20, base=0.5, maximum=10) <= 10 for _ in range(100)))
+
+    def test_is_transient(self):
+        self.assertTrue(is_transient(ConnectionResetError()))
+        self.assertTrue(is_transient(Unavailable("busy")))
+        self.assertFalse(is_transient(ValueError()))
+
+        class ClientError(Exception):
+            def __init__(self, status):
+                self.response = {"ResponseMetadata": {"HTTPStatusCode": status}}
+
+        self.assertTrue(is_transient(ClientError(503)))
+        self.assertFalse(is_transient(ClientError(404)))
+
+    def test_half_open_allows_a_single_probe(self):
+        circuit = CircuitBreaker("probe", failures=1, reset_timeout=0)
+        circuit.record_failure()
+        self.assertTrue(circuit.allow())
+        self.assertFalse(circuit.allow())
+        circuit.record_failure()
+        self.assertEqual(OPEN, circuit.state)
+
+
+class TestCopies(unittest.TestCase):
+
+    def test_copies_are_identical(self):
+        # The bot and yolo5 images are built from their own directories, each with its own copy of the module
+        polybot_dir = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+        with open(os.path.join(polybot_dir, 'python', 'resilience.py'), 'rb') as polybot, \
+                open(os.path.join(polybot_dir, '..', 'yolo5', 'resilience.py'), 'rb') as yolo5:
+            self.assertEqual(polybot.read(), yolo5.read(), "polybot/python/resilience.py and yolo5/resilience.py differ")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+import tempfile
+import os
+from polybot.python.result_cache import ResultCache
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.directory = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_hits_and_misses(self):
+        cache = ResultCache(memory_bytes=1024, disk_bytes=1024, directory=self.directory)
+
+        self.assertIsNone(cache.get(("photo", "blur(5,)")))
+        cache.put(("photo", "blur(5,)"), b"result")
+        self.assertEqual(b"result", cache.get(("photo", "blur(5,)")))
+        self.assertIsNone(cache.get(("photo", "blur(6,)")))
+
+        stats = cache.stats
+        self.assertEqual(1, stats["hits"])
+        self.assertEqual(1, stats["memory_hits"])
+        self.assertEqual(2, stats["misses"])
+
+    def test_memory_tier_evicts_least_recently_used(self):
+        cache = ResultCache(memory_bytes=10, disk_bytes=0, directory=self.directory)
+
+        cache.put("a", b"aaaa")
+        cache.put("b", b"bbbb")
+        cache.get("a")
+        cache.put("c", b"cccc")
+
+        self.assertEqual(b"aaaa", cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(b"cccc", cache.get("c"))
+        self.assertLessEqual(cache.stats["memory_bytes"], 10)
+
+    def test_disk_tier_is_shared_and_capped(self):
+        cache = ResultCache(memory_bytes=0, disk_bytes=10, directory=self.directory)
+        cache.put("a", b"aaaa")
+
+        # Another process (or a restart) sees the results on disk
+        other = ResultCache(memory_bytes=1024, disk_bytes=10, directory=self.directory)
+        self.assertEqual(b"aaaa", other.get("a"))
+        self.assertEqual(1, other.stats["disk_hits"])
+
+        old = os.path.join(self.directory, ResultCache.digest("a"))
+        os.utime(old, (0, 0))
+        cache.put("b", b"bbbb")
+        cache.put("c", b"cccc")
+
+        self.assertFalse(os.path.exists(old))
+        self.assertLessEqual(sum(os.path.getsize(os.path.join(self.directory, name)) for name in os.listdir(self.directory)), 10)
+        self.assertEqual(b"cccc", cache.get("c"))
+
+    def test_rewriting_a_result_keeps_its_size(self):
+        cache = ResultCache(memory_bytes=0, disk_bytes=100, directory=self.directory)
+        for _ in range(5):
+            cache.put("a", b"aaaa")
+
+        self.assertEqual(4, cache.stats["disk_bytes"])
+        self.assertEqual(b"aaaa", cache.get("a"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -25,6 +25,35 @@ class TestImgConcat(unittest.TestCase):
 
         self.assertEqual(expected_img, self.img.data)
 
+    def test_composed_rotations(self):
+        other_img = Img(img_path)
+
+        self.img.rotate("clockwise", 270)
+        other_img.rotate("anti-clockwise", 90)
+        self.assertEqual(other_img.data, self.img.data)
+
+        self.img.rotate("clockwise", 180)
+        self.img.flip()
+        self.img.flip("vertical")
+        other_img.rotate("anti-clockwise", 180)
+        other_img.rotate("clockwise", 180)
+        self.assertEqual(other_img.data, self.img.data)
+
+    def test_rotation_matches_list_rotation(self):
+        mat = [[1, 2, 3], [4, 5, 6], [7, 8, 9], [10, 11, 12]]
+
+        self.img.data = mat
+        self.img.rotate()
+        self.assertEqual([[10, 7, 4, 1], [11, 8, 5, 2], [12, 9, 6, 3]], self.img.data)
+
+        self.img.data = mat
+        self.img.rotate("anti-clockwise")
+        self.assertEqual([[3, 6, 9, 12], [2, 5, 8, 11], [1, 4, 7, 10]], self.img.data)
+
+    def test_invalid_direction(self):
+        with self.assertRaises(ValueError):
+            self.img.rotate("sideways")
+
 
 if __name__ == '__main__':
     unittest.main()
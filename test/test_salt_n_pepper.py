@@ -36,6 +36,16 @@ class TestImgConcat(unittest.TestCase):
         untouched_pixel_percentage = (squared_diff_sum / (len(self.original_img.data) * len(self.original_img.data[0]))) * 100
         self.assertGreaterEqual(untouched_pixel_percentage, 0.70)
 
+    def test_seeded_noise_is_reproducible(self):
+        img1 = Img(img_path)
+        img2 = Img(img_path)
+
+        img1.salt_n_pepper(rng=42)
+        img2.salt_n_pepper(rng=42)
+
+        self.assertEqual(img1.data, img2.data)
+        self.assertNotEqual(self.original_img.data, img1.data)
+
 
 if __name__ == '__main__':
     unittest.main()
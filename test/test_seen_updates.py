@@ -0,0 +1,73 @@
+import unittest
+import tempfile
+import time
+import os
+from unittest.mock import patch
+from polybot.python.seen_updates import SeenUpdates
+
+
+def update(update_id, message_id, edited=False, edit_date=None):
+    msg = {'message_id': message_id, 'chat': {'id': 5}}
+    if edit_date is not None:
+        msg['edit_date'] = edit_date
+    return {'update_id': update_id, 'edited_message' if edited else 'message': msg}
+
+
+class TestSeenUpdates(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.path = os.path.join(self.tmp_dir.name, 'seen_updates.sqlite3')
+
+    def seen_updates(self, **kwargs):
+        seen_updates = SeenUpdates(self.path, **kwargs)
+        self.addCleanup(seen_updates.close)
+        return seen_updates
+
+    def test_redelivered_update_is_a_duplicate(self):
+        seen_updates = self.seen_updates()
+
+        self.assertFalse(seen_updates.seen(seen_updates.keys(update(1, 10))))
+        self.assertTrue(seen_updates.add(seen_updates.keys(update(1, 10))))
+        self.assertTrue(seen_updates.seen(seen_updates.keys(update(1, 10))))
+        self.assertFalse(seen_updates.add(seen_updates.keys(update(1, 10))))
+        # The same message under another update_id
+        self.assertTrue(seen_updates.seen(seen_updates.keys(update(2, 10))))
+        # An edit of the message is a new update
+        self.assertFalse(seen_updates.seen(seen_updates.keys(update(3, 10, edited=True, edit_date=100))))
+
+        # It's shared by the processes
+        self.assertTrue(self.seen_updates().seen(seen_updates.keys(update(1, 10))))
+
+        self.assertEqual({"lookups": 4, "duplicates": 2, "hit_rate": 0.5}, seen_updates.stats)
+
+    def test_update_is_only_seen_once_added(self):
+        # The process accepting it died before it was queued
+        seen_updates = self.seen_updates()
+        keys = seen_updates.keys(update(1, 10))
+
+        self.assertFalse(seen_updates.seen(keys))
+        self.assertFalse(seen_updates.seen(keys))
+
+    def test_keys_expire(self):
+        seen_updates = self.seen_updates(ttl=60)
+        keys = seen_updates.keys(update(1, 10))
+        seen_updates.add(keys)
+
+        with patch('polybot.python.seen_updates.time.time', return_value=time.time() + 61):
+            self.assertTrue(seen_updates.add(keys))
+
+    def test_size_is_bounded(self):
+        seen_updates = self.seen_updates(max_size=10)
+
+        with patch('polybot.python.seen_updates.PRUNE_EVERY', 1):
+            for update_id in range(20):
+                seen_updates.add(seen_updates.keys(update(update_id, update_id)))
+
+        self.assertTrue(seen_updates.add(seen_updates.keys(update(0, 0))))
+        self.assertFalse(seen_updates.add(seen_updates.keys(update(19, 19))))
+
+
+if __name__ == '__main__':
+    unittest.main()
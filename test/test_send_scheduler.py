@@ -0,0 +1,113 @@
+import unittest
+import threading
+import time
+import io
+from telebot.apihelper import ApiTelegramException
+from polybot.python.send_scheduler import SendScheduler
+
+
+class Recorder:
+
+    def __init__(self, failures=()):
+        self.lock = threading.Lock()
+        self.calls = []
+        self.failures = list(failures)
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.record(("text", chat_id, text))
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        return self.record(("photo", chat_id, photo.read() if hasattr(photo, "read") else photo))
+
+    def record(self, call):
+        with self.lock:
+            self.calls.append((time.monotonic(), call))
+            if self.failures:
+                raise self.failures.pop(0)
+        return call
+
+
+def flood_wait(retry_after):
+    return ApiTelegramException("sendPhoto", None, {
+        "ok": False, "error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": retry_after}
+    })
+
+
+class TestSendScheduler(unittest.TestCase):
+
+    def test_texts_are_coalesced(self):
+        scheduler = SendScheduler(coalesce_window=0.1)
+        recorder = Recorder()
+
+        first = scheduler.send_text(1, "Processing, please wait...", recorder.send_message)
+        second = scheduler.send_text(1, "An error has occurred", recorder.send_message)
+        other_chat = scheduler.send_text(2, "Hello", recorder.send_message)
+
+        self.assertIs(first, second)
+        self.assertEqual(("text", 1, "Processing, please wait...\n\nAn error has occurred"), first.result(5))
+        self.assertEqual(("text", 2, "Hello"), other_chat.result(5))
+        self.assertEqual(1, scheduler.stats["coalesced"])
+
+    def test_chat_rate_is_limited(self):
+        scheduler = SendScheduler(chat_rate=10, chat_burst=1)
+        recorder = Recorder()
+
+        futures = [scheduler.send(1, recorder.send_photo, 1, index) for index in range(4)]
+        self.assertEqual([("photo", 1, index) for index in range(4)], [future.result(5) for future in futures])
+
+        times = [sent for sent, _ in recorder.calls]
+        # One every 0.1 seconds, in order
+        self.assertGreaterEqual(times[-1] - times[0], 0.25)
+
+    def test_global_rate_is_limited(self):
+        scheduler = SendScheduler(global_rate=10)
+        recorder = Recorder()
+
+        futures = [scheduler.send(chat_id, recorder.send_photo, chat_id, "photo") for chat_id in range(13)]
+        for future in futures:
+            future.result(5)
+
+        # The first 10 go out in a burst, then one every 0.1 seconds
+        times = sorted(sent for sent, _ in recorder.calls)
+        self.assertGreaterEqual(times[-1] - times[0], 0.25)
+
+    def test_photos_go_before_texts(self):
+        scheduler = SendScheduler(coalesce_window=0, chat_rate=10, chat_burst=1)
+        recorder = Recorder()
+        block = threading.Event()
+
+        # Keeps the chat busy while the others are queued
+        blocker = scheduler.send(1, lambda: block.wait(5))
+        while not scheduler.stats["in_flight"]:
+            time.sleep(0.01)
+        text = scheduler.send_text(1, "Processing, please wait...", recorder.send_message)
+        photo = scheduler.send(1, recorder.send_photo, 1, "result")
+        block.set()
+
+        blocker.result(5)
+        text.result(5)
+        photo.result(5)
+        self.assertEqual(["photo", "text"], [call[0] for _, call in recorder.calls])
+
+    def test_retry_after_is_honored(self):
+        scheduler = SendScheduler()
+        recorder = Recorder([flood_wait(0.2)])
+
+        start = time.monotonic()
+        self.assertEqual(("photo", 1, b"image"), scheduler.send(1, recorder.send_photo, 1, io.BytesIO(b"image")).result(5))
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(2, len(recorder.calls))
+        self.assertEqual(1, scheduler.stats["flood_waits"])
+
+    def test_failures_are_raised(self):
+        scheduler = SendScheduler(max_retries=1)
+        recorder = Recorder([flood_wait(0), flood_wait(0)])
+
+        with self.assertRaises(ApiTelegramException):
+            scheduler.send(1, recorder.send_photo, 1, "photo").result(5)
+        self.assertEqual(1, scheduler.stats["failed"])
+
+
+if __name__ == '__main__':
+    unittest.main()
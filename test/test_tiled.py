@@ -0,0 +1,95 @@
+import unittest
+import numpy as np
+from PIL import Image
+from polybot.python.img_proc import Img, Pipeline, decode_bytes_per_pixel
+import os
+
+img_path = 'polybot/test/beatles.jpeg' if '/polybot/test' not in os.getcwd() else 'beatles.jpeg'
+
+# Small enough to split the test image into many bands
+MEMORY_BUDGET = 64 * 1024
+
+
+def tiled_img(path):
+    """
+    The image is decoded in memory, a budget this small only fits the operations run on it in bands
+    """
+    img = Img(path, memory_budget=None)
+    img.memory_budget = MEMORY_BUDGET
+    return img
+
+
+class TestImgTiled(unittest.TestCase):
+
+    def setUp(self):
+        self.img = tiled_img(img_path)
+        self.expected_img = Img(img_path, memory_budget=None)
+
+    def test_decode_over_budget_is_rejected(self):
+        with self.assertRaises(RuntimeError):
+            Img(img_path, memory_budget=MEMORY_BUDGET)
+
+    def test_concat_decode_matches_in_memory(self):
+        # Enough to decode every image on its own, but not to hold the concatenated result
+        with Image.open(img_path) as image:
+            memory_budget = image.width * image.height * decode_bytes_per_pixel(image.mode)
+
+        img = Img.from_concat([img_path] * 4, memory_budget=memory_budget)
+        expected_img = Img.from_concat([img_path] * 4, memory_budget=None)
+
+        self.assertIsInstance(img._pixels, np.memmap)
+        self.assertEqual(expected_img.data, img.data)
+
+    def test_encode_matches_in_memory(self):
+        self.img.blur(4)
+        self.expected_img.blur(4)
+
+        for format in ["PNG", "JPEG"]:
+            self.assertEqual(self.expected_img.encode(format).data, self.img.encode(format).data)
+
+    def test_blur_matches_in_memory(self):
+        for blur_level in [1, 4, 31]:
+            img = tiled_img(img_path)
+            expected_img = Img(img_path, memory_budget=None)
+
+            img.blur(blur_level)
+            expected_img.blur(blur_level)
+
+            self.assertIsInstance(img._pixels, np.memmap)
+            self.assertEqual(expected_img.data, img.data)
+
+    def test_contour_and_segment_match_in_memory(self):
+        self.img.rotate()
+        self.img.contour()
+        self.img.segment()
+
+        self.expected_img.rotate()
+        self.expected_img.contour()
+        self.expected_img.segment()
+
+        self.assertEqual(self.expected_img.data, self.img.data)
+
+    def test_pipeline_matches_in_memory(self):
+        pipeline = Pipeline().blur(9).rotate(deg=270).segment()
+        pipeline.run(self.img)
+        pipeline.run(self.expected_img)
+
+        self.assertEqual(self.expected_img.data, self.img.data)
+
+    def test_concat_matches_in_memory(self):
+        self.img.concat(tiled_img(img_path), "vertical")
+        self.expected_img.concat(Img(img_path, memory_budget=None), "vertical")
+
+        self.assertEqual(self.expected_img.data, self.img.data)
+
+    def test_salt_n_pepper_dimension(self):
+        self.img.salt_n_pepper(0.1, rng=7)
+
+        total_pixels = len(self.img.data) * len(self.img.data[0])
+        noisy_pixels = sum(row.count(255) + row.count(0) for row in self.img.data)
+        self.assertEqual((len(self.expected_img.data), len(self.expected_img.data[0])), (len(self.img.data), len(self.img.data[0])))
+        self.assertGreaterEqual(noisy_pixels / total_pixels, 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+import threading
+from polybot.python.worker_pool import WorkerPool
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_tasks_run(self):
+        pool = WorkerPool(workers=2, queue_size=4)
+        done = threading.Semaphore(0)
+        results = []
+
+        for value in range(4):
+            self.assertTrue(pool.submit(value, lambda v: (results.append(v), done.release()), value))
+        for _ in range(4):
+            self.assertTrue(done.acquire(timeout=5))
+
+        self.assertEqual([0, 1, 2, 3], sorted(results))
+        self.assertEqual(4, pool.stats["submitted"])
+
+    def test_full_queue_rejects(self):
+        pool = WorkerPool(workers=1, queue_size=1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        self.assertTrue(pool.submit(1, block))
+        self.assertTrue(started.wait(5))
+        # The worker is busy, one task may wait in the queue and the next one is turned away
+        self.assertTrue(pool.submit(1, block))
+        self.assertFalse(pool.submit(1, block))
+
+        stats = pool.stats
+        self.assertEqual(1, stats["rejected"])
+        self.assertEqual(1, stats["queue_depth"])
+        self.assertEqual(1, stats["active"])
+        release.set()
+
+    def test_failing_task_keeps_the_worker(self):
+        pool = WorkerPool(workers=1, queue_size=2)
+        done = threading.Event()
+
+        pool.submit(1, lambda: 1 / 0)
+        pool.submit(1, done.set)
+
+        self.assertTrue(done.wait(5))
+
+    def test_tasks_of_a_key_run_in_order(self):
+        pool = WorkerPool(workers=4, queue_size=100)
+        done = threading.Semaphore(0)
+        results = {chat_id: [] for chat_id in range(8)}
+
+        for index in range(50):
+            for chat_id in results:
+                pool.submit(chat_id, lambda c, i: (results[c].append(i), done.release()), chat_id, index)
+        for _ in range(50 * len(results)):
+            self.assertTrue(done.acquire(timeout=5))
+
+        for chat_id in results:
+            self.assertEqual(list(range(50)), results[chat_id])
+
+    def test_other_keys_run_while_one_is_busy(self):
+        pool = WorkerPool(workers=2, queue_size=1)
+        release = threading.Event()
+        done = threading.Event()
+
+        # Keys 0 and 1 go to different workers
+        pool.submit(0, release.wait, 5)
+        pool.submit(1, done.set)
+
+        self.assertTrue(done.wait(5))
+        release.set()
+
+    def test_needs_a_worker(self):
+        with self.assertRaises(ValueError):
+            WorkerPool(workers=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import unittest
+import threading
+import json
+import sys
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# The bot's modules import each other as top level modules, the way uWSGI loads them
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python')))
+from yolo5_client import Yolo5Client, poll_delays
+
+
+class FakeYolo5(BaseHTTPRequestHandler):
+    """
+    A job API which reports every job pending for the given number of polls and then done (or failed with fail_with),
+    and can lose its jobs
+    """
+    pending_polls = 2
+    fail_with = None
+    lose_jobs = False
+    created = 0
+    jobs = {}
+    submits = []
+    polls = []
+
+    def do_POST(self):
+        img_name = parse_qs(urlparse(self.path).query)["imgName"][0]
+        self.submits.append(img_name)
+        created = img_name not in self.jobs
+        if created:
+            self.jobs[img_name] = f"job-{FakeYolo5.created}"
+            FakeYolo5.created += 1
+        self.answer(202 if created else 200, {"job_id": self.jobs[img_name], "status": "queued"})
+
+    def do_GET(self):
+        job_id = self.path.split("/")[2]
+        self.polls.append(job_id)
+        if FakeYolo5.lose_jobs:
+            # Restarted
+            FakeYolo5.lose_jobs = False
+            self.jobs.clear()
+        if job_id not in self.jobs.values():
+            self.answer(404, {"job_id": job_id, "status": "unknown", "error": f"Job {job_id} was not found."})
+        elif self.polls.count(job_id) <= self.pending_polls:
+            self.answer(202, {"job_id": job_id, "status": "running"})
+        elif FakeYolo5.fail_with is not None:
+            self.answer(422, {"job_id": job_id, "status": "failed", "error": "Prediction result not found", "status_code": FakeYolo5.fail_with})
+        else:
+            self.answer(200, {"prediction_id": job_id, "labels": []})
+
+    def answer(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestYolo5Client(unittest.TestCase):
+
+    def setUp(self):
+        FakeYolo5.pending_polls = 2
+        FakeYolo5.fail_with = None
+        FakeYolo5.lose_jobs = False
+        FakeYolo5.created = 0
+        FakeYolo5.jobs = {}
+        FakeYolo5.submits = []
+        FakeYolo5.polls = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeYolo5)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = Yolo5Client(f"http://127.0.0.1:{self.server.server_port}", timeout=5, poll_initial=0.01, poll_max=0.02)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.client.session.close()
+
+    def test_result_is_polled_for(self):
+        self.assertEqual({"prediction_id": "job-0", "labels": []}, self.client.predict("image.jpeg"))
+        self.assertEqual(["image.jpeg"], FakeYolo5.submits)
+        self.assertEqual(["job-0"] * 3, FakeYolo5.polls)
+
+    def test_lost_job_is_submitted_again(self):
+        FakeYolo5.lose_jobs = True
+
+        self.assertEqual("job-1", self.client.predict("image.jpeg")["prediction_id"])
+        self.assertEqual(["image.jpeg", "image.jpeg"], FakeYolo5.submits)
+        self.assertEqual(["job-0", "job-1", "job-1", "job-1"], FakeYolo5.polls)
+
+    def test_failed_job_is_not_submitted_again(self):
+        # Nothing was detected in the photo
+        FakeYolo5.fail_with = 404
+
+        with self.assertRaisesRegex(RuntimeError, "failed \\(404\\): Prediction result not found"):
+            self.client.predict("image.jpeg")
+        self.assertEqual(["image.jpeg"], FakeYolo5.submits)
+        self.assertEqual(["job-0"] * 3, FakeYolo5.polls)
+
+        # A job which expired before it started isn't taken for yolo5 being busy either
+        FakeYolo5.fail_with = 504
+        with self.assertRaisesRegex(RuntimeError, "failed \\(504\\)"):
+            self.client.predict("image.jpeg")
+        self.assertEqual(["image.jpeg"] * 2, FakeYolo5.submits)
+
+    def test_timeout(self):
+        FakeYolo5.pending_polls = 1000
+        self.client.timeout = 0.2
+        with self.assertRaises(TimeoutError):
+            self.client.predict("image.jpeg")
+        self.assertEqual(["image.jpeg"], FakeYolo5.submits)
+
+    def test_poll_delays(self):
+        delays = poll_delays(0.5, 5)
+        self.assertEqual([0.5, 1, 2, 4, 5, 5], [next(delays) for _ in range(6)])
+
+
+if __name__ == '__main__':
+    unittest.main()
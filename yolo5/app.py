@@ -1,28 +1,111 @@
 from flask import Flask, request, jsonify
-import uuid
+import queue
 from yolo_utils import identify, write_to_db
+from jobs import JobStore, DONE, FAILED, UNKNOWN
+from resilience import breaker_stats
 
 app = Flask(__name__, static_url_path='')
 
+# Seconds a client is told to wait before submitting again when the queue is full
+RETRY_AFTER = 5
+
+def run_prediction(img_name, prediction_id):
+    # Execute the identification process on the image
+    response = identify(img_name, prediction_id)
+
+    if response[1] == 200:
+        response = write_to_db(prediction_id, response[0])
+
+    return response
+
+# The job id is used as the prediction id, as a reference in logs to identify and track individual predictions
+jobs = JobStore(run_prediction)
+
+def submit(img_name, callback_url=None, timeout=None):
+    """
+    :return: (job, created) or (None, None) if the queue is full
+    """
+    try:
+        return jobs.submit(img_name, callback_url, timeout)
+    except queue.Full:
+        return None, None
+
+def unknown_job(job_id):
+    # The body tells a client the job is gone and may be submitted again, from a 404 of anything else
+    return jsonify({"job_id": job_id, "status": UNKNOWN, "error": f"Job {job_id} was not found."}), 404
+
+def queue_full():
+    return jsonify("Too many predictions are waiting, please try again later."), 503, {"Retry-After": str(RETRY_AFTER)}
+
 @app.route('/', methods=['GET'])
 def index():
     return 'Ok'
 
-@app.route('/predict', methods=['POST'])
-def predict():
-    # Generates a UUID for this current prediction HTTP request. This id can be used as a reference in logs to identify and track individual prediction requests.
-    prediction_id = str(uuid.uuid4())
-
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Starts a prediction job of the image (or joins the image's existing one) and answers straight away with its id,
+    the result is then polled for at /jobs/<job_id>/result or posted to the callbackUrl once it's ready.
+    The optional timeout is the seconds the client waits for the result
+    """
     # Receives a URL parameter representing the image to download from S3
     img_name = request.args.get('imgName')
+    if not img_name:
+        return jsonify("The imgName parameter is required."), 400
 
-    # Execute the identification process on the image
-    response = identify(img_name, prediction_id)
+    timeout = request.args.get('timeout', type=float)
+    job, created = submit(img_name, request.args.get('callbackUrl'), timeout)
+    if job is None:
+        return queue_full()
 
-    if response[1] == 200:
-        response = write_to_db(prediction_id, response[0])
+    return jsonify(job.to_dict()), 202 if created else 200, {"Location": f"/jobs/{job.job_id}"}
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return unknown_job(job_id)
+
+    return jsonify(job.to_dict()), 200
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """
+    200 with the prediction summary once the job is done, 202 with its status while it's queued or running, 422 with
+    its status, error and the status code it failed with if it failed and 404 with the 'unknown' status for a job
+    which isn't known. The status of a failed job is never one a client takes for yolo5 being busy or the job being lost
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return unknown_job(job_id)
+
+    if job.status == DONE:
+        return jsonify(job.result), 200
+    if job.status == FAILED:
+        return jsonify(job.to_dict()), 422
+
+    return jsonify(job.to_dict()), 202
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({"jobs": jobs.stats, "breakers": breaker_stats()}), 200
+
+@app.route('/predict', methods=['POST'])
+def predict():
+    """
+    Kept for clients which wait for the prediction, it submits a job (or joins the image's existing one, so a retried
+    request doesn't predict again) and waits for it
+    """
+    img_name = request.args.get('imgName')
+    if not img_name:
+        return jsonify("The imgName parameter is required."), 400
+
+    job, _ = submit(img_name)
+    if job is None:
+        return queue_full()
 
-    return jsonify(response[0]), response[1]
+    job.done.wait()
+    return jsonify(job.result), job.status_code
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=8081)
@@ -0,0 +1,190 @@
+from loguru import logger
+from resilience import deadline
+import threading
+import requests
+import queue
+import time
+import uuid
+import os
+
+# Number of predictions run at the same time, inference is CPU bound so more only makes them slower
+PREDICT_WORKERS = int(os.getenv("PREDICT_WORKERS", "1"))
+# Number of jobs which may wait for a worker before new ones are turned away
+PREDICT_QUEUE_SIZE = int(os.getenv("PREDICT_QUEUE_SIZE", "32"))
+# How long a finished job (and its result) is kept
+JOB_TTL = int(os.getenv("JOB_TTL_SECONDS", "600"))
+# Seconds to wait for a callback URL to answer
+CALLBACK_TIMEOUT = 10
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+# Answered for a job id which isn't known (anymore), e.g. yolo5 restarted or the job expired
+UNKNOWN = "unknown"
+
+
+class Job:
+
+    def __init__(self, img_name, timeout=None):
+        self.job_id = str(uuid.uuid4())
+        self.img_name = img_name
+        self.status = QUEUED
+        self.submitted = time.time()
+        # When the client gives up waiting for the result
+        self.expires = None if timeout is None else time.monotonic() + timeout
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.status_code = None
+        self.callback_urls = []
+        self.done = threading.Event()
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "img_name": self.img_name,
+            "status": self.status,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "error": self.result if self.status == FAILED else None,
+            # The status the prediction failed with (see identify) e.g. 404 if nothing was detected
+            "status_code": self.status_code if self.status == FAILED else None,
+        }
+
+
+class JobStore:
+    """
+    Runs the predictions as jobs on a fixed number of worker threads, so a prediction request is answered straight away
+    with a job id and its status and result are polled for (or posted to a callback URL once it's done).
+    Submitting is idempotent by image name: while a job of an image is queued, running or done (for ttl seconds)
+    submitting the image again returns the same job, so a client retrying never starts a second inference.
+    A failed job may be submitted again.
+    """
+
+    def __init__(self, predict, workers=PREDICT_WORKERS, queue_size=PREDICT_QUEUE_SIZE, ttl=JOB_TTL):
+        """
+        :param predict: Called with (img_name, job_id) by the workers, returns (result, status code) like identify
+        """
+        self.predict = predict
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._by_image = {}
+        self._queue = queue.Queue(maxsize=queue_size)
+
+        self.submitted = 0
+        self.deduplicated = 0
+        self.rejected = 0
+
+        for index in range(workers):
+            threading.Thread(target=self._work, name=f"predict-{index}", daemon=True).start()
+
+    def submit(self, img_name, callback_url=None, timeout=None):
+        """
+        Raises queue.Full if the queue is full
+
+        :param callback_url: Posted the job's status and result once it's done
+        :param timeout: The seconds the client waits for the result, the job isn't started once they passed and its S3
+                        and MongoDB calls don't retry beyond them
+        :return: (job, created) the job of the image and whether it was created by this call
+        """
+        with self._lock:
+            self._prune()
+
+            job = self._by_image.get(img_name)
+            created = job is None or job.status == FAILED
+            if created:
+                job = Job(img_name, timeout)
+                try:
+                    self._queue.put_nowait(job)
+                except queue.Full:
+                    self.rejected += 1
+                    raise
+
+                self._jobs[job.job_id] = job
+                self._by_image[img_name] = job
+                self.submitted += 1
+            else:
+                self.deduplicated += 1
+                if job.status == QUEUED and job.expires is not None:
+                    # The job is started as long as any of its clients still waits
+                    job.expires = None if timeout is None else max(job.expires, time.monotonic() + timeout)
+
+            if callback_url and callback_url not in job.callback_urls:
+                job.callback_urls.append(callback_url)
+            finished = job.done.is_set()
+
+        # Joining a job which already finished
+        if callback_url and finished:
+            self._notify(job, [callback_url])
+
+        return job, created
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self) -> None:
+        # Must be called holding the lock
+        expired = time.time() - self.ttl
+        for job_id, job in list(self._jobs.items()):
+            if job.finished is not None and job.finished < expired:
+                del self._jobs[job_id]
+                if self._by_image.get(job.img_name) is job:
+                    del self._by_image[job.img_name]
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            with self._lock:
+                job.status = RUNNING
+                job.started = time.time()
+
+            try:
+                if job.expires is None:
+                    result, status_code = self.predict(job.img_name, job.job_id)
+                elif job.expires <= time.monotonic():
+                    # Nobody waits for the result anymore, predicting it would only delay the jobs behind it
+                    logger.warning(f"Prediction: {job.job_id}/{job.img_name}. Dropped, its client stopped waiting while it was queued")
+                    result, status_code = f"Prediction: {job.job_id}/{job.img_name}. The client stopped waiting before it started", 504
+                else:
+                    with deadline(job.expires - time.monotonic()):
+                        result, status_code = self.predict(job.img_name, job.job_id)
+            except Exception as e:
+                logger.exception(f"Prediction: {job.job_id}/{job.img_name} failed: {e}")
+                result, status_code = f"Prediction: {job.job_id}/{job.img_name} failed: {e}", 500
+
+            with self._lock:
+                job.result = result
+                job.status_code = status_code
+                job.status = DONE if status_code == 200 else FAILED
+                job.finished = time.time()
+                callback_urls = list(job.callback_urls)
+            job.done.set()
+
+            self._notify(job, callback_urls)
+
+    def _notify(self, job, callback_urls) -> None:
+        for callback_url in callback_urls:
+            try:
+                requests.post(callback_url, json={**job.to_dict(), "result": job.result if job.status == DONE else None}, timeout=CALLBACK_TIMEOUT)
+            except requests.RequestException as e:
+                logger.warning(f"Prediction: {job.job_id}. Calling back {callback_url} failed: {e}")
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+            return {
+                "queue_depth": self._queue.qsize(),
+                "queued": statuses.count(QUEUED),
+                "running": statuses.count(RUNNING),
+                "done": statuses.count(DONE),
+                "failed": statuses.count(FAILED),
+                "submitted": self.submitted,
+                "deduplicated": self.deduplicated,
+                "rejected": self.rejected,
+            }